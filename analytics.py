@@ -0,0 +1,261 @@
+import argparse
+import csv
+import math
+import sys
+import time
+
+import logs
+
+# Per-cycle analytics from controller logs.
+#
+# Text logs and telemetry files are streamed through logs.iter_events() and
+# cut into cycles, one row per cycle, so gigabytes of logs go through in
+# constant memory:
+#   - text logs are split at the 'Starting <phase> phase' and 'Cycle Count'
+#     lines, and the timeout/early exit lines are counted per phase,
+#   - telemetry (and old text logs without phase lines) are split where the
+#     cycle timer or the phase timer starts over; phases are named after their
+#     mode, and there is no record of timeouts.
+# The rows are saved as NumPy columns in an .npz file, which loads in
+# milliseconds for any later question:
+#
+#   python analytics.py mark_icemaker2.log* --output cycles.npz
+#   python analytics.py cycles.npz --since 2024-05-01 --until 2024-06-01
+#
+# Durations are seconds; text log timestamps only have one second resolution.
+
+FIXED = ('start', 'duration_s', 'interval_s', 'cycles_per_hour', 'complete', 'timeouts', 'timed_out', 'early_exits',
+         'plate_min', 'plate_max', 'bin_min', 'bin_max', 'ticks')
+
+
+class Cycle():
+    def __init__(self, start):
+        self.start = start
+        self.end = start
+        self.complete = False
+        # phase name -> [start, end], in order
+        self.phases = {}
+        self.phase = None
+        # times each phase name came up
+        self.seen = {}
+        self.timed_out = []
+        self.early_exits = 0
+        self.plate = [math.inf, -math.inf]
+        self.bin = [math.inf, -math.inf]
+        self.ticks = 0
+
+    def start_phase(self, name, t):
+        if self.phase is not None:
+            self.phases[self.phase][1] = t
+        self.seen[name] = self.seen.get(name, 0) + 1
+        if self.seen[name] > 1:
+            # the same phase twice in one cycle (e.g. CHILL for prechill and rechill)
+            name = f'{name}_{self.seen[name]}'
+        self.phases[name] = [t, t]
+        self.phase = name
+
+    def finish(self, t, complete):
+        self.end = max(self.end, t)
+        if self.phase is not None:
+            self.phases[self.phase][1] = self.end
+        self.complete = complete
+
+
+class CycleSplitter():
+    # feed events in order with add(); finished cycles come out of add() and close()
+    def __init__(self):
+        self.cycle = None
+        # split on the phase/cycle lines, or on the tick timers if there are none
+        self.from_ticks = True
+        self.last = None
+
+    def add(self, kind, t, data):
+        done = []
+        cycle = self.cycle
+        if kind == 'tick':
+            _, mode, _, plate, bin_temp, time_in_mode, time_in_cycle = data
+            if self.from_ticks:
+                last = self.last
+                if cycle is None or (last is not None and time_in_cycle < last[2]):
+                    if cycle is not None:
+                        done.append(self._close(cycle.end, True))
+                    cycle = self.cycle = Cycle(t - time_in_cycle)
+                    last = None
+                if last is None or mode != last[0] or time_in_mode < last[1]:
+                    cycle.start_phase(mode, t - time_in_mode)
+                self.last = (mode, time_in_mode, time_in_cycle)
+            if cycle is None:
+                return done
+            cycle.end = max(cycle.end, t)
+            cycle.ticks += 1
+            cycle.plate[0] = min(cycle.plate[0], plate)
+            cycle.plate[1] = max(cycle.plate[1], plate)
+            cycle.bin[0] = min(cycle.bin[0], bin_temp)
+            cycle.bin[1] = max(cycle.bin[1], bin_temp)
+        elif kind == 'phase':
+            name = data[0]
+            if self.from_ticks:
+                # phase lines from here on; a cycle cut from ticks so far is cut short
+                self.from_ticks = False
+                if cycle is not None:
+                    done.append(self._close(t, False))
+                    cycle = None
+            elif cycle is not None and name in cycle.phases:
+                # no Cycle Count line, the controller was restarted mid cycle
+                done.append(self._close(t, False))
+                cycle = None
+            if cycle is None:
+                cycle = self.cycle = Cycle(t)
+            cycle.start_phase(name, t)
+        elif cycle is not None:
+            if kind == 'timeout':
+                # old logs say 'Chilling'/'Harvest' rather than the phase name
+                cycle.timed_out.append(cycle.phase)
+            elif kind == 'early':
+                cycle.early_exits += 1
+            elif kind == 'cycle' and not self.from_ticks:
+                done.append(self._close(t, True))
+        return done
+
+    def _close(self, t, complete):
+        cycle = self.cycle
+        cycle.finish(t, complete)
+        self.cycle = None
+        self.last = None
+        return cycle
+
+    def close(self):
+        if self.cycle is None:
+            return []
+        return [self._close(self.cycle.end, False)]
+
+
+def iter_cycles(paths):
+    splitter = CycleSplitter()
+    for path in paths:
+        for kind, t, data in logs.iter_events(path):
+            yield from splitter.add(kind, t, data)
+    yield from splitter.close()
+
+
+def tabulate(cycles):
+    # cycles -> {column: list}; a column per phase name, nan where a cycle didn't have it
+    columns = {name: [] for name in FIXED}
+    phase_columns = {}
+    previous = None
+    rows = 0
+    for cycle in cycles:
+        if previous is not None:
+            interval = cycle.start - previous.start
+            columns['interval_s'][-1] = interval
+            columns['cycles_per_hour'][-1] = 3600 / interval if interval > 0 else math.nan
+        columns['start'].append(cycle.start)
+        columns['duration_s'].append(cycle.end - cycle.start)
+        columns['interval_s'].append(math.nan)
+        columns['cycles_per_hour'].append(math.nan)
+        columns['complete'].append(cycle.complete)
+        columns['timeouts'].append(len(cycle.timed_out))
+        columns['timed_out'].append(' '.join(cycle.timed_out))
+        columns['early_exits'].append(cycle.early_exits)
+        for channel in ('plate', 'bin'):
+            low, high = getattr(cycle, channel) if cycle.ticks else (math.nan, math.nan)
+            columns[f'{channel}_min'].append(low)
+            columns[f'{channel}_max'].append(high)
+        columns['ticks'].append(cycle.ticks)
+        for name, (start, end) in cycle.phases.items():
+            column = phase_columns.setdefault(f'{name}_s', [math.nan] * rows)
+            column.append(end - start)
+        rows += 1
+        for column in phase_columns.values():
+            if len(column) < rows:
+                column.append(math.nan)
+        previous = cycle
+    columns.update(phase_columns)
+    return columns
+
+
+def save(columns, path):
+    import numpy
+    numpy.savez(path, **{name: numpy.array(values) for name, values in columns.items()})
+
+
+def load(path):
+    import numpy
+    with numpy.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+
+def write_csv(columns, path):
+    names = list(columns)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(names)
+        for row in zip(*(columns[name] for name in names)):
+            writer.writerow(f'{value:.1f}' if isinstance(value, float) else value for value in row)
+
+
+def select(columns, since=None, until=None):
+    # rows with since <= start < until (unix times)
+    import numpy
+    start = numpy.asarray(columns['start'])
+    keep = numpy.ones(len(start), dtype=bool)
+    if since is not None:
+        keep &= start >= since
+    if until is not None:
+        keep &= start < until
+    return {name: numpy.asarray(values)[keep] for name, values in columns.items()}
+
+
+def summary(columns):
+    import numpy
+    lines = []
+    count = len(columns['start'])
+    if not count:
+        return 'no cycles'
+    complete = columns['complete'].astype(bool)
+    span = (columns['start'][-1] - columns['start'][0]) / 3600
+    lines.append(f'{count} cycles ({int(complete.sum())} complete) from {time.strftime("%Y-%m-%d %H:%M", time.localtime(columns["start"][0]))} '
+                 f'over {span:.1f} h')
+    lines.append(f'  cycle      {numpy.nanmean(columns["duration_s"][complete]) / 60:6.1f} min mean, '
+                 f'{numpy.nanmedian(columns["duration_s"][complete]) / 60:6.1f} min median')
+    timed_out = [name for names in columns['timed_out'] for name in str(names).split()]
+    for name in columns:
+        if not name.endswith('_s') or name in FIXED:
+            continue
+        values = columns[name][complete]
+        values = values[~numpy.isnan(values)]
+        if not len(values):
+            continue
+        phase = name[:-2]
+        lines.append(f'  {phase:10} {values.mean() / 60:6.1f} min mean, {numpy.median(values) / 60:6.1f} min median, '
+                     f'{values.max() / 60:6.1f} min max, {timed_out.count(phase)} timeouts')
+    lines.append(f'  throughput {numpy.nanmean(columns["cycles_per_hour"]):.2f} cycles/h, '
+                 f'{int(columns["early_exits"].sum())} early exits')
+    lines.append(f'  plate      {numpy.nanmin(columns["plate_min"]):.1f} to {numpy.nanmax(columns["plate_max"]):.1f} °F, '
+                 f'bin {numpy.nanmin(columns["bin_min"]):.1f} to {numpy.nanmax(columns["bin_max"]):.1f} °F')
+    return '\n'.join(lines)
+
+
+def parse_date(text):
+    return time.mktime(time.strptime(text, '%Y-%m-%d'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-cycle statistics from controller logs.')
+    parser.add_argument('paths', nargs='+', help='text logs and/or telemetry files oldest first, or one .npz from --output')
+    parser.add_argument('--output', help='save the per-cycle columns to this .npz file (needs numpy)')
+    parser.add_argument('--csv', help='write the per-cycle rows to this CSV file')
+    parser.add_argument('--since', type=parse_date, help='only cycles starting on or after this date (YYYY-MM-DD)')
+    parser.add_argument('--until', type=parse_date, help='only cycles starting before this date (YYYY-MM-DD)')
+    args = parser.parse_args()
+
+    if len(args.paths) == 1 and args.paths[0].endswith('.npz'):
+        columns = load(args.paths[0])
+    else:
+        columns = tabulate(iter_cycles(args.paths))
+    if args.output:
+        save(columns, args.output)
+    columns = select(columns, args.since, args.until)
+    if args.csv:
+        write_csv({name: values.tolist() for name, values in columns.items()}, args.csv)
+    print(summary(columns), file=sys.stderr)
@@ -0,0 +1,242 @@
+import argparse
+import asyncio
+import os
+import selectors
+
+from mark_icemaker2 import IceMaker
+from recipe import DONE, ConfigWatcher, load_config
+
+# asyncio controller runtime.
+#
+# The control loop of mark_icemaker2.IceMaker as cooperative coroutines, so
+# one process can drive the relays while other tasks (sensor polling, status,
+# stats flushes) run on the same event loop.  Relay switching and the per-tick
+# decisions are shared with IceMaker; only the waiting is different.
+#
+#   sensing   polls the SensorSampler in an executor thread at the sensors' own
+#             rates; phases read the cache, never the bus
+#   timeouts  every wait is capped at the phase timeout from the recipe's
+#             transition table, the same CycleEngine decides when phases end
+#   ticks     absolute deadlines, so per-tick work doesn't add up
+#   tasks     the scheduler's background tasks run from their own coroutine
+#   restart   run(restart=True) resumes from the checkpoint, see warm_restart()
+#
+# Run as a script it keeps telemetry.bin, stats.json and checkpoint.json next
+# to config.json, like mark_icemaker2 does; with --sim they stay in memory.
+# With a virtual-time backend (simulator.SimBackend) the loop runs on
+# VirtualTimeEventLoop, which jumps the simulated clock instead of blocking
+# whenever every coroutine is waiting on a timer.
+
+
+class VirtualTimeSelector(selectors.DefaultSelector):
+    def __init__(self, clock):
+        super().__init__()
+        self.clock = clock
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if events or timeout is None:
+            # nothing on a timer, block for real I/O (e.g. an executor finishing)
+            return events or super().select(timeout)
+        self.clock.sleep(timeout)
+        return events
+
+
+class VirtualTimeEventLoop(asyncio.SelectorEventLoop):
+    def __init__(self, clock):
+        super().__init__(VirtualTimeSelector(clock))
+        self.clock = clock
+
+    def time(self):
+        return self.clock.monotonic()
+
+
+def run(coro, backend):
+    # run a coroutine on the right kind of event loop for the backend
+    if not backend.virtual_time:
+        return asyncio.run(coro)
+    loop = VirtualTimeEventLoop(backend.clock)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class AsyncIceMaker(IceMaker):
+    # set while sense() has a poll running in the executor
+    sense_busy = False
+
+    async def sleep_until(self, deadline):
+        await asyncio.sleep(max(0, deadline - self.clock.monotonic()))
+
+    def next_deadline(self, deadline, period):
+        deadline += period
+        now = self.clock.monotonic()
+        if deadline <= now:
+            # missed whole ticks, skip them rather than bunching up
+            deadline = now + period - ((now - deadline) % period)
+        return deadline
+
+    async def sense(self):
+        # feed the sampler cache; reads block on the 1-Wire bus so they run in a thread
+        loop = asyncio.get_running_loop()
+        self.sampler.inline_polling = False
+        try:
+            while True:
+                if self.backend.parallel_reads:
+                    self.sense_busy = True
+                    try:
+                        await loop.run_in_executor(None, self.sampler.poll)
+                    finally:
+                        self.sense_busy = False
+                else:
+                    self.sampler.poll()
+                await self.sleep_until(min(self.sampler.next_due.values()))
+        finally:
+            self.sampler.inline_polling = True
+
+    async def housekeeping(self):
+        # the scheduler's background tasks (stats & telemetry flushes, sensor
+        # checks...), which the blocking runtime runs while its phase loops wait
+        while True:
+            self.scheduler.run_due()
+            due = self.scheduler.next_due()
+            await self.sleep_until(self.clock.monotonic() + self.MIN if due is None else due)
+
+    async def power_on(self):
+        self.logger.info('\tActivating Power On Startup Sequence')
+        deadline = self.clock.monotonic()
+        for relay, message, duration in (('water_valve', 'water valve', self.config['water_valve_time']),
+                                         ('recirculating_pump', 'recirculating pump', self.config['recirculation_pump_time']),
+                                         ('water_valve', 'water valve', self.config['water_valve_time'])):
+            self.logger.info(f'\t\tTurning on {message} for {duration} min.')
+            self.relay_on(relay)
+            deadline += duration * self.MIN
+            await self.sleep_until(deadline)
+            self.logger.info(f'\t\tTurning off {message}')
+            self.relay_off(relay)
+        self.save_checkpoint()
+        self.logger.info('\tCompletion of Power On Sequence')
+
+    def interlock_wait(self, deadline):
+        # relay switching is synchronous, so this blocks the loop; refresh the
+        # sensor cache the sense task couldn't meanwhile, unless its poll is
+        # still running in the executor, the sampler has a single writer
+        super().interlock_wait(deadline)
+        if not self.sense_busy:
+            self.sampler.poll()
+
+    async def apply_relays_async(self, settings, log=False):
+        # apply_relays, awaiting the interlock waits instead of blocking the loop
+        # (and every other machine on it, see fleet.py)
+        plan = self.interlocks.plan(self.relay_bank.state(), self.relay_bank.changed_at, settings, self.clock.monotonic())
+        changed = []
+        for at, batch in plan:
+            if at > self.clock.monotonic():
+                self.relay_logger.info('\t\tWaiting %.1f s for relay interlocks', at - self.clock.monotonic())
+                await self.sleep_until(at)
+            changed += self.apply_batch(batch, log)
+        return changed
+
+    async def run_cycle(self, resume=None):
+        # same recipe tables as CycleEngine.run_cycle, waiting with asyncio instead;
+        # resume: (phase, seconds into it, seconds into the cycle), see warm_restart()
+        engine = self.engine
+        recipe = engine.start_cycle()
+        wait_time = self.MIN / 12.0
+        state = recipe.start
+        elapsed = 0.0
+        if resume is not None and resume[0] in recipe.names:
+            state = recipe.names.index(resume[0])
+            elapsed = resume[1]
+            self.cycle_start_time -= resume[2]
+        while state != DONE:
+            # the phase's relays are switched here so interlock waits don't block
+            # the loop; the engine then finds them already set
+            await self.apply_relays_async(recipe.relays[state], True)
+            engine.enter(recipe, state, elapsed)
+            elapsed = 0.0
+            next_state = engine.evaluate(recipe, state)
+            deadline = self.mode_start_time
+            while next_state is None:
+                deadline = self.next_deadline(deadline, wait_time)
+                await self.sleep_until(min(deadline, engine.wake_at(recipe, state)))
+                next_state = engine.evaluate(recipe, state)
+            recipe, state = engine.boundary(recipe, next_state)
+        engine.finish_cycle()
+
+    async def wait_while_bin_full(self):
+        deadline = self.clock.monotonic()
+        while self.bin_full(threshold=self.config['bin_full_temp']):
+            self.logger.info('Ice bin full...sleeping.')
+            deadline = self.next_deadline(deadline, self.MIN)
+            await self.sleep_until(deadline)
+            await self.idle_step()
+        self.logger.info('Ice Bin not full...restarting ice-making cycle.')
+
+    async def idle_step(self):
+        settings = self.idle_settings()
+        if settings:
+            await self.apply_relays_async(settings, True)
+            self.save_checkpoint()
+        self.publish_status()
+
+    async def control(self, cycles=None, restart=False):
+        # restart: pick up from the checkpoint like mark_icemaker2's __main__ does
+        power_on, resume = self.warm_restart() if restart else (True, None)
+        if power_on:
+            await self.power_on()
+        elif resume is None:
+            await self.wait_while_bin_full()
+        while cycles is None or self.cycle_count < cycles:
+            await self.run_cycle(resume)
+            resume = None
+            if cycles is None or self.cycle_count < cycles:
+                await self.wait_while_bin_full()
+
+    async def run(self, cycles=None, tasks=(), restart=False):
+        # control loop plus any extra coroutines (monitoring, stats...) on one event loop;
+        # the extra tasks are cancelled once the control loop ends
+        background = [asyncio.ensure_future(self.sense()), asyncio.ensure_future(self.housekeeping())]
+        background += [asyncio.ensure_future(task) for task in tasks]
+        try:
+            await self.control(cycles, restart)
+        finally:
+            for task in background:
+                task.cancel()
+            await asyncio.gather(*background, return_exceptions=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the ice maker on the asyncio runtime.')
+    parser.add_argument('--sim', action='store_true', help='use the simulated backend')
+    parser.add_argument('--cycles', type=int, help='stop after this many cycles')
+    parser.add_argument('--config', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json'),
+                        help='settings file, config.json next to this script by default')
+    args = parser.parse_args()
+    config = load_config(args.config)
+
+    backend = None
+    if args.sim:
+        from simulator import SimBackend
+        backend = SimBackend(IceMaker.relays)
+    ice_maker = AsyncIceMaker(backend=backend, config=config)
+    ice_maker.config_watcher = ConfigWatcher(args.config, ice_maker.logger)
+    ice_maker.debug = config['debug']
+    if not args.sim:
+        # same files as mark_icemaker2, next to the config; a simulated machine keeps them in memory
+        data_dir = os.path.dirname(os.path.abspath(args.config))
+        ice_maker.telemetry.open(os.path.join(data_dir, 'telemetry.bin'))
+        ice_maker.checkpoint.open(os.path.join(data_dir, 'checkpoint.json'))
+        ice_maker.stats.open(os.path.join(data_dir, 'stats.json'))
+    ice_maker.logger.info('Powering On...')
+    try:
+        run(ice_maker.run(args.cycles, restart=config['warm_restart'] and not args.sim), ice_maker.backend)
+    except BaseException as error:
+        ice_maker.logger.warning('SYSTEM POWER OFF, TURNING OFF ALL RELAYS...')
+        ice_maker.power_off()
+        if not isinstance(error, KeyboardInterrupt):
+            ice_maker.logger.warning('An error occurred...' + repr(error))
+    finally:
+        ice_maker.telemetry.flush()
+        ice_maker.flush_stats()
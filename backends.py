@@ -0,0 +1,59 @@
+import os
+import time
+
+# Hardware backends for the ice maker controller.
+#
+# A backend bundles everything IceMaker touches outside the process:
+#   gpio           module-like object with the RPi.GPIO calls we use
+#   clock          object with monotonic() and sleep()
+#   temp_sensor()  binds a 1-Wire temperature sensor by name & ID, without a bus scan
+#   parallel_reads whether sensor reads block on real I/O and are worth threading
+#   virtual_time   whether the clock only advances when the controller sleeps
+#
+# The simulated backend lives in simulator.py.
+
+
+class W1Sensor():
+    # W1ThermSensor wrapper that always reads in the unit the controller works in (°F)
+    def __init__(self, sensor, unit):
+        self.sensor = sensor
+        self.unit = unit
+        self.id = sensor.id
+
+    def get_temperature(self):
+        return self.sensor.get_temperature(self.unit)
+
+
+class PiBackend():
+    parallel_reads = True
+    virtual_time = False
+
+    def __init__(self, sensor_type='DS18B20'):
+        # imported here so the controller can be loaded on machines without the Pi libraries
+        if os.path.isdir('/sys/bus/w1/devices'):
+            # the 1-Wire modules are already loaded, skip w1thermsensor's modprobe on import
+            os.environ.setdefault('W1THERMSENSOR_NO_KERNEL_MODULE', '1')
+        import RPi.GPIO as GPIO
+        from w1thermsensor import W1ThermSensor, Sensor, Unit
+        self.gpio = GPIO
+        self.clock = time
+        self.sensor_class = W1ThermSensor
+        # with the type given a sensor is bound straight from its ID, without
+        # one w1thermsensor scans the whole bus to find it
+        self.sensor_type = getattr(Sensor, sensor_type)
+        self.unit = Unit.DEGREES_F
+
+    def temp_sensor(self, name, sensor_id):
+        return W1Sensor(self.sensor_class(self.sensor_type, sensor_id), self.unit)
+
+    def available_sensors(self):
+        return [W1Sensor(sensor, self.unit) for sensor in self.sensor_class.get_available_sensors()]
+
+
+def get_backend(name='pi', **kwargs):
+    if name == 'pi':
+        return PiBackend(**kwargs)
+    if name == 'sim':
+        from simulator import SimBackend
+        return SimBackend(**kwargs)
+    raise ValueError(f'Unknown backend: {name}')
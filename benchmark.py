@@ -0,0 +1,144 @@
+import argparse
+import json
+import logging
+import platform
+import subprocess
+import sys
+import time
+
+from mark_icemaker2 import IceMaker
+from simulator import SimBackend
+
+# Control loop benchmark.
+#
+# Runs mark_icemaker2.IceMaker against the simulated backend and reports
+#   tick_latency_us     wall time from the start of a tick (sensor read) to its log_data
+#   tick_jitter_s       simulated time between tick starts minus the nominal MIN/12 cadence
+#   relay_latency_us    wall time of each relay batch (apply_relays call)
+#   cycles_per_sim_hour completed ice cycles per simulated hour
+# as JSON, so runs from different versions can be diffed or compared with --baseline.
+
+
+class BenchIceMaker(IceMaker):
+    def __init__(self, backend):
+        self.tick_start = None
+        self.tick_mode_start = None
+        self.last_tick_sim = None
+        self.tick_latencies = []
+        self.tick_intervals = []
+        self.relay_latencies = []
+        super().__init__(backend=backend)
+
+    def read_sensors(self):
+        now = self.clock.monotonic()
+        if self.tick_mode_start == self.mode_start_time and self.last_tick_sim is not None:
+            self.tick_intervals.append(now - self.last_tick_sim)
+        self.tick_mode_start = self.mode_start_time
+        self.last_tick_sim = now
+        self.tick_start = time.perf_counter()
+        return super().read_sensors()
+
+    def log_data(self):
+        # every phase loop ends its tick by logging, then sleeps
+        super().log_data()
+        if self.tick_start is not None:
+            self.tick_latencies.append(time.perf_counter() - self.tick_start)
+            self.tick_start = None
+
+    def apply_relays(self, settings, log=False):
+        start = time.perf_counter()
+        changed = super().apply_relays(settings, log)
+        self.relay_latencies.append(time.perf_counter() - start)
+        return changed
+
+
+def percentile(ordered, fraction):
+    # linear interpolation between closest ranks
+    if not ordered:
+        return None
+    position = (len(ordered) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarize(values, scale=1.0):
+    ordered = sorted(value * scale for value in values)
+    if not ordered:
+        return {'count': 0}
+    return {
+        'count': len(ordered),
+        'mean': sum(ordered) / len(ordered),
+        'p50': percentile(ordered, 0.50),
+        'p90': percentile(ordered, 0.90),
+        'p99': percentile(ordered, 0.99),
+        'max': ordered[-1],
+    }
+
+
+def git_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(cycles, conversion_time=0.0):
+    ice_maker = BenchIceMaker(SimBackend(IceMaker.relays, conversion_time=conversion_time))
+    # measure the controller, not the terminal
+    logging.getLogger().setLevel(logging.WARNING)
+    wait_time = ice_maker.MIN / 12
+    wall_start = time.perf_counter()
+    ice_maker.power_on()
+    for _ in range(cycles):
+        ice_maker.run_cycle()
+    wall_time = time.perf_counter() - wall_start
+    sim_hours = ice_maker.clock.monotonic() / 3600
+    return {
+        'version': git_version(),
+        'python': platform.python_version(),
+        'cycles': cycles,
+        'conversion_time_s': conversion_time,
+        'wall_time_s': wall_time,
+        'sim_hours': sim_hours,
+        'cycles_per_sim_hour': cycles / sim_hours,
+        'cycles_per_wall_second': cycles / wall_time,
+        'tick_latency_us': summarize(ice_maker.tick_latencies, 1e6),
+        'tick_jitter_s': summarize([interval - wait_time for interval in ice_maker.tick_intervals]),
+        'relay_latency_us': summarize(ice_maker.relay_latencies, 1e6),
+    }
+
+
+def compare(results, baseline):
+    # lower is better for every metric here except throughput
+    rows = [
+        ('tick_latency_us', 'p50'), ('tick_latency_us', 'p99'),
+        ('tick_jitter_s', 'p99'), ('relay_latency_us', 'p99'),
+    ]
+    for group, stat in rows:
+        old, new = baseline[group].get(stat), results[group].get(stat)
+        if old and new is not None:
+            print(f'{group}.{stat}: {old:.3f} -> {new:.3f} ({(new - old) / old * 100:+.1f}%)', file=sys.stderr)
+    old, new = baseline['cycles_per_sim_hour'], results['cycles_per_sim_hour']
+    print(f'cycles_per_sim_hour: {old:.3f} -> {new:.3f} ({(new - old) / old * 100:+.1f}%)', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark control loop latency, jitter and cycle throughput.')
+    parser.add_argument('--cycles', type=int, default=20)
+    parser.add_argument('--conversion-time', type=float, default=0.75,
+                        help='simulated seconds each 1-Wire read blocks for')
+    parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    results = run(args.cycles, args.conversion_time)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
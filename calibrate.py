@@ -0,0 +1,169 @@
+import argparse
+import json
+import math
+import sys
+
+import logs
+
+# Thermal model calibration from recorded history.
+#
+# Over a short step every sensor follows first order dynamics,
+#   dT/dt = k * (equilibrium - T)
+# with its own k and equilibrium for every mode (relays on/off).  Each pair of
+# consecutive ticks in the same phase gives
+#   dT = (a + b * T_mid) * dt,   k = -b, equilibrium = a / k
+# and the fit is linear least squares in (a, b).  The records are read in
+# chunks of NumPy columns (see logs.py) and only the normal equation sums are
+# kept per mode, so weeks of text logs or telemetry stream through in constant
+# memory and the result doesn't depend on the chunk size.
+#
+# The plate coefficients of the standard recipe's modes are turned into
+# simulator.ThermalModel parameters (CHILL: compressors and fan, HEAT: hot
+# gas), with the plate's own ambient leak taken from the base parameters since
+# nothing is logged while idle.  The model file keeps every per-mode fit next
+# to those parameters:
+#
+#   python calibrate.py telemetry.bin --output model.json
+#   python sweep.py --model model.json --set ice_target_temp=-4:0:1
+#
+# Pairs where the plate is around freezing are left out: water freezing on it
+# or ice melting off it holds the temperature, which no rate constant
+# describes.
+
+CHANNELS = ('plate', 'bin')
+# sums per mode: pairs, then the normal equations dt², dt² T, dt² T², dt dT, dt T dT, dT²
+SUMS = 7
+
+
+class Calibration():
+    def __init__(self, max_gap=30.0, melt_band=(30.0, 36.0)):
+        import numpy
+        self.numpy = numpy
+        # ticks further apart than this (seconds) don't make a pair
+        self.max_gap = max_gap
+        self.melt_band = melt_band
+        self.modes = []
+        self.sums = {channel: numpy.zeros((0, SUMS)) for channel in CHANNELS}
+        self.ticks = 0
+        # last row of the previous chunk, paired with the first row of the next
+        self.tail = None
+
+    def add(self, columns, modes):
+        numpy = self.numpy
+        self.modes = modes
+        self.ticks += len(columns['timestamp'])
+        if self.tail is not None:
+            columns = {name: numpy.concatenate((self.tail[name], values)) for name, values in columns.items()}
+        self.tail = {name: values[-1:] for name, values in columns.items()}
+        if not len(columns['timestamp']):
+            return
+        mode = columns['mode']
+        # steps on the controller's own clock; same phase means same mode with
+        # the time in mode still counting up
+        dt = columns['time_in_mode'][1:] - columns['time_in_mode'][:-1]
+        paired = (mode[1:] == mode[:-1]) & (dt > 0) & (dt <= self.max_gap)
+        for channel in CHANNELS:
+            temp = columns[channel]
+            valid = paired & numpy.isfinite(temp[1:]) & numpy.isfinite(temp[:-1])
+            if channel == 'plate':
+                low, high = self.melt_band
+                valid &= ~(((temp[1:] >= low) & (temp[1:] <= high)) | ((temp[:-1] >= low) & (temp[:-1] <= high)))
+            step = dt[valid]
+            mid = (temp[1:][valid] + temp[:-1][valid]) / 2
+            change = temp[1:][valid] - temp[:-1][valid]
+            terms = (numpy.ones_like(step), step * step, step * step * mid, step * step * mid * mid,
+                     step * change, step * mid * change, change * change)
+            codes = mode[1:][valid]
+            count = max(len(modes), len(self.sums[channel]))
+            sums = numpy.zeros((count, SUMS))
+            sums[:len(self.sums[channel])] = self.sums[channel]
+            for i, term in enumerate(terms):
+                sums[:, i] += numpy.bincount(codes, weights=term, minlength=count)
+            self.sums[channel] = sums
+
+    def fits(self, channel, min_samples=50):
+        # {mode: {k, equilibrium, samples, rmse}} for every mode with enough pairs
+        result = {}
+        for code, mode in enumerate(self.modes):
+            if code >= len(self.sums[channel]) or self.sums[channel][code][0] < min_samples:
+                continue
+            samples, s11, s12, s22, s1y, s2y, syy = self.sums[channel][code]
+            det = s11 * s22 - s12 * s12
+            if det <= 1e-12 * s11 * s22:
+                # temperature barely moved, nothing to fit
+                continue
+            a = (s1y * s22 - s2y * s12) / det
+            b = (s2y * s11 - s1y * s12) / det
+            residual = max(0.0, syy - 2 * (a * s1y + b * s2y) + a * a * s11 + 2 * a * b * s12 + b * b * s22)
+            k = float(-b)
+            result[mode] = {
+                'k': k,
+                'equilibrium': float(a) / k if k > 0 else None,
+                'samples': int(samples),
+                # °F per tick
+                'rmse': math.sqrt(residual / samples),
+            }
+        return result
+
+
+def model_params(plate, base):
+    # ThermalModel parameters from the plate's per-mode fits; a mode's
+    # coefficient is what's left after the ambient leak
+    params = {}
+    k_ambient = base['k_plate_ambient']
+    ambient = base['ambient_temp']
+    for mode, rate, target in (('CHILL', 'k_cool', 'evaporator_temp'), ('HEAT', 'k_hot', 'hot_gas_temp')):
+        fit = plate.get(mode)
+        if fit is None or fit['equilibrium'] is None or fit['k'] <= k_ambient:
+            continue
+        k = fit['k'] - k_ambient
+        params[rate] = k
+        params[target] = (fit['equilibrium'] * fit['k'] - ambient * k_ambient) / k
+    return params
+
+
+def calibrate(paths, base=None, chunk=1 << 18, max_gap=30.0, melt_band=(30.0, 36.0), min_samples=50):
+    from simulator import DEFAULT_PARAMS
+    calibration = Calibration(max_gap, melt_band)
+    for columns, modes in logs.iter_chunks(paths, chunk):
+        calibration.add(columns, modes)
+    if not calibration.ticks:
+        raise ValueError('No tick records found')
+    base = dict(DEFAULT_PARAMS, **(base or {}))
+    fits = {channel: calibration.fits(channel, min_samples) for channel in CHANNELS}
+    return {
+        'ticks': calibration.ticks,
+        'plate': fits['plate'],
+        'bin': fits['bin'],
+        'params': model_params(fits['plate'], base),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fit thermal model coefficients from recorded history.')
+    parser.add_argument('paths', nargs='+', help='text logs and/or telemetry files, oldest first')
+    parser.add_argument('--base', help='JSON of ThermalModel parameters to take the ambient terms from')
+    parser.add_argument('--max-gap', type=float, default=30, help='longest tick gap (seconds) still paired')
+    parser.add_argument('--melt-band', default='30:36', help='plate range (°F) left out of the fit, low:high')
+    parser.add_argument('--min-samples', type=int, default=50, help='pairs a mode needs to get a fit')
+    parser.add_argument('--output', help='write the model here instead of stdout')
+    args = parser.parse_args()
+
+    base = None
+    if args.base:
+        from simulator import load_params
+        base = load_params(args.base)
+    low, _, high = args.melt_band.partition(':')
+    model = calibrate(args.paths, base, max_gap=args.max_gap, melt_band=(float(low), float(high)),
+                      min_samples=args.min_samples)
+    for channel in CHANNELS:
+        for mode, fit in model[channel].items():
+            equilibrium = 'none' if fit['equilibrium'] is None else f'{fit["equilibrium"]:.1f} °F'
+            print(f'{channel:5} {mode:6} k {fit["k"]:.6f}/s  equilibrium {equilibrium}  '
+                  f'{fit["samples"]} pairs  rmse {fit["rmse"]:.3f} °F', file=sys.stderr)
+    text = json.dumps(model, indent=4)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
@@ -0,0 +1,89 @@
+import json
+import logging
+
+from stats import write_atomic
+
+# Crash-safe checkpoint of where the controller is in its cycle.
+#
+# The phase, when it and the cycle started, which relays are on and when each
+# last switched are written to a small JSON file (atomically, fsynced) at
+# every phase boundary, at the end of each cycle, on idle relay changes and on
+# power off.  On startup restart_plan() reconciles the checkpoint with the
+# live plate temperature:
+#   - no checkpoint, or the machine has been stopped longer than
+#     restart_max_age minutes: cold start, power on sequence and a new cycle
+#   - stopped between cycles: skip the power on sequence, check the bin first
+#   - stopped mid cycle: skip the power on sequence and resume the phase with
+#     the time already spent in it, so timeouts still hold; an ice phase whose
+#     plate has warmed past freezing goes straight on to harvest, the slab is
+#     already coming loose
+# Times are wall clock, since monotonic time starts over with the process.
+# The relay switch times carry over too, so the compressors still get their
+# minimum off time across the restart.  A checkpoint that can't be written is
+# logged and skipped, the next one tries again.
+
+VERSION = 1
+FREEZING = 32.0
+
+
+class Checkpoint():
+    def __init__(self, path=None, logger=None):
+        self.path = path
+        self.logger = logger or logging.getLogger()
+        self.state = None
+
+    def open(self, path):
+        # persist to path from now on; load() reads what's there
+        self.path = path
+
+    def load(self):
+        # the last checkpoint, None if there is none or it can't be read
+        if self.path is None:
+            return None
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(state, dict) or state.get('version') != VERSION:
+            return None
+        self.state = state
+        return state
+
+    def save(self, state):
+        self.state = dict(state, version=VERSION)
+        if self.path is None:
+            return
+        try:
+            write_atomic(self.path, json.dumps(self.state).encode())
+        except OSError as error:
+            # a missed checkpoint only makes a restart less accurate, stopping would cost the cycle
+            self.logger.error(f'Could not write {self.path}: {error}')
+
+
+def restart_plan(state, now, read_plate, recipe, max_age):
+    # (run the power on sequence, (phase, seconds into it, seconds into the cycle) or None, reason);
+    # read_plate() is only called when the answer depends on the plate, so a
+    # cold start doesn't wait for a sensor conversion
+    if state is None:
+        return True, None, 'no checkpoint'
+    stopped = state.get('stopped_at') or state['saved_at']
+    down = now - stopped
+    if down > max_age or down < 0:
+        return True, None, f'stopped {down / 60:.0f} minutes ago'
+    phase = state.get('phase')
+    if phase is None:
+        return False, None, f'stopped between cycles {down:.0f} s ago'
+    if phase not in recipe.names:
+        return False, None, f'phase {phase} is no longer in the recipe'
+    index = recipe.names.index(phase)
+    in_phase = max(0.0, stopped - state['phase_start'])
+    in_cycle = max(0.0, stopped - state['cycle_start'])
+    plate_temp = read_plate() if recipe.modes[index] == 'ICE' else None
+    if plate_temp is not None and plate_temp > FREEZING:
+        following = recipe.transitions[index][-1][3]
+        if following < 0:
+            return False, None, f'{phase} warmed to {plate_temp:.1f} °F, starting over'
+        return False, (recipe.names[following], 0.0, in_cycle), \
+            f'{phase} warmed to {plate_temp:.1f} °F, harvesting what is on the plate'
+    return False, (phase, in_phase, in_cycle), f'resuming {phase} at {in_phase / 60:.1f} min'
@@ -0,0 +1,132 @@
+import math
+from collections import deque
+
+# Online fit of the plate cooling curve during ice making.
+#
+# With the compressors on, the plate relaxes toward an equilibrium temperature
+# like a first order system, dT/dt = (T_eq - T) / tau.  While ice builds up it
+# insulates the plate from the recirculating water, so the equilibrium itself
+# keeps sinking; over a few minutes that drift is close enough to linear:
+#   dT/dt = a + b*T + c*t       tau = -1/b,  T_eq(t) = -(a + c*t) / b
+# Each pair of successive (decimated) samples gives one (t, T, dT/dt) point,
+# and a least squares plane through the points in a sliding window gives the
+# three coefficients with a 3x3 solve, no iteration.  The fitted curve is then
+# stepped forward to find when the plate will reach the target.
+
+
+def _solve3(a, b):
+    # gaussian elimination with partial pivoting; None if singular
+    m = [row[:] + [value] for row, value in zip(a, b)]
+    for i in range(3):
+        pivot = max(range(i, 3), key=lambda r: abs(m[r][i]))
+        m[i], m[pivot] = m[pivot], m[i]
+        if abs(m[i][i]) < 1e-12:
+            return None
+        for r in range(3):
+            if r != i:
+                f = m[r][i] / m[i][i]
+                for c in range(i, 4):
+                    m[r][c] -= f * m[i][c]
+    return [m[i][3] / m[i][i] for i in range(3)]
+
+
+class CoolingCurve():
+    # target:  plate temperature the phase is waiting for
+    # step:    seconds between the samples used for the fit; the sensor's 0.1 °F
+    #          resolution swamps the derivative over shorter spans
+    # window:  seconds of fit points kept
+    # min_fit: seconds of fit points needed before predicting
+    # settle:  seconds into the phase before predictions count; the first
+    #          minutes of pull down say little about where the plate ends up
+    # confirm: number of successive fits a prediction has to hold for
+    # horizon: seconds to look ahead; further than that counts as never
+    def __init__(self, target, step=15, window=8*60, min_fit=2*60, settle=10*60, confirm=8,
+                 horizon=60*60):
+        self.target = target
+        self.step = step
+        self.window = window
+        self.min_fit = min_fit
+        self.settle = settle
+        self.horizon = horizon
+        self.last = None
+        self.points = deque()
+        self.fit = None
+        self.ends = deque(maxlen=confirm)
+
+    def update(self, t, temp):
+        # add a plate sample taken t seconds into the phase
+        if self.last is None:
+            self.last = (t, temp)
+            return
+        last_t, last_temp = self.last
+        if t - last_t < self.step:
+            return
+        self.last = (t, temp)
+        self.points.append(((t + last_t) / 2, (temp + last_temp) / 2, (temp - last_temp) / (t - last_t)))
+        while self.points[0][0] < t - self.window:
+            self.points.popleft()
+        self._fit()
+        if t >= self.settle:
+            self.ends.append(self._predict())
+
+    def _fit(self):
+        self.fit = None
+        if len(self.points) < 4 or self.points[-1][0] - self.points[0][0] < self.min_fit:
+            return
+        t0 = self.points[-1][0]
+        rows = [((1.0, temp, t - t0), slope) for t, temp, slope in self.points]
+        a = [[sum(x[i] * x[j] for x, _ in rows) for j in range(3)] for i in range(3)]
+        b = [sum(x[i] * y for x, y in rows) for i in range(3)]
+        solution = _solve3(a, b)
+        if solution is None or solution[1] >= 0:
+            # not settling toward anything (e.g. still on the freezing plateau)
+            return
+        c0, c1, c2 = solution
+        k = -c1
+        # equilibrium line T_eq = eq + drift * (t - t0)
+        self.fit = (k, c0 / k, c2 / k, t0)
+
+    def _predict(self):
+        # seconds into the phase when the fitted curve reaches target, inf if it
+        # doesn't within the horizon, None without a fit
+        if self.fit is None:
+            return None
+        k, eq, drift, t0 = self.fit
+        t, temp = self.last
+        # the solution of dT/dt = k*(T_eq(t) - T) for a linear T_eq
+        offset = temp - (eq + drift * (t - t0) - drift / k)
+
+        def above(at):
+            return eq + drift * (at - t0) - drift / k + offset * math.exp(-k * (at - t)) - self.target
+
+        if above(t) <= 0:
+            return t
+        low = t
+        while True:
+            high = low + self.step
+            if high - t > self.horizon:
+                return math.inf
+            if above(high) <= 0:
+                break
+            low = high
+        for _ in range(20):
+            middle = (low + high) / 2
+            if above(middle) <= 0:
+                high = middle
+            else:
+                low = middle
+        return high
+
+    @property
+    def predicted_end(self):
+        # seconds into the phase the plate will reach target (inf: never), once
+        # the last `confirm` fits all had a prediction; the earliest of them, so
+        # a cycle is only written off when every recent fit agrees
+        if len(self.ends) < self.ends.maxlen or None in self.ends:
+            return None
+        return min(self.ends)
+
+    def unreachable(self, timeout):
+        # True once the target is confidently out of reach within timeout seconds
+        end = self.predicted_end
+        return end is not None and end > timeout
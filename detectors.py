@@ -0,0 +1,60 @@
+from collections import deque
+
+
+def slope(samples):
+    # least squares slope of [(t, value), ...] in value units per second
+    n = len(samples)
+    if n < 2:
+        return 0.0
+    mean_t = sum(t for t, _ in samples) / n
+    mean_v = sum(v for _, v in samples) / n
+    var = sum((t - mean_t) ** 2 for t, _ in samples)
+    if var == 0:
+        return 0.0
+    return sum((t - mean_t) * (v - mean_v) for t, v in samples) / var
+
+
+class ReleaseDetector():
+    # Spots the moment the ice slab lets go of the plate during harvest.
+    #
+    # While hot gas melts the slab's contact face the plate sits on a plateau
+    # just above freezing, because the heat goes into melting ice.  Once the
+    # slab slides off there is nothing left to melt and the plate temperature
+    # jumps.  So: a rolling dT/dt over the last `window` seconds, wait for a
+    # plateau (|slope| <= plateau_slope °F/min inside plateau_temps) lasting at
+    # least min_plateau seconds, then call it released as soon as the slope
+    # climbs past release_slope °F/min.  Latches once released.
+
+    def __init__(self, window=30, release_slope=4.0, plateau_slope=1.0, min_plateau=30,
+                 plateau_temps=(28.0, 40.0)):
+        self.window = window
+        self.release_slope = release_slope
+        self.plateau_slope = plateau_slope
+        self.min_plateau = min_plateau
+        self.plateau_temps = plateau_temps
+        self.samples = deque()
+        self.slope = 0.0
+        self.plateau_start = None
+        self.had_plateau = False
+        self.released = False
+
+    def update(self, t, temp):
+        # add a plate sample; returns True once the release has been seen
+        self.samples.append((t, temp))
+        while self.samples[0][0] < t - self.window:
+            self.samples.popleft()
+        # °F per minute
+        self.slope = slope(self.samples) * 60
+        if self.released or len(self.samples) < 3:
+            return self.released
+        low, high = self.plateau_temps
+        if abs(self.slope) <= self.plateau_slope and low <= temp <= high:
+            if self.plateau_start is None:
+                self.plateau_start = t
+            if t - self.plateau_start >= self.min_plateau:
+                self.had_plateau = True
+        else:
+            self.plateau_start = None
+        if self.had_plateau and self.slope >= self.release_slope:
+            self.released = True
+        return self.released
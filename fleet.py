@@ -0,0 +1,196 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+
+from async_icemaker import AsyncIceMaker, run
+from logsetup import DATE_FORMAT, LOG_FORMAT, add_handler, setup_logging
+from mark_icemaker2 import IceMaker
+from status import StatusServer
+
+# Fleet supervisor: several ice machines from one process.
+#
+# Every unit is an AsyncIceMaker with its own relay pins, sensor IDs, config,
+# log file, telemetry and stats, and all of them run as tasks on one event
+# loop, so a unit costs a few hundred kB rather than a whole interpreter.
+# Interlock waits and idle restarts are awaited (see
+# AsyncIceMaker.apply_relays_async), so no unit holds up the others.  A unit
+# that fails is switched off and the rest carry on.  One status server
+# publishes every unit with a unit="<name>" label, and a fleet summary is
+# logged every 15 minutes.
+#
+# fleet.json:
+#   {
+#       "status_port": 8080,
+#       "status_host": "127.0.0.1",
+#       "data_dir": "fleet",
+#       "units": [
+#           {"name": "left", "config": "left.json",
+#            "relays": {"compressor_1": 24, ...}, "sensor_ids": {"plate": "...", "bin": "..."}},
+#           {"name": "spare", "sim": true}
+#       ]
+#   }
+#
+# "config" is a file (relative to fleet.json) or the settings themselves;
+# relays and sensor_ids default to IceMaker's.  "sim" runs the unit on the
+# simulator, true or a dict of ThermalModel parameters.  Simulated units share
+# one virtual clock and can't be mixed with real ones.  Each unit writes
+# <name>.log, <name>.telemetry.bin and <name>.stats.json to data_dir, which
+# analytics.py and calibrate.py read as they are.
+#
+# Units keep no checkpoint: after a restart every unit cold starts with the
+# power on sequence and a new cycle, and warm_restart in a unit's config has
+# no effect here (see checkpoint.py for the single machine controllers).
+#
+#   python fleet.py fleet.json
+#   python fleet.py --sim 24 --cycles 5
+
+# a day of ticks in memory per unit, the files keep the rest
+UNIT_DEFAULTS = {'telemetry_buffer_days': 1}
+# seconds between status snapshots, and snapshots between summaries
+PUBLISH_PERIOD = 5
+SUMMARY_EVERY = 180
+
+
+class Fleet():
+    def __init__(self, spec, base_dir='.', logger=None):
+        self.logger = logger or logging.getLogger('fleet')
+        self.data_dir = os.path.join(base_dir, spec.get('data_dir', 'fleet'))
+        self.status_port = spec.get('status_port', 8080)
+        # the status server has no authentication, see recipe.DEFAULT_CONFIG
+        self.status_host = spec.get('status_host', '127.0.0.1')
+        self.status = None
+        units = spec['units']
+        names = [unit['name'] for unit in units]
+        if len(set(names)) != len(names):
+            raise ValueError('Unit names must be unique')
+        simulated = {bool(unit.get('sim')) for unit in units}
+        if len(simulated) > 1:
+            raise ValueError('Simulated and real units can\'t share an event loop')
+        self.clock = None
+        if simulated == {True}:
+            from simulator import SimClock
+            self.clock = SimClock()
+        os.makedirs(self.data_dir, exist_ok=True)
+        self.units = {unit['name']: self.build(unit, base_dir) for unit in units}
+        if simulated == {False}:
+            self.check_wiring()
+
+    def build(self, unit, base_dir):
+        name = unit['name']
+        config = dict(UNIT_DEFAULTS)
+        if isinstance(unit.get('config'), str):
+            with open(os.path.join(base_dir, unit['config'])) as f:
+                config.update(json.load(f))
+        else:
+            config.update(unit.get('config') or {})
+        relays = dict(IceMaker.relays, **unit.get('relays', {}))
+        sensor_ids = dict(IceMaker.sensor_ids, **unit.get('sensor_ids', {}))
+        backend = None
+        if unit.get('sim'):
+            from simulator import SimBackend
+            params = unit['sim'] if isinstance(unit['sim'], dict) else None
+            backend = SimBackend(relays, params, clock=self.clock)
+        # the unit's own log file in the usual format, written by the log
+        # thread, and the fleet console with the unit name
+        logger = logging.getLogger(f'fleet.{name}')
+        handler = logging.FileHandler(os.path.join(self.data_dir, f'{name}.log'))
+        handler.setFormatter(logging.Formatter(LOG_FORMAT, DATE_FORMAT))
+        add_handler(handler, logger)
+        ice_maker = AsyncIceMaker(backend=backend, config=config, relays=relays, sensor_ids=sensor_ids, logger=logger)
+        ice_maker.debug = ice_maker.config['debug']
+        ice_maker.telemetry.open(os.path.join(self.data_dir, f'{name}.telemetry.bin'))
+        ice_maker.stats.open(os.path.join(self.data_dir, f'{name}.stats.json'))
+        return ice_maker
+
+    def check_wiring(self):
+        # units on one Pi mustn't share a pin or a sensor
+        seen = {}
+        for name, ice_maker in self.units.items():
+            for kind, values in (('pin', ice_maker.relays.values()), ('sensor', ice_maker.sensor_ids.values())):
+                for value in values:
+                    other = seen.setdefault((kind, value), name)
+                    if other != name:
+                        raise ValueError(f'Units {other} and {name} both use {kind} {value}')
+
+    def summary(self):
+        modes = {}
+        for ice_maker in self.units.values():
+            modes[ice_maker.mode] = modes.get(ice_maker.mode, 0) + 1
+        cycles = sum(ice_maker.cycle_count for ice_maker in self.units.values())
+        return (f'{len(self.units)} units (' + ', '.join(f'{count} {mode}' for mode, count in sorted(modes.items()))
+                + f'), {cycles} cycles')
+
+    async def publish(self):
+        count = 0
+        while True:
+            if self.status is not None:
+                self.status.publish_units(list(self.units.items()))
+            count += 1
+            if count % SUMMARY_EVERY == 0:
+                self.logger.info(f'Fleet: {self.summary()}')
+            await asyncio.sleep(PUBLISH_PERIOD)
+
+    async def supervise(self, name, ice_maker, cycles):
+        ice_maker.logger.info('Powering On...')
+        try:
+            await ice_maker.run(cycles)
+        except Exception as error:
+            ice_maker.power_off()
+            ice_maker.logger.error(f'Unit {name} stopped, all relays off: {error!r}')
+
+    async def control(self, cycles=None):
+        publisher = asyncio.ensure_future(self.publish())
+        try:
+            await asyncio.gather(*(self.supervise(name, ice_maker, cycles) for name, ice_maker in self.units.items()))
+        finally:
+            publisher.cancel()
+            await asyncio.gather(publisher, return_exceptions=True)
+
+    def run(self, cycles=None):
+        if self.status_port:
+            try:
+                self.status = StatusServer(self.status_port, self.status_host)
+                self.status.start()
+            except OSError as error:
+                self.status = None
+                self.logger.error(f'Status server not started on {self.status_host}:{self.status_port}: {error}')
+        try:
+            run(self.control(cycles), next(iter(self.units.values())).backend)
+        finally:
+            for ice_maker in self.units.values():
+                ice_maker.power_off()
+                ice_maker.telemetry.flush()
+                ice_maker.flush_stats()
+            if self.status is not None:
+                self.status.stop()
+
+
+def simulated_fleet(count):
+    return {'data_dir': 'fleet-sim', 'status_port': 0,
+            'units': [{'name': f'sim{i + 1}', 'sim': True} for i in range(count)]}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run several ice machines from one process.')
+    parser.add_argument('fleet', nargs='?', help='fleet JSON file')
+    parser.add_argument('--sim', type=int, metavar='N', help='run N simulated units instead of a fleet file')
+    parser.add_argument('--cycles', type=int, help='stop every unit after this many cycles')
+    args = parser.parse_args()
+    if (args.fleet is None) == (args.sim is None):
+        parser.error('give a fleet file or --sim N')
+
+    setup_logging(logging.INFO, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+    if args.sim:
+        fleet = Fleet(simulated_fleet(args.sim))
+    else:
+        with open(args.fleet) as f:
+            spec = json.load(f)
+        fleet = Fleet(spec, os.path.dirname(os.path.abspath(args.fleet)))
+    try:
+        fleet.run(args.cycles)
+    except KeyboardInterrupt:
+        fleet.logger.warning('SYSTEM POWER OFF, TURNING OFF ALL RELAYS...')
+    fleet.logger.info(f'Fleet: {fleet.summary()}, peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB')
@@ -1,11 +1,12 @@
 import RPi.GPIO as GPIO
-import adafruit_dht
 import time
-import datetime
-import board
 import logging
+import os
 import sys
-from w1thermsensor import W1ThermSensor, Unit
+# the 1-Wire modules are already loaded if the bus is up, skip w1thermsensor's modprobe on import
+if os.path.isdir('/sys/bus/w1/devices'):
+    os.environ.setdefault('W1THERMSENSOR_NO_KERNEL_MODULE', '1')
+from w1thermsensor import W1ThermSensor, Sensor, Unit
 
 # 0 indicates active relay
 # 1 indicates inactive relay
@@ -83,8 +84,9 @@ class IceMaker():
         # Setup 1-Wire temp sensors
         self.ice_bin_temp_sensor_id = "3c01f0956abd"
         self.plate_temp_sensor_id = "092101487373"
-        self.ice_bin_temp_sensor = W1ThermSensor(sensor_id=self.ice_bin_temp_sensor_id)
-        self.plate_temp_sensor = W1ThermSensor(sensor_id=self.plate_temp_sensor_id)
+        # bound by type & ID, without the type an ID lookup scans the whole bus
+        self.ice_bin_temp_sensor = W1ThermSensor(Sensor.DS18B20, self.ice_bin_temp_sensor_id)
+        self.plate_temp_sensor = W1ThermSensor(Sensor.DS18B20, self.plate_temp_sensor_id)
 
     def sensor_check(self):
         try:
@@ -278,14 +280,14 @@ if __name__ == '__main__':
         time.sleep(test_time)
         ice_maker.relay_off('compressor_1', True)
         ice_maker.relay_off('compressor_2', True)
+        # every sensor on the bus, handy for finding IDs but too slow for every boot
+        try:
+            for sensor in W1ThermSensor.get_available_sensors():
+                ice_maker.logger.info("Sensor %s has temperature %.2f deg C" % (sensor.id, sensor.get_temperature()))
+                ice_maker.logger.info("Sensor %s has temperature %.2f deg F" % (sensor.id, sensor.get_temperature(Unit.DEGREES_F)))
+        except:
+            ice_maker.logger.error('Error reading temperature sensor on startup.')
     # -----------------------------       
-    
-    try:
-        for sensor in W1ThermSensor.get_available_sensors():
-            ice_maker.logger.info("Sensor %s has temperature %.2f deg C" % (sensor.id, sensor.get_temperature()))
-            ice_maker.logger.info("Sensor %s has temperature %.2f deg F" % (sensor.id, sensor.get_temperature(Unit.DEGREES_F)))
-    except:
-        ice_maker.logger.error('Error reading temperature sensor on startup.')
             
     ice_maker.logger.info('Powering On...')
     try:
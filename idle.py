@@ -0,0 +1,73 @@
+from collections import deque
+
+from detectors import slope
+
+# Compressor control while the bin is full.
+#
+# Restarting from a warm plate costs a long prechill, but keeping the
+# compressors running through an hour of idling wastes far more.  So the
+# controller follows the bin temperature trend and estimates when the bin will
+# stop reading full, and:
+#   - keeps the compressors running (standby) while that is less than
+#     idle_standby_time minutes away,
+#   - starts them again that long before it, so the next cycle begins with a
+#     cold plate,
+#   - otherwise shuts them down,
+# without going over max_compressor_starts_per_hour.  When the start budget is
+# used up a running compressor is kept running rather than stopped, as long as
+# the bin is still heading for a restart.  A bin below min_bin_temp, or
+# max_time_after_cycle_finish minutes without a cycle, always stops it.
+
+
+class IdleController():
+    def __init__(self, ice_maker):
+        self.ice_maker = ice_maker
+        self.samples = deque()
+        self.eta = float('inf')
+        # when the compressors were last started ahead of a restart
+        self.prestart = float('-inf')
+
+    def update(self, now, bin_temp):
+        # add a bin reading; returns seconds until the bin stops reading full, inf if not warming
+        im = self.ice_maker
+        self.samples.append((now, bin_temp))
+        while self.samples[0][0] < now - im.config['idle_trend_window'] * im.MIN:
+            self.samples.popleft()
+        rate = slope(self.samples)
+        gap = im.config['bin_full_temp'] - bin_temp
+        if gap <= 0:
+            self.eta = 0.0
+        elif len(self.samples) < 3 or rate <= 0:
+            self.eta = float('inf')
+        else:
+            self.eta = gap / rate
+        return self.eta
+
+    def starts_left(self, now):
+        im = self.ice_maker
+        recent = sum(1 for start in im.relay_usage.starts if start > now - 60 * im.MIN)
+        return im.config['max_compressor_starts_per_hour'] - recent
+
+    def decide(self, now, bin_temp, running):
+        # (compressors should run, reason)
+        im = self.ice_maker
+        eta = self.update(now, bin_temp)
+        standby = im.config['idle_standby_time'] * im.MIN
+        # the guards stop the compressors whatever the start budget says
+        if running and now > max(im.cycle_finish_time, self.prestart) + im.config['max_time_after_cycle_finish'] * im.MIN:
+            return False, f'{im.config["max_time_after_cycle_finish"]} minutes passed since the last cycle'
+        if bin_temp < im.config['min_bin_temp']:
+            # solidly full, a warming trend this early is noise
+            if running:
+                return False, f'Bin Temp is below {im.config["min_bin_temp"]} °F ({bin_temp:.02f} °F)'
+            return False, None
+        if running:
+            if eta <= standby:
+                return True, None
+            if self.starts_left(now) <= 0 and eta != float('inf'):
+                return True, None
+            return False, f'no restart expected for {eta / im.MIN:.0f} minutes'
+        if eta <= standby and self.starts_left(now) > 0:
+            self.prestart = now
+            return True, f'restart expected in {eta / im.MIN:.1f} minutes, chilling the plate ahead of it'
+        return False, None
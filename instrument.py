@@ -0,0 +1,258 @@
+import io
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+from stats import write_atomic
+
+# Built-in instrumentation.
+#
+# Timers add up the wall time spent in each part of the control loop:
+#   sensor_read  1-Wire conversions, on the sampler thread
+#   sensor_wait  control thread waiting for a sensor snapshot
+#   gpio         relay pin writes
+#   sleep        scheduler sleeping between ticks and tasks
+#   tick         a whole phase loop tick, sensor snapshot to log_data
+# and the log pipeline keeps two more (logsetup.pipeline_stats()):
+#   log_enqueue  handing log records to the queue, on the calling threads
+#   log_write    formatting and writing them, on the log thread
+# Each timer keeps a count, total, max and a histogram of powers of two
+# microseconds.  It has one writer thread, so there are no locks on the hot
+# path; a reader may see a count and total a call apart.  log_enqueue has
+# many writers, so it is one Timer per logging thread, merged when read.
+#
+# Phase durations go in per phase histograms across cycles, 'idle' being the
+# time between cycles.
+#
+# A running controller can be profiled without a restart (see Profiler):
+#   kill -USR1 <pid>   start profiling, and again to stop and write the result
+#   kill -USR2 <pid>   write instrumentation.json
+# instrumentation.json is also written on exit, and the timers and phase
+# histograms are on the status endpoint.
+
+# histogram buckets: timers up to 2^26 µs (about a minute), phases per 30 s up to an hour
+TIMER_BUCKETS = 27
+PHASE_BUCKET = 30
+PHASE_BUCKETS = 120
+# phase durations kept for percentiles
+PHASE_HISTORY = 1000
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else None
+
+
+class Timer():
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * TIMER_BUCKETS
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        # bucket i holds durations under 2^i µs
+        self.buckets[min(int(seconds * 1e6).bit_length(), TIMER_BUCKETS - 1)] += 1
+
+    def merge(self, other):
+        # add other's calls to this timer
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+    def export(self):
+        return {
+            'count': self.count,
+            'total_s': self.total,
+            'mean_us': self.total / self.count * 1e6 if self.count else None,
+            'max_us': self.max * 1e6,
+            'buckets_us': {f'<{1 << i}': count for i, count in enumerate(self.buckets) if count},
+        }
+
+
+class PhaseHistogram():
+    def __init__(self):
+        self.buckets = [0] * (PHASE_BUCKETS + 1)
+        self.count = 0
+        self.total = 0.0
+        self.recent = deque(maxlen=PHASE_HISTORY)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.buckets[min(int(seconds // PHASE_BUCKET), PHASE_BUCKETS)] += 1
+        self.recent.append(seconds)
+
+    def cumulative(self):
+        # [(upper bound in seconds, count at or below it), ...] for the buckets
+        # in use; count covers the rest
+        result = []
+        running = 0
+        for i, count in enumerate(self.buckets[:-1]):
+            running += count
+            if count:
+                result.append(((i + 1) * PHASE_BUCKET, running))
+        return result
+
+    def export(self):
+        ordered = sorted(self.recent)
+        return {
+            'count': self.count,
+            'mean_s': self.total / self.count if self.count else None,
+            'p50_s': percentile(ordered, 0.5),
+            'p90_s': percentile(ordered, 0.9),
+            'max_s': ordered[-1] if ordered else None,
+            'buckets_s': {f'<{(i + 1) * PHASE_BUCKET}' if i < PHASE_BUCKETS else 'more': count
+                          for i, count in enumerate(self.buckets) if count},
+        }
+
+
+class Instruments():
+    def __init__(self, clock=time):
+        self.clock = clock
+        self.timers = {}
+        self.phases = {}
+        # (phase, monotonic start) of the phase running now
+        self.current = None
+        self.started = time.time()
+
+    def timer(self, name):
+        # the Timer for one part of the loop, for its one writer to add() to
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = Timer()
+        return timer
+
+    def phase_started(self, name, start=None):
+        now = self.clock.monotonic()
+        self.phase_ended(now)
+        self.current = (name, now if start is None else start)
+
+    def phase_ended(self, now=None):
+        if self.current is None:
+            return
+        name, start = self.current
+        now = self.clock.monotonic() if now is None else now
+        self.phases.setdefault(name, PhaseHistogram()).add(now - start)
+        self.current = None
+
+    def export(self, extra=None):
+        result = {
+            'started': self.started,
+            'exported': time.time(),
+            'cpu_s': time.process_time(),
+            'timers': {name: timer.export() for name, timer in self.timers.items()},
+            'phases': {name: phase.export() for name, phase in self.phases.items()},
+        }
+        result.update(extra or {})
+        return result
+
+    def write(self, path, extra=None):
+        write_atomic(path, (json.dumps(self.export(extra), indent=1) + '\n').encode())
+
+
+class Profiler():
+    # Toggled profile of the running controller, written to directory when it
+    # stops.
+    #   cprofile  deterministic, every call in the control (main) thread; a
+    #             .prof file for pstats/snakeviz, and the top functions logged
+    #   sample    the stack of every thread every interval seconds, so sensor,
+    #             log and status threads show up too, at a fraction of the
+    #             cost on a slow CPU; a .folded file of stack counts for
+    #             flamegraph.pl or speedscope
+    def __init__(self, directory='.', mode='cprofile', interval=0.005, logger=None):
+        if mode not in ('cprofile', 'sample'):
+            raise ValueError(f'Unknown profiler mode {mode!r}, expected cprofile or sample')
+        self.directory = directory
+        self.mode = mode
+        self.interval = interval
+        self.logger = logger
+        self.profile = None
+        self.sampler = None
+        self.stacks = {}
+        self.stop_event = threading.Event()
+        self.start_time = None
+
+    @property
+    def running(self):
+        return self.profile is not None or self.sampler is not None
+
+    def toggle(self):
+        if self.running:
+            return self.stop()
+        self.start()
+        return None
+
+    def start(self):
+        self.start_time = time.time()
+        if self.mode == 'cprofile':
+            # imported here, they would add to every controller's startup
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            self.stacks = {}
+            self.stop_event.clear()
+            self.sampler = threading.Thread(target=self._sample, name='profiler', daemon=True)
+            self.sampler.start()
+        if self.logger:
+            self.logger.warning(f'Profiling started ({self.mode}), signal again to stop.')
+
+    def stop(self):
+        # returns the path written
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.start_time))
+        if self.profile is not None:
+            import pstats
+            # stopped before anything is written, so a write error leaves it stopped
+            profile, self.profile = self.profile, None
+            profile.disable()
+            path = os.path.join(self.directory, f'profile-{stamp}.prof')
+            profile.dump_stats(path)
+            text = io.StringIO()
+            pstats.Stats(profile, stream=text).sort_stats('cumulative').print_stats(15)
+            summary = text.getvalue()
+        else:
+            self.stop_event.set()
+            self.sampler.join()
+            self.sampler = None
+            path = os.path.join(self.directory, f'profile-{stamp}.folded')
+            with open(path, 'w') as f:
+                for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+                    f.write(f'{stack} {count}\n')
+            summary = '\n'.join(f'{count:6d} {stack.rsplit(";", 1)[-1]}'
+                                for stack, count in sorted(self.leaf_counts().items(), key=lambda item: -item[1])[:15])
+        if self.logger:
+            self.logger.warning(f'Profile of {time.time() - self.start_time:.0f} s written to {path}\n{summary}')
+        return path
+
+    def leaf_counts(self):
+        counts = {}
+        for stack, count in self.stacks.items():
+            leaf = stack.rsplit(';', 1)[-1]
+            counts[leaf] = counts.get(leaf, 0) + count
+        return counts
+
+    def _sample(self):
+        me = threading.get_ident()
+        names = {}
+        while not self.stop_event.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
@@ -0,0 +1,124 @@
+import math
+
+# Relay interlocks.
+#
+# The safety rules for switching relays, as data:
+#   min_off    {relay: seconds} a relay that was switched off stays off at least
+#              this long (compressor short cycle protection)
+#   exclusive  [(relay, relay), ...] pairs that are never on together
+#   quiet      [(relay, (guard, ...), seconds), ...] relay only switches (either
+#              way) once every guard has been off for `seconds`, and the guards
+#              only come back on `seconds` after it switched, e.g. a reversing
+#              valve that mustn't move under compressor pressure
+#
+# plan() turns "get from this state to these settings" into the shortest
+# legal sequence of timed relay batches: everything that may switch now does,
+# guards that are in the way are switched off temporarily, and each later
+# batch happens the moment the rule holding it back expires.  Offs go before
+# ons within a batch.
+
+
+class Interlocks():
+    def __init__(self, min_off=None, exclusive=(), quiet=()):
+        self.min_off = dict(min_off or {})
+        self.exclusive = [tuple(pair) for pair in exclusive]
+        self.quiet = [(relay, tuple(guards), seconds) for relay, guards, seconds in quiet]
+
+    def check(self, on):
+        # raise ValueError if the set of relays that are on breaks an exclusion
+        for a, b in self.exclusive:
+            if a in on and b in on:
+                raise ValueError(f'{a} and {b} must never be on together')
+
+    def check_settings(self, state, settings):
+        # raise ValueError if applying settings [(relay, on), ...] to state
+        # {relay: on} may break an exclusion; relays missing from state could
+        # be either way
+        target = dict(state)
+        target.update(settings)
+        switched_on = {relay for relay, on in settings if on}
+        for a, b in self.exclusive:
+            for relay, other in ((a, b), (b, a)):
+                if relay not in switched_on or target.get(other) is False:
+                    continue
+                if target.get(other):
+                    raise ValueError(f'{a} and {b} must never be on together')
+                raise ValueError(f'{relay} is switched on while {other} may still be on, switch {other} off too')
+
+    def _earliest(self, relay, on, state, target, changed_at, now):
+        # earliest time relay may switch to `on`, or None while it is waiting on
+        # another relay to switch first
+        earliest = now
+        if on and relay in self.min_off:
+            earliest = max(earliest, changed_at[relay] + self.min_off[relay])
+        if on:
+            for a, b in self.exclusive:
+                other = b if relay == a else a if relay == b else None
+                if other is not None and state[other]:
+                    return None
+        for quiet, guards, seconds in self.quiet:
+            if relay == quiet:
+                for guard in guards:
+                    if state[guard]:
+                        return None
+                    earliest = max(earliest, changed_at[guard] + seconds)
+            elif on and relay in guards:
+                if state[quiet] != target[quiet]:
+                    return None
+                earliest = max(earliest, changed_at[quiet] + seconds)
+        return earliest
+
+    def plan(self, state, changed_at, settings, now):
+        # state {relay: on}, changed_at {relay: monotonic time of its last
+        # switch}, settings [(relay, on), ...] to reach; returns
+        # [(time, ((relay, on), ...)), ...] with the first batch at `now`
+        state = dict(state)
+        changed_at = dict(changed_at)
+        target = dict(state)
+        order = []
+        for relay, on in settings:
+            target[relay] = on
+            if relay not in order:
+                order.append(relay)
+        self.check({relay for relay, on in target.items() if on})
+
+        steps = []
+        t = now
+        while True:
+            batch = []
+
+            def switch(relay, on):
+                state[relay] = on
+                changed_at[relay] = t
+                batch.append((relay, on))
+
+            # guards in the way of a quiet relay go off first, and come back later
+            for quiet, guards, _ in self.quiet:
+                if state[quiet] != target[quiet]:
+                    for guard in guards:
+                        if state[guard]:
+                            if guard not in order:
+                                order.append(guard)
+                            switch(guard, False)
+            waits = []
+            for on in (False, True):
+                for relay in order:
+                    if state[relay] == target[relay] or target[relay] != on:
+                        continue
+                    earliest = self._earliest(relay, on, state, target, changed_at, t)
+                    if earliest is not None and earliest <= t:
+                        switch(relay, on)
+                    elif earliest is not None:
+                        waits.append(earliest)
+            if batch:
+                if steps and steps[-1][0] == t:
+                    # something freed up by this same batch, e.g. an exclusive partner
+                    steps[-1] = (t, steps[-1][1] + tuple(batch))
+                else:
+                    steps.append((t, tuple(batch)))
+            if all(state[relay] == target[relay] for relay in order):
+                return steps
+            if not batch:
+                if not waits or math.isinf(min(waits)):
+                    raise RuntimeError(f'Relay interlocks deadlocked reaching {settings}')
+                t = min(waits)
@@ -0,0 +1,126 @@
+import re
+import time
+
+import telemetry
+
+# Reading recorded controller history.
+#
+# Two sources carry the same per-tick data: the text lines log_data writes in
+# debug runs,
+#   2024-05-01 12:00:05 - DEBUG - ICE -2.0 9.11 34.50 06:15 08:15
+# and telemetry.bin files (see telemetry.py).  Both are read as a stream of
+# (timestamp, mode, target, plate, bin, time_in_mode, time_in_cycle) tuples,
+# mode as a name, or in chunks of NumPy columns for vectorized work, so weeks of
+# history never have to fit in memory at once.  The text timestamps only have
+# one second resolution; telemetry keeps the exact tick times.
+#
+# Text logs also carry the phase and cycle boundaries, which iter_events()
+# returns in order with the ticks.
+
+PREFIX = re.compile(r'(\d{4}-\d\d-\d\d) (\d\d):(\d\d):(\d\d)(?:,\d+)? - (\w+) - (.*)')
+TICK = re.compile(r'(\w+) (\S+) (-?[\d.]+) (-?[\d.]+) (\d+):(\d+) (\d+):(\d+)\s*')
+# the lines the controller writes at phase and cycle boundaries, tried in order
+# on every line that isn't a tick
+EVENTS = (
+    ('phase', re.compile(r'\s*Starting (\S+) phase \((\w+)\)')),
+    ('timeout', re.compile(r'\s*(\S+) (?:timed|Timed) out after')),
+    ('early', re.compile(r'\s*Ending (\S+) early')),
+    ('reached', re.compile(r'.*Reached (\S+) exit \((.*)\)!')),
+    ('cycle', re.compile(r'Cycle Count: (\d+)')),
+)
+COLUMNS = ('timestamp', 'mode', 'target', 'plate', 'bin', 'time_in_mode', 'time_in_cycle')
+
+
+def is_telemetry(path):
+    with open(path, 'rb') as f:
+        return f.read(len(telemetry.MAGIC)) == telemetry.MAGIC
+
+
+def iter_text_events(lines):
+    # (kind, timestamp, data) from log lines: ('tick', t, record) for log_data
+    # lines, (event kind, t, regex groups) for the EVENTS lines; anything else
+    # is skipped
+    midnight = {}
+    for line in lines:
+        match = PREFIX.match(line)
+        if not match:
+            continue
+        day, hours, minutes, seconds, level, message = match.groups()
+        if day not in midnight:
+            midnight[day] = time.mktime(time.strptime(day, '%Y-%m-%d'))
+        timestamp = midnight[day] + int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+        if level == 'DEBUG':
+            match = TICK.fullmatch(message)
+            if match:
+                mode, target, plate, bin_temp, mode_min, mode_sec, cycle_min, cycle_sec = match.groups()
+                yield 'tick', timestamp, (timestamp, mode, float(target) if target != 'None' else float('nan'),
+                                          float(plate), float(bin_temp), int(mode_min) * 60 + int(mode_sec),
+                                          int(cycle_min) * 60 + int(cycle_sec))
+            continue
+        for kind, pattern in EVENTS:
+            match = pattern.match(message)
+            if match:
+                yield kind, timestamp, match.groups()
+                break
+
+
+def iter_text(lines):
+    # tick records from log lines
+    for kind, _, data in iter_text_events(lines):
+        if kind == 'tick':
+            yield data
+
+
+def iter_records(path):
+    if is_telemetry(path):
+        for record in telemetry.read_file(path):
+            yield (record[0], telemetry.mode_name(record[1])) + record[2:5] + record[6:]
+    else:
+        with open(path, errors='replace') as f:
+            yield from iter_text(f)
+
+
+def iter_events(path):
+    # iter_text_events for a text log; a telemetry file only has ticks
+    if is_telemetry(path):
+        for record in iter_records(path):
+            yield 'tick', record[0], record
+    else:
+        with open(path, errors='replace') as f:
+            yield from iter_text_events(f)
+
+
+def iter_chunks(paths, size=1 << 18):
+    # {column: numpy array} chunks of at most `size` ticks across all paths in
+    # order; mode is an integer code into the `modes` list that comes with each
+    # chunk, and the list only ever grows
+    import numpy
+    modes = list(telemetry.MODES)
+    codes = {mode: code for code, mode in enumerate(modes)}
+    for path in paths:
+        if is_telemetry(path):
+            data = telemetry.load_numpy(path)
+            for start in range(0, len(data), size):
+                part = data[start:start + size]
+                yield {name: part[name].astype(numpy.float64) if name != 'mode' else part[name].astype(numpy.int64)
+                       for name in COLUMNS}, modes
+            continue
+        rows = []
+        for record in iter_records(path):
+            mode = record[1]
+            if mode not in codes:
+                codes[mode] = len(modes)
+                modes.append(mode)
+            rows.append((record[0], codes[mode]) + record[2:])
+            if len(rows) == size:
+                yield _columns(numpy, rows), modes
+                rows = []
+        if rows:
+            yield _columns(numpy, rows), modes
+
+
+def _columns(numpy, rows):
+    table = numpy.array(rows, dtype=numpy.float64)
+    columns = {name: table[:, i] for i, name in enumerate(COLUMNS)}
+    columns['mode'] = columns['mode'].astype(numpy.int64)
+    return columns
@@ -0,0 +1,228 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+from instrument import Timer
+
+# Logging off the control path.
+#
+# Loggers hand their records to a QueueHandler, which only puts them on a
+# queue.  A QueueListener thread formats and writes them, so a slow SD card or
+# a stdout pipe nobody is reading never holds up the relays.  Records go on
+# the queue unformatted (see LazyQueueHandler) and the hot paths log with
+# %-style arguments, so the text is built on the listener's thread, and only
+# for records that pass the level checks.  If the writer falls QUEUE_SIZE
+# records behind, new records are dropped and counted rather than waited on.
+#
+# The controller logs per subsystem, on children of the machine's logger:
+#   icemaker            phases, cycles, startup ('control' in log_levels)
+#   icemaker.relays     relay switching and interlock waits
+#   icemaker.sensors    bad reads and sensor health
+#   icemaker.scheduler  task overruns
+#   icemaker.stats      stats file errors
+# (fleet.py units log under fleet.<name> instead of icemaker.)  log_levels in
+# config.json sets their levels, e.g. {"relays": "WARNING", "sensors": "DEBUG"};
+# log_json names a JSON lines file that gets every record with its fields.
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+QUEUE_SIZE = 10000
+SUBSYSTEMS = ('control', 'relays', 'sensors', 'scheduler', 'stats')
+# LogRecord attributes; anything else on a record came in through extra={...}
+RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+        # time the logging threads spend handing records over, see instrument.py;
+        # every thread that logs adds to its own Timer, and the timer property
+        # merges them.  Timers of threads that have ended are kept, so the
+        # totals never go backwards.
+        self.local = threading.local()
+        self.timers = []
+        self.timers_lock = threading.Lock()
+
+    def prepare(self, record):
+        # the listener is in this process, so the record goes on the queue as
+        # it is and is formatted over there
+        return record
+
+    def thread_timer(self):
+        timer = getattr(self.local, 'timer', None)
+        if timer is None:
+            timer = self.local.timer = Timer()
+            with self.timers_lock:
+                self.timers.append(timer)
+        return timer
+
+    @property
+    def timer(self):
+        merged = Timer()
+        with self.timers_lock:
+            timers = list(self.timers)
+        for timer in timers:
+            merged.merge(timer)
+        return merged
+
+    def emit(self, record):
+        start = time.perf_counter()
+        super().emit(record)
+        self.thread_timer().add(time.perf_counter() - start)
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    'name': record.name, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': '%d log records dropped, the log writer fell behind', 'args': (self.dropped,)}))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogListener(logging.handlers.QueueListener):
+    def __init__(self, queue, *handlers, respect_handler_level=False):
+        super().__init__(queue, *handlers, respect_handler_level=respect_handler_level)
+        # time spent formatting and writing records
+        self.timer = Timer()
+
+    def handle(self, record):
+        start = time.perf_counter()
+        super().handle(record)
+        self.timer.add(time.perf_counter() - start)
+
+    def enqueue_sentinel(self):
+        # wait for room rather than fail when the queue is full
+        self.queue.put(self._sentinel)
+
+
+class JsonFormatter(logging.Formatter):
+    # one JSON object per record: time, level, logger, thread, message and any
+    # extra fields
+    def format(self, record):
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage().strip(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        entry.update((key, value) for key, value in vars(record).items() if key not in RECORD_FIELDS)
+        return json.dumps(entry, default=str)
+
+
+class LogPipeline():
+    def __init__(self, handlers, size=QUEUE_SIZE):
+        self.queue = queue.Queue(size)
+        self.handler = LazyQueueHandler(self.queue)
+        self.listener = LogListener(self.queue, *handlers, respect_handler_level=True)
+        self.running = False
+
+    def start(self):
+        if not self.running:
+            self.listener.start()
+            self.running = True
+
+    def add_handler(self, handler):
+        # the listener only reads its handler tuple, so swapping it is safe while running
+        self.listener.handlers += (handler,)
+
+    def flush(self):
+        # wait until everything logged so far has been written
+        if self.running:
+            self.listener.stop()
+            self.listener.start()
+
+    def stop(self):
+        if self.running:
+            self.listener.stop()
+            self.running = False
+
+
+pipeline = None
+
+
+def setup_logging(level=logging.DEBUG, stream=sys.stdout, format=LOG_FORMAT):
+    # like logging.basicConfig(), but the console handler sits behind the
+    # queue; does nothing if the root logger already has handlers.  Returns
+    # the pipeline, None if logging was set up some other way.
+    global pipeline
+    root = logging.getLogger()
+    if root.handlers:
+        return pipeline
+    console = logging.StreamHandler(stream)
+    console.setFormatter(logging.Formatter(format, DATE_FORMAT))
+    pipeline = LogPipeline([console])
+    root.addHandler(pipeline.handler)
+    root.setLevel(level)
+    pipeline.start()
+    # write out whatever is still queued before logging shuts down
+    atexit.register(pipeline.stop)
+    return pipeline
+
+
+def add_handler(handler, logger=None):
+    # write records with handler, only those of logger and its children if
+    # given; behind the queue when there is one
+    if logger is not None:
+        handler.addFilter(logging.Filter(logger.name))
+    if pipeline is not None and pipeline.running:
+        pipeline.add_handler(handler)
+    else:
+        (logger or logging.getLogger()).addHandler(handler)
+    return handler
+
+
+def json_handler(path):
+    handler = logging.FileHandler(path)
+    handler.setFormatter(JsonFormatter())
+    return handler
+
+
+def pipeline_stats():
+    # the pipeline's timers for instrumentation.json, see instrument.py
+    if pipeline is None:
+        return None
+    return {
+        'log_enqueue': pipeline.handler.timer.export(),
+        'log_write': pipeline.listener.timer.export(),
+        'queued': pipeline.queue.qsize(),
+        'dropped': pipeline.handler.dropped,
+    }
+
+
+def flush_logging():
+    if pipeline is not None:
+        pipeline.flush()
+
+
+def check_levels(levels):
+    # log_levels from config.json: {subsystem: level name}
+    if not isinstance(levels, dict):
+        raise ValueError(f'log_levels must be an object, got {levels!r}')
+    for name, level in levels.items():
+        if name not in SUBSYSTEMS:
+            raise ValueError(f'Unknown log_levels subsystem {name!r}, expected one of {", ".join(SUBSYSTEMS)}')
+        if not isinstance(level, str) or not isinstance(logging.getLevelName(level.upper()), int):
+            raise ValueError(f'Unknown log level {level!r} for {name}')
+
+
+def set_levels(logger, levels):
+    # apply log_levels to a machine's logger and its subsystem loggers; the
+    # ones not listed go back to inheriting their parent's level
+    for name in SUBSYSTEMS:
+        target = logger if name == 'control' else logger.getChild(name)
+        if name in levels:
+            target.setLevel(levels[name].upper())
+        elif target is not logging.getLogger():
+            target.setLevel(logging.NOTSET)
@@ -1,11 +1,24 @@
-import RPi.GPIO as GPIO
-import adafruit_dht
-import time
-import datetime
-import board
 import logging
-import sys
-from w1thermsensor import W1ThermSensor, Unit
+import os
+import signal
+import time
+# startup timing starts with the controller's own imports, see startup_report()
+IMPORT_START = time.perf_counter()
+from backends import PiBackend
+from checkpoint import Checkpoint, restart_plan
+from cooling import CoolingCurve
+from detectors import ReleaseDetector
+from idle import IdleController
+from instrument import Instruments, Profiler
+from interlocks import Interlocks
+from logsetup import json_handler, add_handler, pipeline_stats, set_levels, setup_logging
+from relays import RelayBank
+from recipe import DEFAULT_CONFIG, ConfigWatcher, CycleEngine, compile_recipe, load_config, validate_config
+from scheduler import Scheduler
+from sensors import SensorReader, SensorSampler, StaleReadingError
+from stats import RelayUsage, StatsStore
+from status import StatusServer
+from telemetry import Telemetry
 
 # 0 indicates active relay
 # 1 indicates inactive relay
@@ -55,6 +68,22 @@ class IceMaker():
         'ice_cutter': 'Ice Cutter'
     }
 
+    # relay safety rules, see interlocks.py
+    interlock_rules = {
+        # keep the compressors from short cycling
+        'min_off': {'compressor_1': 3*60, 'compressor_2': 3*60},
+        # hot gas heats the plate, the condenser fan would just fight it
+        'exclusive': [('hot_gas_solenoid', 'condenser_fan')],
+    }
+
+    # 1-Wire temperature sensors
+    sensor_ids = {
+        # on the back of the evaporator plate
+        'plate': '092101487373',
+        # in the ice bin, reads cold once ice piles up against it
+        'bin': '3c01f0956abd'
+    }
+
     #sensors = {
     #     # Whole machine temperature and humidity sensor
     #    'temp_humidity_sensor': 17
@@ -64,29 +93,85 @@ class IceMaker():
     fill_count = 0
     total_fill_count = 0
     last_batch = None
+    debug = False
     MIN=60
 
-    def __init__(self):
+    def __init__(self, backend=None, config=None, relays=None, sensor_ids=None, logger=None):
         #self.MIN = 2 if self.debug else 60
-        logging.basicConfig(stream=sys.stdout, 
-                level=logging.DEBUG,
-                format='%(asctime)s - %(levelname)s - %(message)s',
-                datefmt='%Y-%m-%d %H:%M:%S')
-        self.logger = logging.getLogger()
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setwarnings(False)
+        # console logging behind a queue, see logsetup.py
+        setup_logging()
+        # per machine wiring, e.g. one of several units run by fleet.py
+        if relays is not None:
+            self.relays = relays
+        if sensor_ids is not None:
+            self.sensor_ids = sensor_ids
+        self.logger = logger or logging.getLogger('icemaker')
+        # cycle parameters, defaults overridden by config.json
+        self.config = dict(DEFAULT_CONFIG)
+        self.config.update(config or {})
+        validate_config(self.config)
+        # subsystem loggers, their levels come from log_levels
+        set_levels(self.logger, self.config['log_levels'])
+        self.relay_logger = self.logger.getChild('relays')
+        # real Pi hardware unless a backend (e.g. simulator.SimBackend) is passed in
+        self.backend = backend or PiBackend()
+        self.clock = self.backend.clock
+        self.gpio = self.backend.gpio
+        # every phase loop ticks against absolute deadlines on this scheduler,
+        # which also runs the background periodic tasks while the loops wait
+        self.scheduler = Scheduler(self.clock, self.logger.getChild('scheduler'))
+        self.timeline = self.scheduler.timeline()
+        self.scheduler.add_task('scheduler_report', 15*60, self.log_scheduler_report)
+        # every relay write goes through the bank, which knows the state of each
+        # relay and only writes the pins that change
+        self.relay_bank = RelayBank(self.gpio, self.relays, self.clock)
+        self.interlocks = Interlocks(**self.interlock_rules)
+        # per-tick records; only kept in memory until telemetry.open() is given a file
+        self.telemetry = Telemetry(max(1, round(self.config['telemetry_buffer_days'] * 24 * 720)),
+                                   logger=self.logger.getChild('stats'))
+        self.wall_offset = time.time() - self.clock.monotonic()
+        self.scheduler.add_task('telemetry_flush', 10*60, self.telemetry.flush)
+        # long term counters; in memory only until stats.open() is given a file
+        self.stats = StatsStore(logger=self.logger.getChild('stats'))
+        self.relay_usage = RelayUsage(self.stats, self.relay_bank.bits, self.clock.monotonic())
+        self.scheduler.add_task('stats_flush', 60, self.flush_stats)
+        self.gpio.setmode(self.gpio.BCM)
+        self.gpio.setwarnings(False)
         for relay in self.relays.values():
-            GPIO.setup(relay, GPIO.OUT, initial=GPIO.HIGH)
-            GPIO.output(relay, 1)
+            self.gpio.setup(relay, self.gpio.OUT, initial=self.gpio.HIGH)
+        self.relay_bank.all_off()
+        # pins are only ever written, so check now and then that they still say
+        # what the bank thinks they do
+        self.scheduler.add_task('relay_watchdog', 60, self.relay_watchdog)
         
         # Setup 1-Wire temp sensors
-        self.ice_bin_temp_sensor_id = "3c01f0956abd"
-        self.plate_temp_sensor_id = "092101487373"
-        self.ice_bin_temp_sensor = W1ThermSensor(sensor_id=self.ice_bin_temp_sensor_id)
-        self.plate_temp_sensor = W1ThermSensor(sensor_id=self.plate_temp_sensor_id)
+        self.ice_bin_temp_sensor_id = self.sensor_ids['bin']
+        self.plate_temp_sensor_id = self.sensor_ids['plate']
+        self.ice_bin_temp_sensor = self.backend.temp_sensor('bin', self.ice_bin_temp_sensor_id)
+        self.plate_temp_sensor = self.backend.temp_sensor('plate', self.plate_temp_sensor_id)
+        # both sensors convert in parallel, so a tick costs one conversion time
+        self.sensor_reader = SensorReader({
+            'plate': self.plate_temp_sensor.get_temperature,
+            'bin': self.ice_bin_temp_sensor.get_temperature
+        }, clock=self.clock, parallel=self.backend.parallel_reads)
+        # the sampler keeps the latest good reading of each sensor in memory;
+        # plate is polled every second, the slow moving bin every 5 seconds, and
+        # a bad read is retried once if that still fits in 2 seconds
+        self.sampler = SensorSampler(self.sensor_reader, {'plate': 1, 'bin': 5}, clock=self.clock, logger=self.logger.getChild('sensors'),
+                                     retries=1, deadline=2.0)
+        self.scheduler.add_task('sensor_check', 15*60, self.sensor_check)
+        # where the loop's time goes and how long phases take, see instrument.py
+        self.instruments = Instruments(self.clock)
+        self.instruments.timers['sensor_read'] = self.sampler.read_timer
+        self.instruments.timers['sleep'] = self.scheduler.sleep_timer
+        self.sensor_timer = self.instruments.timer('sensor_wait')
+        self.gpio_timer = self.instruments.timer('gpio')
+        self.tick_timer = self.instruments.timer('tick')
+        self.tick_started_at = None
+        self.last_snapshot = None
         
         self.mode = 'IDLE'
-        self.system_start_time = time.monotonic()
+        self.system_start_time = self.clock.monotonic()
         self.mode_start_time = self.system_start_time
         self.time_in_mode = 0
         self.cycle_start_time = self.system_start_time
@@ -96,201 +181,342 @@ class IceMaker():
         self.plate_temp = 100
         self.plate_target = 32
         self.cycle_count = 0
-        # add config params here (to be overwritten by those read in from config file later)
-        # ... TBD
+        # ice phases predicted to miss their target before timing out
+        self.unreachable_count = 0
+        self.recipe = compile_recipe(self.config, self.relays, self.interlocks)
+        self.engine = CycleEngine(self)
+        self.idle = IdleController(self)
+        # set to a recipe.ConfigWatcher to pick up config file edits between phases
+        self.config_watcher = None
+        # set to a status.StatusServer to publish a snapshot every tick
+        self.status = None
+        # where in the cycle we are, for a warm restart; in memory until checkpoint.open()
+        self.checkpoint = Checkpoint(logger=self.logger.getChild('stats'))
 
     def sensor_check(self):
-        try:
-            #ambient_th_sensor = adafruit_dht.DHT22(board.D17, False)
-            #ice_bucket_temp = W1ThermSensor()
-
-            #temperature_c = ambient_th_sensor.temperature
-            #temperature_f = temperature_c * (9 / 5) + 32
-            #humidity = ambient_th_sensor.humidity
-            ice_bucket_temperature = ice_bucket_temp.get_temperature()
-            ice_bucket_temperature_f = ice_bucket_temperature * (9 / 5) + 32
-            #print("Temp={0:0.1f}ºC, Temp={1:0.1f}ºF, Humidity={2:0.1f}%, Temp={3:0.1f}ºF".format(temperature_c, temperature_f, humidity, ice_bucket_temperature))
-            self.logger.info("Ice Bucket Temp={0:0.1f}ºF".format(ice_bucket_temperature_f))
-            return ice_bucket_temperature_f
-        except RuntimeError as error:
-            # Errors happen fairly often, DHT's are hard to read, just keep going
-            print(error.args[0])
-            return None
-        except Exception as error:
-            ambient_th_sensor.exit()
-            return None
+        # {name: (latest reading, None once it's stale, health 0-1)} for every sensor
+        result = {}
+        for name in self.sampler.periods:
+            try:
+                value = self.sampler.get(name)
+            except StaleReadingError:
+                value = None
+            result[name] = (value, self.sampler.health[name])
+        self.logger.info('Sensors: ' + ', '.join(
+            f'{name} ' + ('stale' if value is None else f'{value:.2f} °F') + f' health {health:.2f} ({self.sampler.error_count[name]} bad reads)'
+            for name, (value, health) in result.items()))
+        return result
+
+    @property
+    def relay_mask(self):
+        # bit per relay in self.relays order, set while it's on
+        return self.relay_bank.mask
+
+    def relay_watchdog(self):
+        wrong = self.relay_bank.mismatched()
+        if wrong:
+            self.relay_logger.warning('Relay pins out of step with their last setting, rewriting %s', ', '.join(wrong))
+            self.relay_bank.reassert(wrong)
+        return wrong
 
     def power_off(self):
-        for relay in self.relays.keys():
-            print(relay)
-            self.relay_off(relay)
+        # rewrite every pin, whatever the shadow state says
+        self.relay_bank.all_off()
+        self.relay_usage.update(self.relay_mask, self.clock.monotonic())
+        self.save_checkpoint(self.checkpoint.state['phase'] if self.checkpoint.state else None, stopped=True)
         self.logger.warning('Powered off all relays.')
 
+    def save_checkpoint(self, phase=None, stopped=False):
+        # phase: the recipe phase being run, None between cycles
+        now = self.wall_offset + self.clock.monotonic()
+        self.checkpoint.save({
+            'saved_at': now,
+            'stopped_at': now if stopped else None,
+            'phase': phase,
+            'mode': self.mode,
+            'phase_start': self.wall_offset + self.mode_start_time,
+            'cycle_start': self.wall_offset + self.cycle_start_time,
+            'relays': [relay for relay, on in self.relay_bank.state().items() if on],
+            'changed_at': {relay: self.wall_offset + at for relay, at in self.relay_bank.changed_at.items()
+                           if at != float('-inf')},
+        })
+
+    def warm_restart(self):
+        # reconcile the checkpoint with the plate temperature, see checkpoint.py;
+        # returns (run the power on sequence, phase to resume or None)
+        state = self.checkpoint.load()
+        now = self.clock.monotonic()
+        power_on, resume, reason = restart_plan(state, self.wall_offset + now, lambda: self.sampler.get('plate'), self.recipe,
+                                                self.config['restart_max_age'] * self.MIN)
+        if state is not None:
+            # short cycle protection carries over; relays that were still on
+            # were switched off when this process set up the pins
+            for relay, at in state.get('changed_at', {}).items():
+                if relay in self.relay_bank.changed_at:
+                    self.relay_bank.changed_at[relay] = min(now, at - self.wall_offset)
+            for relay in state.get('relays', []):
+                if relay in self.relay_bank.changed_at:
+                    self.relay_bank.changed_at[relay] = now
+        if power_on:
+            self.logger.info(f'Cold start: {reason}.')
+        else:
+            self.logger.info(f'Warm restart: {reason}, skipping the power on sequence.')
+        return power_on, resume
+
     def power_on(self):
         #start up only, aka only one run once on first boot
         self.logger.info('\tActivating Power On Startup Sequence')
+        self.timeline.reset()
 
-        # turn on the water valve for 2 minutes
-        duration = 0.25
+        # turn on the water valve
+        duration = self.config['water_valve_time']
         self.logger.info(f'\t\tTurning on water valve for {duration} min.')
         self.relay_on('water_valve')
-        time.sleep(duration * self.MIN)
+        self.timeline.sleep(duration * self.MIN)
         # turn off the water valve
         self.logger.info('\t\tTurning off water valve')
         self.relay_off('water_valve')
 
-        # turn on the recirculating pump for 1 minute
-        duration = 0.25
+        # turn on the recirculating pump
+        duration = self.config['recirculation_pump_time']
         self.logger.info(f'\t\tTurning on recirculating pump for {duration} min.')
         self.relay_on('recirculating_pump')
-        time.sleep(duration * self.MIN)
+        self.timeline.sleep(duration * self.MIN)
         # turn off the recirculating pump 
         self.logger.info('\t\tTurning off recirculating pump')
         self.relay_off('recirculating_pump')
 
-        # turn on the water valve for 2 minutes
-        duration = 0.25
+        # turn on the water valve again
+        duration = self.config['water_valve_time']
         self.logger.info(f'\t\tTurning on water valve for another {duration} min.')
         self.relay_on('water_valve')
-        time.sleep(duration * self.MIN)
+        self.timeline.sleep(duration * self.MIN)
         # turn off the water valve
         self.logger.info('\t\tTurning off water valve')
         self.relay_off('water_valve')
 
         #completion of power on sequence
+        self.save_checkpoint()
         self.logger.info('\tCompletion of Power On Sequence')  
     
+    def read_sensors(self):
+        # latest plate & bin readings from the sampler cache, one snapshot per tick
+        self.tick_started_at = time.perf_counter()
+        self.last_snapshot = self.sampler.snapshot()
+        self.sensor_timer.add(time.perf_counter() - self.tick_started_at)
+        self.plate_temp = self.last_snapshot.values['plate']
+        self.bin_temp = self.last_snapshot.values['bin']
+        return self.last_snapshot
+
+    def publish_status(self):
+        if self.status is not None:
+            self.status.publish(self)
+
     def log_data(self):
-        self.logger.debug(self.mode + f' {self.plate_target} {self.plate_temp:.02f} {self.bin_temp:.02f} {int(self.time_in_mode/self.MIN):02d}:{round(self.time_in_mode % self.MIN):02d} {int(self.time_in_cycle/self.MIN):02d}:{round(self.time_in_cycle % self.MIN):02d}')
+        self.telemetry.record(self.wall_offset + self.clock.monotonic(), self.mode, self.plate_target,
+                              self.plate_temp, self.bin_temp, self.relay_mask, self.time_in_mode, self.time_in_cycle)
+        self.publish_status()
+        # the text line is only worth its cost when someone is watching
+        if self.debug:
+            self.logger.debug('%s %s %.02f %.02f %02d:%02d %02d:%02d', self.mode, self.plate_target, self.plate_temp, self.bin_temp,
+                              int(self.time_in_mode/self.MIN), round(self.time_in_mode % self.MIN),
+                              int(self.time_in_cycle/self.MIN), round(self.time_in_cycle % self.MIN))
+        # a tick runs from its sensor snapshot to here
+        if self.tick_started_at is not None:
+            self.tick_timer.add(time.perf_counter() - self.tick_started_at)
+            self.tick_started_at = None
         
-    def chill_plate(self, timeout=25*60, target_temp=25, recirc=False):
-        self.logger.info(f'\tChilling Plate to {target_temp} °F, Recirculation ' + ('On' if recirc else 'Off'))
-        self.plate_temp = self.plate_temp_sensor.get_temperature(Unit.DEGREES_F)
-        self.bin_temp = self.ice_bin_temp_sensor.get_temperature(Unit.DEGREES_F)
-        self.mode_start_time = time.monotonic()
-        self.plate_target = target_temp
-        chilling = True if (self.plate_temp > target_temp) else False # Only turn compressor etc on if temp is above target temp
-        if chilling:
-            # hot gas/water fill OFF
-            self.relay_off('hot_gas_solenoid', True)
-            self.relay_off('water_valve', True)
-            # condenser/compressor ON
-            self.relay_on('condenser_fan', True)
-            self.relay_on('compressor_1', True)
-            self.relay_on('compressor_2', True)
-            # recirculating pump
-            if recirc:
-                self.relay_on('recirculating_pump', True)
-            else:
-                self.relay_off('recirculating_pump', True)
-        else:
-            self.logger.info(f'\tSkipping Chilling Sequence.  Plate temp ({self.plate_temp} °F) is below target temp ({target_temp} °F).')
-        
-        wait_time = self.MIN / 12.0
-        while chilling:
-            self.time_in_mode = time.monotonic() - self.mode_start_time
-            self.time_in_cycle = time.monotonic() - self.cycle_start_time
-            self.plate_temp = self.plate_temp_sensor.get_temperature(Unit.DEGREES_F) 
-            self.bin_temp = self.ice_bin_temp_sensor.get_temperature(Unit.DEGREES_F)
-
-            if self.time_in_mode > timeout: # Check for timeout
-                chilling = False
-                self.logger.info(f'\tChilling Timed out after {timeout/self.MIN:.02f} minutes.  Ending Chilling Sequence.')
-            elif self.plate_temp > target_temp:  # Continue Chilling Plate if still above target temp
-                # wait for plate temp to reach > 52 degrees F
-                #self.logger.info(f'Target: {target_temp} °F. Current Temp: {temp:.2f} °F Plate, {bin_temp:.2f} °F Bin.  Time spent: {time_spent/60:.02f} minutes')
-                self.log_data()
-                time.sleep(max(0, (wait_time - ((time.monotonic() - self.mode_start_time) - self.time_in_mode))))
-            else:  # stop if reached target temp
-                self.log_data()
-                self.logger.info(f'\t\tCurrent Temp: {self.plate_temp:.2f} °F.  Reached chilling target ({target_temp} °F)!')
-                chilling = False
-                self.logger.info('\tEnding Chilling Sequence')
-        #  Condenser fan & compressor are left ON.  Main loop decides what to do based on ice bin fullness (proceed to ice making or go to sleep)
-              
-        
-    def ice_making(self, ice_target_temp = 6.5):
-        #Start ice making sequence
-        self.logger.info('\tActivating Ice Making Sequence')
+    def cooling_curve(self, target_temp):
+        if not self.config['ice_predict']:
+            return None
+        return CoolingCurve(target_temp, settle=self.config['ice_predict_settle'] * self.MIN)
 
-        # PRECHILL ICE PLATE
-        #self.chill_plate(timeout= 2*self.MIN)
-        
-        
-        # Ice-making phase
-        self.logger.info('\t\tStarting Ice Making Process')
-        self.chill_plate(target_temp=ice_target_temp, recirc=True, timeout=25*self.MIN)
-        self.logger.info('\t\tCompleting Ice Making Process')
-        # Finish Ice-Making Phase
-        #   Turn off condenser fan & recirc pump, but leave compressor on (for harvest)
-        self.relay_off('condenser_fan',True)
-        self.relay_off('recirculating_pump',True)
-        self.last_batch = time.monotonic()
-        self.logger.info('\tCompleting Ice Making Sequence')
-
-    def harvest(self, timeout = 4*60, harvest_threshold = 52.5):
-        self.mode_start_time = time.monotonic()
-        self.logger.info(f'\Activating Harvest Sequence.  Target temp: {harvest_threshold} °F')
-        self.plate_target = harvest_threshold
-        #Start harvest sequence
-        # ensure condenser fan & recirc pump are off
-        self.relay_off('condenser_fan')
-        self.relay_off('recirculating_pump')
-        
-        # start harvest
-        self.relay_on('water_valve', True)  # Fill water reservoir while harvesting
-        self.relay_on('hot_gas_solenoid', True) # Configure to heat the plate
-        self.relay_on('ice_cutter') # Turn on ice cutter
-        harvesting = True
-        wait_time = self.MIN / 12
-        while harvesting:
-            self.time_in_mode = time.monotonic() - self.mode_start_time
-            self.time_in_cycle = time.monotonic() - self.cycle_start_time
-            self.plate_temp = self.plate_temp_sensor.get_temperature(Unit.DEGREES_F)
-            self.bin_temp = self.ice_bin_temp_sensor.get_temperature(Unit.DEGREES_F)
-            if (time.monotonic() - self.mode_start_time) > timeout: # Check for timeout
-                harvesting = False
-                self.logger.info(f'\tHarvest Timed out after {timeout/60} minutes')
-            elif self.plate_temp < harvest_threshold:
-                # wait for plate temp to reach > 52 degrees F
-                #self.logger.info(f'\tWaiting  ({wait_time} more seconds) for plate to warm up to {harvest_threshold} °F. Current Temp: {self.plate_temp:.2f} °F')
-                self.log_data()
-                time.sleep(wait_time)
-            else:
-                self.log_data()
-                self.logger.info(f'\tCurrent Temp: {self.plate_temp:.2f} °F.  Reached harvest threshold ({harvest_threshold} °F)!')
-                harvesting = False
-
-            # end harvest
-        self.logger.info('\tEnding Harvest Sequence')
-        self.relay_off('hot_gas_solenoid', True)
-        self.relay_off('water_valve', True)
-        # leave compressor on (prep for cooling off the plate), turn on condenser fan
-        self.relay_on('condenser_fan', True)
+    def release_detector(self):
+        return ReleaseDetector(window=self.config['harvest_release_window'] * self.MIN,
+                               release_slope=self.config['harvest_release_slope'],
+                               plateau_slope=self.config['harvest_plateau_slope'],
+                               min_plateau=self.config['harvest_min_plateau'] * self.MIN)
+
+    def run_cycle(self, resume=None):
+        # prechill -> ice -> harvest -> rechill, as described by the recipe compiled from config;
+        # resume picks up an interrupted cycle, see warm_restart()
+        self.engine.run_cycle(resume)
 
     def test_relay(self, relay, duration):
         self.logger.info('\tRelay Test')
         self.relay_on(relay, True)
-        time.sleep(duration)
+        self.clock.sleep(duration)
         self.relay_off(relay, True)
 
+    def apply_relays(self, settings, log = False):
+        # switch a set of (relay, on) pairs in as few GPIO batches as the
+        # interlocks allow, waiting between batches only as long as they require;
+        # relays already in the requested state are neither written nor logged
+        plan = self.interlocks.plan(self.relay_bank.state(), self.relay_bank.changed_at, settings, self.clock.monotonic())
+        changed = []
+        for at, batch in plan:
+            if at > self.clock.monotonic():
+                self.relay_logger.info('\t\tWaiting %.1f s for relay interlocks', at - self.clock.monotonic())
+                self.interlock_wait(at)
+            changed += self.apply_batch(batch, log)
+        return changed
+
+    def apply_batch(self, batch, log=False):
+        # one batch of an interlock plan, legal to switch right now
+        start = time.perf_counter()
+        switched = self.relay_bank.apply(batch)
+        self.gpio_timer.add(time.perf_counter() - start)
+        if switched:
+            self.relay_usage.update(self.relay_mask, self.clock.monotonic())
+            if log:
+                for relay, on in switched:
+                    self.relay_logger.info('\t\tTurning %s %s', 'ON' if on else 'OFF', self.relay_names[relay])
+        return switched
+
+    def interlock_wait(self, deadline):
+        self.scheduler.sleep_until(deadline)
+
     def relay_on(self, relay, log = False):
-        if log:
-            self.logger.info(f'\t\tTurning ON {self.relay_names[relay]}')
-        GPIO.output(self.relays[relay], 0)
+        self.apply_relays(((relay, True),), log)
 
     def relay_off(self, relay, log = False):
-        if log:
-            self.logger.info(f'\t\tTurning OFF {self.relay_names[relay]}')
-        GPIO.output(self.relays[relay], 1)
+        self.apply_relays(((relay, False),), log)
+    def flush_stats(self):
+        self.relay_usage.accrue(self.clock.monotonic())
+        self.stats.flush()
+
+    def write_instrumentation(self, path):
+        # timers & phase histograms, with the scheduler's task stats and the
+        # log pipeline's timers, see instrument.py
+        try:
+            self.instruments.write(path, {'tasks': self.scheduler.report(), 'log': pipeline_stats()})
+        except OSError as error:
+            self.logger.error(f'Could not write {path}: {error}')
+            return
+        self.logger.info(f'Instrumentation written to {path}')
+
+    def log_scheduler_report(self):
+        for name, stats in self.scheduler.report().items():
+            if stats['overruns']:
+                self.logger.warning(f'{name}: {stats["overruns"]} overruns in {stats["runs"]} ticks, worst {stats["max_lateness"]:.2f} s late')
+            if stats['failures']:
+                self.logger.warning(f'{name}: {stats["failures"]} of {stats["runs"]} runs failed')
+
+    def reload_config(self):
+        # apply an edited config file if it is valid; returns True if the settings changed
+        if self.config_watcher is None:
+            return False
+        config = self.config_watcher.poll()
+        if config is None:
+            return False
+        try:
+            validate_config(config)
+            recipe = compile_recipe(config, self.relays, self.interlocks)
+        except (ValueError, KeyError, TypeError) as error:
+            self.logger.error(f'Ignoring invalid config: {error}')
+            return False
+        set_levels(self.logger, config['log_levels'])
+        # the per-tick log line follows debug; the 1 s minutes and relay walk
+        # through it also turns on are only set up at startup
+        self.debug = config['debug']
+        changed = sorted(key for key in set(config) | set(self.config) if config.get(key) != self.config.get(key))
+        self.config = config
+        self.recipe = recipe
+        self.logger.info(f'Reloaded config, changed: {", ".join(changed) or "nothing"}')
+        return True
+
+    def idle_step(self):
+        # one pass of the bin-full idle loop, run once a minute while the bin stays full
+        settings = self.idle_settings()
+        if settings:
+            self.apply_relays(settings, True)
+            self.save_checkpoint()
+        self.publish_status()
+
+    def idle_settings(self):
+        # idle_step's decision: the relay settings to apply, if any
+        self.reload_config()
+        if self.clock.monotonic() > (self.cycle_finish_time + self.config['ice_cutter_off_time']*self.MIN):
+            self.relay_off('ice_cutter')
+        
+        self.bin_temp = self.sampler.get('bin')
+        # compressors off, kept in standby or started early, see idle.py
+        running = self.relay_bank.is_on('compressor_1') or self.relay_bank.is_on('compressor_2')
+        run, reason = self.idle.decide(self.clock.monotonic(), self.bin_temp, running)
+        if run and not running:
+            self.logger.info(f'Ice Bin Full, {reason}: turning on compressor & fan.')
+            return (('hot_gas_solenoid', False), ('condenser_fan', True), ('compressor_1', True), ('compressor_2', True))
+        if running and not run:
+            self.logger.info(f'Ice Bin Full and {reason}, turning off compressor & fan.')
+            self.mode = 'IDLE'
+            return (('compressor_1', False), ('compressor_2', False), ('condenser_fan', False))
+        return None
+
+    def wait_while_bin_full(self):
+        bin_check = self.scheduler.add_task('bin_full', 1 * self.MIN)
+        while self.bin_full(threshold=self.config['bin_full_temp']):
+            self.logger.info(f'Ice bin full...sleeping.')
+            self.scheduler.wait(bin_check)
+            self.idle_step()
+
+        self.scheduler.remove_task(bin_check)
+        self.logger.info(f'Ice Bin not full...restarting ice-making cycle.')
+
     def bin_full(self, threshold=35):
-        self.bin_temp = self.ice_bin_temp_sensor.get_temperature(Unit.DEGREES_F)
+        self.bin_temp = self.sampler.get('bin')
         self.logger.info(f'Bucket temp: {self.bin_temp:.2f} °F.')
         return (self.bin_temp < threshold)
         
+def signal_handler(logger, action):
+    # a handler that runs action() wherever the control thread is when the
+    # signal comes in, so whatever it raises is logged, never left to the cycle
+    def handle(signum, frame):
+        try:
+            action()
+        except Exception:
+            logger.exception(f'Handling signal {signum} failed')
+    return handle
+
+
+def startup_report(marks):
+    # 'imports 40 ms, config 1 ms, ..., 60 ms to first relay' from [(step, perf_counter()), ...]
+    steps = [f'{step} {(t - marks[i][1]) * 1000:.0f} ms' for i, (step, t) in enumerate(marks[1:])]
+    return ', '.join(steps) + f', {(marks[-1][1] - marks[0][1]) * 1000:.0f} ms to first relay'
+
+
 if __name__ == '__main__':
-    ice_maker = IceMaker()
-    ice_maker.debug = False
+    startup = [('start', IMPORT_START), ('imports', time.perf_counter())]
+    config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
+    config = load_config(config_path)
+    startup.append(('config', time.perf_counter()))
+    # GPIO & 1-Wire drivers, sensors are bound by ID without scanning the bus
+    backend = PiBackend()
+    startup.append(('drivers', time.perf_counter()))
+    ice_maker = IceMaker(backend=backend, config=config)
+    ice_maker.config_watcher = ConfigWatcher(config_path, ice_maker.logger)
+    if config['log_json']:
+        # every record as a JSON object, written by the log thread like the console
+        add_handler(json_handler(os.path.join(os.path.dirname(config_path), config['log_json'])))
+    ice_maker.telemetry.open(os.path.join(os.path.dirname(config_path), 'telemetry.bin'))
+    ice_maker.checkpoint.open(os.path.join(os.path.dirname(config_path), 'checkpoint.json'))
+    ice_maker.stats.open(os.path.join(os.path.dirname(config_path), 'stats.json'))
+    # kill -USR1 toggles a profile of the running controller, kill -USR2 writes
+    # instrumentation.json (also written on exit), see instrument.py
+    instrumentation_path = os.path.join(os.path.dirname(config_path), 'instrumentation.json')
+    profiler = Profiler(os.path.dirname(config_path), config['profiler'], logger=ice_maker.logger)
+    signal.signal(signal.SIGUSR1, signal_handler(ice_maker.logger, profiler.toggle))
+    signal.signal(signal.SIGUSR2, signal_handler(ice_maker.logger, lambda: ice_maker.write_instrumentation(instrumentation_path)))
+    startup.append(('setup', time.perf_counter()))
+    if config['status_port']:
+        try:
+            ice_maker.status = StatusServer(config['status_port'], config['status_host'])
+            ice_maker.status.start()
+            ice_maker.status.publish(ice_maker)
+        except OSError as error:
+            ice_maker.status = None
+            ice_maker.logger.error(f'Status server not started on {config["status_host"]}:{config["status_port"]}: {error}')
+        startup.append(('status', time.perf_counter()))
+    ice_maker.debug = config['debug']
     ice_maker.MIN = 60
     
     # Debug Only ------------------
@@ -303,90 +529,60 @@ if __name__ == '__main__':
         # Turn on/off compressor_1 & _2 together
         ice_maker.relay_on('compressor_1', True)
         ice_maker.relay_on('compressor_2', True)
-        time.sleep(test_time)
+        ice_maker.clock.sleep(test_time)
         ice_maker.relay_off('compressor_1', True)
         ice_maker.relay_off('compressor_2', True)
+        # every sensor on the bus, handy for finding IDs but too slow for every boot
+        try:
+            for sensor in ice_maker.backend.available_sensors():
+                ice_maker.logger.info("Sensor %s has temperature %.2f deg F" % (sensor.id, sensor.get_temperature()))
+        except:
+            ice_maker.logger.error('Error reading temperature sensor on startup.')
+        startup.append(('debug checks', time.perf_counter()))
     # -----------------------------       
     
-    
-    
-    try:
-        for sensor in W1ThermSensor.get_available_sensors():
-            ice_maker.logger.info("Sensor %s has temperature %.2f deg F" % (sensor.id, sensor.get_temperature(Unit.DEGREES_F)))
-    except:
-        ice_maker.logger.error('Error reading temperature sensor on startup.')
-    
 
-    # Read from file:
-       # long term data like \
-           # total number of batches made
-           # compressor turn ons (count)
-           # compressor turn on time
-           # compressor cooling time
-           # compressor heating time
-           # hot gas solenoid activations (while compressor on)
-           # door open count
-           # door open duration
-       # config settings
-           # rechill temp/timeout
-           # ice-making temp/timeout
-           # harvest temp/timout
-           # bin-full threshold
+    # long term data (batches made, compressor starts & run/cooling/heating time,
+    # hot gas activations...) is kept in stats.json, see stats.py
+    # door open count/duration still need a door switch
+    # config settings are read from config.json (see recipe.py)
+    ice_maker.logger.info('Lifetime stats: ' + ', '.join(f'{name} {value:g}' for name, value in ice_maker.stats.values.items()))
            
        
     
     ice_maker.logger.info('Powering On...')
     try:
-        ice_maker.power_on()
+        # the first readings come in on the sampler thread while the relays start up
+        ice_maker.sampler.start(prime=False)
+        power_on, resume = ice_maker.warm_restart() if config['warm_restart'] else (True, None)
+        startup.append(('restart plan', time.perf_counter()))
+        ice_maker.logger.info(f'Startup: {startup_report(startup)}')
+        if power_on:
+            ice_maker.power_on()
+        elif resume is None:
+            ice_maker.wait_while_bin_full()
         #print(lamp)
         while True:
-            ice_maker.relay_on('ice_cutter') # Turn on ice cutter
-            
-            ice_maker.cycle_start_time = time.monotonic()
-            ice_maker.mode = 'CHILL'
-            ice_maker.chill_plate(timeout=2*ice_maker.MIN, target_temp=32)  #     Prechill
-            ice_maker.mode = 'ICE'
-            ice_maker.ice_making(ice_target_temp=-2) #                            Make Ice
-            ice_maker.mode = 'HEAT'
-            ice_maker.harvest(timeout=4*ice_maker.MIN, harvest_threshold=38) #    Harvest
-            ice_maker.mode = 'CHILL'
-            ice_maker.chill_plate(timeout=5*ice_maker.MIN, target_temp=35) #      Rechill
-            ice_maker.cycle_finish_time = time.monotonic()
-            ice_maker.cycle_count += 1
-            ice_maker.logger.info(f'Cycle Count: {ice_maker.cycle_count}')
-            while ice_maker.bin_full(threshold=35):
-                ice_maker.logger.info(f'Ice bin full...sleeping.')
-                time.sleep(1 * ice_maker.MIN)
-                if time.monotonic() > (ice_maker.cycle_finish_time + 15*ice_maker.MIN):
-                    ice_maker.relay_off('ice_cutter')
-                
-                ice_maker.bin_temp = ice_maker.ice_bin_temp_sensor.get_temperature(Unit.DEGREES_F)
-                min_bin_temp = 33
-                max_time_after_cycle_finish = 20
-                # if bin temp gets below threshold, or enough time passes after the cycle finish time, shut off the compressor            
-                if ice_maker.bin_temp < min_bin_temp: 
-                    ice_maker.logger.info(f'Ice Bin Full and Bin Temp is below {min_bin_temp} °F ({ice_maker.bin_temp:.02f} °F), turning off compressor & fan.')
-                    ice_maker.mode = 'IDLE'
-                    ice_maker.relay_off('compressor_1', True)
-                    ice_maker.relay_off('compressor_2', True)
-                    ice_maker.relay_off('condenser_fan', True)
-                elif time.monotonic() > (ice_maker.cycle_finish_time + max_time_after_cycle_finish*ice_maker.MIN):
-                    ice_maker.logger.info(f'Ice Bin Full and {max_time_after_cycle_finish} minutes passed, turning off compressor & fan.')
-                    ice_maker.mode = 'IDLE'
-                    ice_maker.relay_off('compressor_1', True)
-                    ice_maker.relay_off('compressor_2', True)
-                    ice_maker.relay_off('condenser_fan', True)
-                    
-            ice_maker.logger.info(f'Ice Bin not full...restarting ice-making cycle.')
-            
-            # periodically write long term stats to file
+            ice_maker.run_cycle(resume)
+            resume = None
+            ice_maker.wait_while_bin_full()
 
     except Exception as error:
         ice_maker.power_off()
         ice_maker.logger.warning('SYSTEM POWER OFF, TURNING OFF ALL RELAYS...')
-        # log all long term data stuff to file
         ice_maker.logger.warning('An error occurred...' + str(error))
         
     except:
         ice_maker.logger.warning('SYSTEM POWER OFF, TURNING OFF ALL RELAYS...')
-        ice_maker.power_off()
\ No newline at end of file
+        ice_maker.power_off()
+    finally:
+        ice_maker.telemetry.flush()
+        ice_maker.flush_stats()
+        if profiler.running:
+            try:
+                profiler.stop()
+            except OSError as error:
+                ice_maker.logger.error(f'Could not write the profile: {error}')
+        ice_maker.write_instrumentation(instrumentation_path)
+        if ice_maker.status is not None:
+            ice_maker.status.stop()
\ No newline at end of file
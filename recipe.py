@@ -0,0 +1,438 @@
+import json
+import logging
+import math
+import operator
+import os
+import re
+
+from logsetup import check_levels
+
+# Declarative cycle recipes.
+#
+# config.json describes the cycle as a list of phases.  Each phase has a mode
+# for the logs, the relays to switch on & off when it starts, exit conditions
+# and a timeout.  compile_recipe() turns that into flat per-phase tables up
+# front, so each control tick only walks a short tuple of
+# (value index, comparison, threshold, next phase) entries.
+#
+# If the config has no "phases" list, the standard prechill -> ice -> harvest
+# -> rechill cycle is built from the scalar settings below.
+
+DEFAULT_CONFIG = {
+    'debug': False,
+    # power on sequence, minutes
+    'water_valve_time': 0.25,
+    'recirculation_pump_time': 0.25,
+    # prechill
+    'plate_target_temp': 32.0,
+    'prechill_timeout': 2,
+    # ice making
+    'ice_target_temp': -2.0,
+    'ice_timeout': 25,
+    # fit the plate cooling curve (see cooling.CoolingCurve) and flag cycles that
+    # can't reach the target: predictions start ice_predict_settle minutes in,
+    # and a cycle is flagged when the predicted end is past
+    # ice_timeout * ice_predict_margin.  With ice_predict_abort the ice phase
+    # then ends right away instead of running out the timeout.
+    'ice_predict': True,
+    'ice_predict_settle': 10,
+    'ice_predict_margin': 1.25,
+    'ice_predict_abort': False,
+    # harvest
+    'harvest_threshold_temp': 38.0,
+    'harvest_threshold_timeout': 4,
+    # end harvest as soon as the slab lets go (see detectors.ReleaseDetector);
+    # off by default, with a 38 °F threshold both exits fire on the same tick;
+    # slopes in °F/min, window & plateau in minutes
+    'harvest_release_detect': False,
+    'harvest_release_slope': 4.0,
+    'harvest_release_window': 0.5,
+    'harvest_plateau_slope': 1.0,
+    'harvest_min_plateau': 0.5,
+    # rechill
+    'rechill_target_temp': 35.0,
+    'rechill_timeout': 5,
+    # bin full / idle
+    'bin_full_temp': 35.0,
+    'min_bin_temp': 33.0,
+    'ice_cutter_off_time': 15,
+    'max_time_after_cycle_finish': 20,
+    # see idle.IdleController: keep the compressors running / restart them this
+    # many minutes ahead of the bin needing ice, judging by its last
+    # idle_trend_window minutes of temperatures
+    'idle_standby_time': 5,
+    'idle_trend_window': 10,
+    'max_compressor_starts_per_hour': 6,
+    # HTTP status/metrics endpoint (see status.py), 0 turns it off; it has no
+    # authentication, so it only listens on this machine unless status_host is
+    # set to an address on the network, e.g. '0.0.0.0' for all of them
+    'status_port': 8080,
+    'status_host': '127.0.0.1',
+    # ticks kept in memory (see telemetry.py), about 0.5 MB a day
+    'telemetry_buffer_days': 14,
+    # pick up where the last run stopped (see checkpoint.py) unless that was
+    # more than restart_max_age minutes ago
+    'warm_restart': True,
+    'restart_max_age': 30,
+    # per subsystem log levels and a JSON lines log file, see logsetup.py;
+    # an empty log_json turns that file off
+    'log_levels': {},
+    'log_json': '',
+    # what kill -USR1 profiles with, 'cprofile' or 'sample' (see instrument.py)
+    'profiler': 'cprofile',
+}
+
+# values a condition can test, in the order the engine passes them
+#   plate_slope  rolling plate dT/dt, °F/min
+#   released     1 once the harvest release detector has fired, else 0
+#   predicted_end  minutes into an ICE phase the plate is predicted to reach the
+#                target; inf if it never will, NaN (never matches) until known
+VALUES = ('plate_temp', 'bin_temp', 'time_in_mode', 'plate_slope', 'released', 'predicted_end')
+PLATE_TEMP, BIN_TEMP, TIME_IN_MODE, PLATE_SLOPE, RELEASED, PREDICTED_END = range(len(VALUES))
+OPERATORS = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+CONDITION = re.compile(r'^\s*(\w+)\s*(<=|>=|<|>)\s*(-?\d+(?:\.\d*)?)\s*$')
+# next phase index that ends the cycle
+DONE = -1
+
+CHILL_OFF = ['hot_gas_solenoid', 'water_valve']
+COMPRESSORS_ON = ['condenser_fan', 'compressor_1', 'compressor_2']
+
+
+def default_phases(config):
+    harvest_exits = [f'plate_temp >= {config["harvest_threshold_temp"]}']
+    if config['harvest_release_detect']:
+        harvest_exits.insert(0, 'released >= 1')
+    ice_exits = [f'plate_temp <= {config["ice_target_temp"]}']
+    if config['ice_predict'] and config['ice_predict_abort']:
+        ice_exits.append(f'predicted_end > {round(config["ice_timeout"] * config["ice_predict_margin"], 6)}')
+    return [
+        {'name': 'prechill', 'mode': 'CHILL', 'target': config['plate_target_temp'],
+         'on': COMPRESSORS_ON + ['ice_cutter'], 'off': CHILL_OFF + ['recirculating_pump'],
+         'exits': [f'plate_temp <= {config["plate_target_temp"]}'],
+         'timeout': config['prechill_timeout'], 'next': 'ice'},
+        {'name': 'ice', 'mode': 'ICE', 'target': config['ice_target_temp'],
+         'on': COMPRESSORS_ON + ['recirculating_pump'], 'off': CHILL_OFF,
+         'exits': ice_exits,
+         'timeout': config['ice_timeout'], 'next': 'harvest'},
+        {'name': 'harvest', 'mode': 'HEAT', 'target': config['harvest_threshold_temp'],
+         'on': ['water_valve', 'hot_gas_solenoid', 'ice_cutter'], 'off': ['condenser_fan', 'recirculating_pump'],
+         'exits': harvest_exits,
+         'timeout': config['harvest_threshold_timeout'], 'next': 'rechill'},
+        {'name': 'rechill', 'mode': 'CHILL', 'target': config['rechill_target_temp'],
+         'on': COMPRESSORS_ON, 'off': CHILL_OFF + ['recirculating_pump'],
+         'exits': [f'plate_temp <= {config["rechill_target_temp"]}'],
+         'timeout': config['rechill_timeout'], 'next': None},
+    ]
+
+
+class Recipe():
+    # compiled cycle; every per-phase attribute is a tuple indexed by phase number
+    def __init__(self, config, names, modes, targets, relays, timeouts, transitions):
+        self.config = config
+        self.names = names
+        self.modes = modes
+        self.targets = targets
+        # ((relay, on), ...) to apply when the phase starts
+        self.relays = relays
+        # minutes
+        self.timeouts = timeouts
+        # ((value index, operator, threshold, next phase, description), ...)
+        self.transitions = transitions
+        self.start = 0
+
+
+def parse_condition(text):
+    match = CONDITION.match(text)
+    if not match or match.group(1) not in VALUES:
+        raise ValueError(f'Bad exit condition: {text!r}')
+    name, op, threshold = match.groups()
+    return VALUES.index(name), OPERATORS[op], float(threshold)
+
+
+def compile_recipe(config, relay_names=None, interlocks=None):
+    phases = config.get('phases') or default_phases(config)
+    names = tuple(phase['name'] for phase in phases)
+    if len(set(names)) != len(names):
+        raise ValueError('Phase names must be unique')
+
+    def index(name):
+        if name is None:
+            return DONE
+        if name not in names:
+            raise ValueError(f'Unknown phase: {name}')
+        return names.index(name)
+
+    relays, timeouts, transitions = [], [], []
+    for phase in phases:
+        on, off = phase.get('on', []), phase.get('off', [])
+        if relay_names is not None:
+            unknown = set(on + off) - set(relay_names)
+            if unknown:
+                raise ValueError(f'Unknown relay(s) in phase {phase["name"]}: {", ".join(sorted(unknown))}')
+        if set(on) & set(off):
+            raise ValueError(f'Relay switched both on and off in phase {phase["name"]}')
+        # offs first, so nothing that should be off is ever on together with the new set
+        relays.append(tuple((relay, False) for relay in off) + tuple((relay, True) for relay in on))
+        timeout = float(phase['timeout'])
+        if timeout <= 0:
+            raise ValueError(f'Timeout for phase {phase["name"]} must be positive')
+        timeouts.append(timeout)
+        next_index = index(phase.get('next'))
+        table = []
+        for exit_ in phase.get('exits', []):
+            if isinstance(exit_, str):
+                exit_ = {'when': exit_}
+            value, op, threshold = parse_condition(exit_['when'])
+            target = index(exit_['next']) if 'next' in exit_ else next_index
+            table.append((value, op, threshold, target, exit_['when']))
+        # the timeout is just the last row of the table
+        table.append((TIME_IN_MODE, operator.ge, timeout, next_index, 'timeout'))
+        transitions.append(tuple(table))
+
+    recipe = Recipe(config, names, tuple(phase['mode'] for phase in phases),
+                    tuple(phase.get('target') for phase in phases),
+                    tuple(relays), tuple(timeouts), tuple(transitions))
+    if interlocks is not None:
+        check_interlocks(recipe, interlocks)
+    return recipe
+
+
+def entry_states(recipe):
+    # {phase: {relay: on}} with the relays known to be in that state whenever
+    # the phase starts.  Relays a phase doesn't switch carry over from the one
+    # before, so this follows every transition; the cycle starts with nothing
+    # known, since the idle loop and the previous cycle may have left anything on.
+    entry = {recipe.start: {}}
+    pending = [recipe.start]
+    while pending:
+        state = pending.pop()
+        after = dict(entry[state])
+        after.update(recipe.relays[state])
+        for _, _, _, next_state, _ in recipe.transitions[state]:
+            if next_state == DONE:
+                continue
+            if next_state in entry:
+                merged = {relay: on for relay, on in entry[next_state].items() if after.get(relay) == on}
+                if merged == entry[next_state]:
+                    continue
+                entry[next_state] = merged
+            else:
+                entry[next_state] = after
+            pending.append(next_state)
+    return entry
+
+
+def check_interlocks(recipe, interlocks):
+    # reject a recipe whose phase changes the interlocks can't plan, e.g. hot
+    # gas switched on while the condenser fan may still be on from the phase
+    # before, at load time rather than mid cycle
+    entry = entry_states(recipe)
+    for state, name in enumerate(recipe.names):
+        try:
+            interlocks.check_settings(entry.get(state, {}), recipe.relays[state])
+        except ValueError as error:
+            raise ValueError(f'Phase {name}: {error}')
+
+
+def load_config(path):
+    # settings from the file on top of the defaults
+    config = dict(DEFAULT_CONFIG)
+    with open(path) as f:
+        config.update(json.load(f))
+    return config
+
+
+def validate_config(config):
+    # every known setting must have the right type; phases are checked by compile_recipe
+    for key, default in DEFAULT_CONFIG.items():
+        value = config.get(key)
+        if isinstance(default, bool):
+            if not isinstance(value, bool):
+                raise ValueError(f'{key} must be true or false, got {value!r}')
+        elif isinstance(default, str):
+            if not isinstance(value, str):
+                raise ValueError(f'{key} must be a string, got {value!r}')
+            if key == 'profiler' and value not in ('cprofile', 'sample'):
+                raise ValueError(f'profiler must be cprofile or sample, got {value!r}')
+        elif key == 'log_levels':
+            check_levels(value)
+        elif isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f'{key} must be a number, got {value!r}')
+        elif key.endswith(('_time', '_timeout')) and value <= 0:
+            raise ValueError(f'{key} must be positive, got {value!r}')
+
+
+class ConfigWatcher():
+    # Cheap change detection for the config file: one stat() per poll, the file
+    # is only read & parsed when its mtime or size changes.
+    def __init__(self, path, logger=None):
+        self.path = path
+        self.logger = logger or logging.getLogger()
+        self.stamp = self._stamp()
+
+    def _stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def poll(self):
+        # the new config if the file changed since the last poll, otherwise None
+        stamp = self._stamp()
+        if stamp is None or stamp == self.stamp:
+            return None
+        self.stamp = stamp
+        try:
+            return load_config(self.path)
+        except (OSError, ValueError) as error:
+            # most likely caught mid-save; the finished write changes the mtime again
+            self.logger.error(f'Could not read {self.path}: {error}')
+            return None
+
+
+class CycleEngine():
+    # Runs one ice making cycle from ice_maker.recipe.  A reloaded recipe is
+    # picked up at the next phase boundary.
+
+    def __init__(self, ice_maker):
+        self.ice_maker = ice_maker
+        self.state = DONE
+        self.release = None
+        self.curve = None
+        self.flagged = False
+
+    def enter(self, recipe, state, elapsed=0.0):
+        # elapsed: seconds already spent in the phase before a restart
+        im = self.ice_maker
+        self.state = state
+        im.mode = recipe.modes[state]
+        im.plate_target = recipe.targets[state]
+        im.logger.info('\tStarting %s phase (%s), target %s °F, timeout %s min.', recipe.names[state], im.mode, im.plate_target,
+                       recipe.timeouts[state])
+        if elapsed:
+            im.logger.info('\tResuming %s %.1f minutes in.', recipe.names[state], elapsed / im.MIN)
+        # the phase clock starts once the relays are on, so an interlock wait
+        # (compressor min off time) doesn't eat into the phase timeout
+        im.apply_relays(recipe.relays[state], True)
+        im.mode_start_time = im.clock.monotonic() - elapsed
+        im.time_in_mode = elapsed
+        self.release = im.release_detector()
+        # a custom phase may have no target, which leaves nothing to predict
+        self.curve = im.cooling_curve(im.plate_target) if im.mode == 'ICE' and im.plate_target is not None else None
+        self.flagged = False
+        im.instruments.phase_started(recipe.names[state], im.mode_start_time)
+        im.save_checkpoint(recipe.names[state])
+
+    def evaluate(self, recipe, state):
+        # one control tick: read, log and walk the transition table; returns the next phase or None
+        im = self.ice_maker
+        now = im.clock.monotonic()
+        im.time_in_mode = now - im.mode_start_time
+        im.time_in_cycle = now - im.cycle_start_time
+        im.read_sensors()
+        im.log_data()
+        released = self.release.update(im.time_in_mode, im.plate_temp)
+        predicted_end = math.nan
+        if self.curve is not None:
+            self.curve.update(im.time_in_mode, im.plate_temp)
+            if self.curve.predicted_end is not None:
+                predicted_end = self.curve.predicted_end / im.MIN
+            if not self.flagged and self.curve.unreachable(recipe.timeouts[state] * im.config['ice_predict_margin'] * im.MIN):
+                self.flagged = True
+                im.unreachable_count += 1
+                im.logger.warning(f'\t{recipe.names[state]} cannot reach {im.plate_target} °F before the timeout '
+                                  f'(plate {im.plate_temp:.2f} °F, predicted at {predicted_end:.1f} min).')
+        # minutes rounded so a wake exactly at the timeout compares equal
+        values = (im.plate_temp, im.bin_temp, round(im.time_in_mode / im.MIN, 9),
+                  self.release.slope, float(released), predicted_end)
+        for value, op, threshold, next_state, description in recipe.transitions[state]:
+            if op(values[value], threshold):
+                self.exit(recipe, state, description)
+                return next_state
+        return None
+
+    def exit(self, recipe, state, description):
+        im = self.ice_maker
+        if description.startswith('predicted_end'):
+            im.logger.warning(f'\tEnding {recipe.names[state]} early, target out of reach.')
+        elif description == 'timeout':
+            im.logger.info('\t%s timed out after %.02f minutes.', recipe.names[state], recipe.timeouts[state])
+        else:
+            im.logger.info('\t\tCurrent Temp: %.2f °F.  Reached %s exit (%s)!', im.plate_temp, recipe.names[state], description)
+        if recipe.modes[state] == 'ICE':
+            im.last_batch = im.clock.monotonic()
+
+    def wake_at(self, recipe, state):
+        # latest time the phase loop may sleep to: the timeout, or the predicted
+        # end of an ICE phase if that comes first
+        im = self.ice_maker
+        wake = im.mode_start_time + recipe.timeouts[state] * im.MIN
+        if self.curve is not None and self.curve.predicted_end is not None:
+            predicted = im.mode_start_time + self.curve.predicted_end
+            # once past it, the regular ticks take over again
+            if predicted > im.clock.monotonic() + im.scheduler.tolerance:
+                wake = min(wake, predicted)
+        return wake
+
+    def start_cycle(self):
+        im = self.ice_maker
+        im.reload_config()
+        im.cycle_start_time = im.clock.monotonic()
+        return im.recipe
+
+    def boundary(self, recipe, state):
+        # between phases: switch to a reloaded recipe, continuing at the phase with the same name
+        im = self.ice_maker
+        if state == DONE or not im.reload_config():
+            return recipe, state
+        name = recipe.names[state]
+        if name not in im.recipe.names:
+            im.logger.warning(f'Phase {name} is not in the reloaded recipe, finishing this cycle on the old one.')
+            return recipe, state
+        new_state = im.recipe.names.index(name)
+        try:
+            # the reloaded recipe was checked from its own phases, not from the relays the old one left on
+            im.interlocks.check_settings(im.relay_bank.state(), im.recipe.relays[new_state])
+        except ValueError as error:
+            im.logger.warning(f'Phase {name} of the reloaded recipe can\'t start from the relays as they are ({error}), '
+                              f'finishing this cycle on the old one.')
+            return recipe, state
+        return im.recipe, new_state
+
+    def finish_cycle(self):
+        im = self.ice_maker
+        self.state = DONE
+        im.cycle_finish_time = im.clock.monotonic()
+        im.cycle_count += 1
+        im.stats.add('batches')
+        # the time until the next cycle starts is the idle phase
+        im.instruments.phase_started('idle')
+        im.save_checkpoint()
+        im.publish_status()
+        im.logger.info('Cycle Count: %d', im.cycle_count)
+
+    def run_cycle(self, resume=None):
+        # resume: (phase, seconds into it, seconds into the cycle) to pick up where a restart left off
+        im = self.ice_maker
+        recipe = self.start_cycle()
+        wait_time = im.MIN / 12.0
+        state = recipe.start
+        elapsed = 0.0
+        if resume is not None and resume[0] in recipe.names:
+            state = recipe.names.index(resume[0])
+            elapsed = resume[1]
+            im.cycle_start_time -= resume[2]
+        while state != DONE:
+            self.enter(recipe, state, elapsed)
+            elapsed = 0.0
+            ticker = im.scheduler.add_task(recipe.names[state], wait_time, start=im.clock.monotonic())
+            try:
+                next_state = self.evaluate(recipe, state)
+                while next_state is None:
+                    im.scheduler.wait(ticker, until=self.wake_at(recipe, state))
+                    next_state = self.evaluate(recipe, state)
+            finally:
+                im.scheduler.remove_task(ticker)
+            recipe, state = self.boundary(recipe, next_state)
+        self.finish_cycle()
@@ -0,0 +1,77 @@
+# Relay outputs with a shadow copy of their state.
+#
+# The bank remembers what every relay was last set to as a bitmask, so the
+# current state never has to be read back from the hardware, and a command
+# that doesn't change anything doesn't touch a pin.  apply() takes a whole
+# set of (relay, on) settings and writes every pin that actually changes in
+# one GPIO.output() call, in the order given (e.g. offs before ons).
+#
+# Relays are active low: 0 on the pin switches the relay on.
+#
+# With a clock, the bank also records when each relay last switched, for the
+# interlocks (see interlocks.py).
+#
+# Since nothing reads the pins back in normal running, mismatched() does it on
+# purpose for a watchdog: a pin that was changed behind the bank's back (a
+# glitch, another process) is found and reassert() puts it back.
+
+
+class RelayBank():
+    def __init__(self, gpio, pins, clock=None):
+        self.gpio = gpio
+        self.clock = clock
+        # relay name -> BCM pin
+        self.pins = pins
+        # bit i is relay i in pins order, set while the relay is on
+        self.bits = {relay: 1 << bit for bit, relay in enumerate(pins)}
+        self.mask = 0
+        # monotonic time of each relay's last switch, unknown counts as long ago
+        self.changed_at = dict.fromkeys(pins, float('-inf'))
+        # pin writes actually issued
+        self.writes = 0
+        # pins found out of step with the shadow state and rewritten
+        self.repairs = 0
+
+    def is_on(self, relay):
+        return bool(self.mask & self.bits[relay])
+
+    def state(self):
+        return {relay: bool(self.mask & bit) for relay, bit in self.bits.items()}
+
+    def apply(self, settings, force=False):
+        # switch relays to the given (relay, on) settings in one batch; force also
+        # rewrites pins the shadow says are already right.  Returns the
+        # (relay, on) pairs that changed.
+        mask = self.mask
+        changes = {}
+        for relay, on in settings:
+            bit = self.bits[relay]
+            mask = mask | bit if on else mask & ~bit
+            changes[relay] = on
+        if not force:
+            changes = {relay: on for relay, on in changes.items() if bool(self.mask & self.bits[relay]) != on}
+        if changes:
+            self.gpio.output([self.pins[relay] for relay in changes], [0 if on else 1 for on in changes.values()])
+            self.writes += len(changes)
+        changed = [(relay, on) for relay, on in changes.items() if bool(self.mask & self.bits[relay]) != on]
+        self.mask = mask
+        if self.clock is not None:
+            now = self.clock.monotonic()
+            for relay, _ in changed:
+                self.changed_at[relay] = now
+        return changed
+
+    def all_off(self, force=True):
+        # every relay off; forced by default since this is the shutdown path
+        return self.apply(((relay, False) for relay in self.pins), force=force)
+
+    def mismatched(self):
+        # relays whose pin doesn't read back what the shadow state says
+        return [relay for relay, pin in self.pins.items() if (self.gpio.input(pin) == 0) != self.is_on(relay)]
+
+    def reassert(self, relays):
+        # rewrite the given relays' pins from the shadow state; nothing changes
+        # as far as the bank is concerned, so switch times are left alone
+        relays = list(relays)
+        self.apply(((relay, self.is_on(relay)) for relay in relays), force=True)
+        self.repairs += len(relays)
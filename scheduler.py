@@ -0,0 +1,135 @@
+import logging
+import time
+
+from instrument import Timer
+
+# Drift-free tick scheduling.
+#
+# Every periodic task keeps an absolute monotonic deadline that advances by
+# exactly one period per tick, so the time spent reading sensors, logging or
+# driving relays inside a tick never pushes the schedule back.  A tick that is
+# missed entirely is counted as an overrun and skipped rather than bunched up.
+#
+# Tasks with a callback (logging, watchdogs, stats flushes...) are run by the
+# scheduler whenever a phase loop waits on it.  An exception from a callback is
+# logged and counted, and the task runs again next period.  Tasks without a callback are
+# plain tickers that a loop waits on with wait().
+
+
+class Task():
+    def __init__(self, name, period, callback, deadline):
+        self.name = name
+        self.period = period
+        self.callback = callback
+        self.deadline = deadline
+        self.runs = 0
+        self.overruns = 0
+        self.failures = 0
+        self.max_lateness = 0.0
+
+    def stats(self):
+        return {'period': self.period, 'runs': self.runs, 'overruns': self.overruns,
+                'failures': self.failures, 'max_lateness': self.max_lateness}
+
+
+class Timeline():
+    # Sequential delays measured from the end of the previous delay rather than
+    # from whenever the caller got around to sleeping again, e.g.
+    #   timeline.sleep(20); do_a(); timeline.sleep(15 * 60); do_b()
+    # fires do_b exactly 15m20s after the first call.
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.target = None
+        self.overruns = 0
+
+    def reset(self):
+        self.target = self.scheduler.clock.monotonic()
+
+    def sleep(self, seconds):
+        if self.target is None:
+            self.reset()
+        self.target += seconds
+        lateness = self.scheduler.sleep_until(self.target)
+        if lateness > self.scheduler.tolerance:
+            # we were already past the target, start measuring from now
+            self.overruns += 1
+            self.scheduler.logger.warning('Timeline overran by %.2f seconds', lateness)
+            self.reset()
+
+
+class Scheduler():
+    # tolerance: lateness (seconds) that still counts as on time
+    def __init__(self, clock=time, logger=None, tolerance=0.05):
+        self.clock = clock
+        self.logger = logger or logging.getLogger()
+        self.tolerance = tolerance
+        self.tasks = []
+        # wall time spent sleeping, see instrument.py
+        self.sleep_timer = Timer()
+
+    def add_task(self, name, period, callback=None, start=None):
+        start = self.clock.monotonic() if start is None else start
+        task = Task(name, period, callback, start + period)
+        self.tasks.append(task)
+        return task
+
+    def remove_task(self, task):
+        if task in self.tasks:
+            self.tasks.remove(task)
+
+    def timeline(self):
+        return Timeline(self)
+
+    def _advance(self, task, now):
+        lateness = now - task.deadline
+        task.runs += 1
+        task.max_lateness = max(task.max_lateness, lateness)
+        task.deadline += task.period
+        if task.deadline <= now:
+            # missed one or more whole ticks, skip them
+            missed = int((now - task.deadline) // task.period) + 1
+            task.deadline += missed * task.period
+            task.overruns += 1
+            self.logger.warning('%s overran by %.2f seconds, skipped %d tick(s)', task.name, lateness, missed)
+
+    def run_due(self):
+        for task in list(self.tasks):
+            if task.callback is not None and task.deadline <= self.clock.monotonic():
+                try:
+                    task.callback()
+                except Exception:
+                    # a failing housekeeping task mustn't take the control loop down with it
+                    task.failures += 1
+                    self.logger.exception('%s failed', task.name)
+                self._advance(task, self.clock.monotonic())
+
+    def next_due(self):
+        # deadline of the next background task, None if there are none
+        return min((task.deadline for task in self.tasks if task.callback is not None), default=None)
+
+    def sleep_until(self, deadline):
+        # run background tasks as they come due until the deadline, returns how late we woke
+        while True:
+            self.run_due()
+            now = self.clock.monotonic()
+            if now >= deadline:
+                return now - deadline
+            due = self.next_due()
+            wake = deadline if due is None else min(deadline, due)
+            start = time.perf_counter()
+            self.clock.sleep(wake - now)
+            self.sleep_timer.add(time.perf_counter() - start)
+
+    def sleep(self, seconds):
+        return self.sleep_until(self.clock.monotonic() + seconds)
+
+    def wait(self, task, until=None):
+        # block until the task's next tick, or until `until` (e.g. a phase timeout) if sooner
+        target = task.deadline if until is None else min(task.deadline, until)
+        self.sleep_until(target)
+        now = self.clock.monotonic()
+        if now >= task.deadline:
+            self._advance(task, now)
+
+    def report(self):
+        return {task.name: task.stats() for task in self.tasks}
@@ -0,0 +1,282 @@
+import logging
+import math
+import statistics
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from instrument import Timer
+
+# One set of readings taken together on a control tick.
+#   timestamp: monotonic time the conversions were started
+#   values: {sensor name: temperature}
+#   duration: seconds spent waiting on the bus for the whole set
+#   errors: {sensor name: exception} for the reads that failed
+SensorSnapshot = namedtuple('SensorSnapshot', ['timestamp', 'values', 'duration', 'errors'], defaults=({},))
+
+# health is a moving average of read outcomes, 1 for a good read and 0 for a
+# failed or rejected one; warn below HEALTH_WARN, all clear again above HEALTH_OK
+HEALTH_WEIGHT = 0.1
+HEALTH_WARN = 0.5
+HEALTH_OK = 0.9
+
+# Latest cached value of one sensor and the monotonic time it was taken.
+Sample = namedtuple('Sample', ['value', 'timestamp'])
+
+
+class StaleReadingError(RuntimeError):
+    # raised when the cache has no reading for a sensor newer than its staleness limit
+    def __init__(self, name, age):
+        self.name = name
+        self.age = age
+        super().__init__(f'No fresh reading for {name} sensor (last sample {age:.1f} s old)')
+
+
+class SensorReader():
+    # Reads a group of 1-Wire sensors concurrently.
+    #
+    # Each DS18B20 conversion blocks for up to ~750 ms, but the w1_therm driver
+    # releases the bus master while a conversion is in progress, so issuing the
+    # reads from separate threads lets every sensor convert at the same time.
+    # A tick then costs one conversion time instead of the sum of all of them.
+    #
+    # A read that raises goes into the snapshot's errors rather than failing the
+    # whole set.  With threads, a read still running after timeout seconds is
+    # given up on; its worker is left to finish it, and the sensor is reported
+    # busy until it has.
+    #
+    # sensors is a dict of {name: zero argument function returning a temperature}
+
+    def __init__(self, sensors, clock=time, parallel=True):
+        self.sensors = dict(sensors)
+        self.clock = clock
+        self.executor = None
+        # the last read submitted for each sensor
+        self.pending = {}
+        if parallel:
+            self.executor = ThreadPoolExecutor(max_workers=len(self.sensors),
+                                               thread_name_prefix='w1-read')
+
+    def read(self, names=None, timeout=None):
+        names = list(self.sensors) if names is None else list(names)
+        start = self.clock.monotonic()
+        values = {}
+        errors = {}
+        if self.executor is None:
+            for name in names:
+                try:
+                    values[name] = self.sensors[name]()
+                except Exception as error:
+                    errors[name] = error
+            return SensorSnapshot(start, values, self.clock.monotonic() - start, errors)
+        futures = []
+        for name in names:
+            if name in self.pending and not self.pending[name].done():
+                # don't queue another read behind a hung one
+                errors[name] = TimeoutError(f'{name} sensor still busy with an earlier read')
+                continue
+            self.pending[name] = self.executor.submit(self.sensors[name])
+            futures.append((name, self.pending[name]))
+        for name, future in futures:
+            remaining = None if timeout is None else max(0.0, start + timeout - self.clock.monotonic())
+            try:
+                # result() re-raises any read error in the calling thread
+                values[name] = future.result(remaining)
+            except FutureTimeoutError:
+                errors[name] = TimeoutError(f'no reading from {name} sensor within {timeout} s')
+            except Exception as error:
+                errors[name] = error
+        return SensorSnapshot(start, values, self.clock.monotonic() - start, errors)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+
+class SensorFilter():
+    # Screens the raw readings of one sensor before they reach the cache.
+    #   - not a number, or outside valid_range (a DS18B20's own range by
+    #     default): rejected
+    #   - the DS18B20 power-on reset value, 85 °C: rejected, the sensor lost
+    #     power and hasn't converted since
+    #   - further from the median of the last window good readings than
+    #     max_jump, plus max_rate for every second since the middle one:
+    #     rejected as a spike.  After window spikes in a row the temperature
+    #     really has moved, and the history starts over from there.
+    # The median only judges readings; a good reading goes to the cache as it
+    # is, so filtering adds no lag.
+
+    def __init__(self, valid_range=(-67.0, 257.0), window=5, max_jump=10.0, max_rate=2.0, reset_value=185.0):
+        self.valid_range = valid_range
+        self.window = window
+        self.max_jump = max_jump
+        self.max_rate = max_rate
+        self.reset_value = reset_value
+        # (timestamp, value) of the latest good readings
+        self.history = deque(maxlen=window)
+        self.spikes = 0
+
+    def check(self, value, timestamp):
+        # None for a good reading, otherwise why it was rejected
+        low, high = self.valid_range
+        if not isinstance(value, (int, float)) or not math.isfinite(value) or not low <= value <= high:
+            return f'reading {value!r} out of range'
+        if self.reset_value is not None and abs(value - self.reset_value) < 0.01:
+            return 'power-on reset value'
+        if len(self.history) >= 3:
+            median = statistics.median(reading for _, reading in self.history)
+            allowed = self.max_jump + self.max_rate * (timestamp - self.history[len(self.history) // 2][0])
+            if abs(value - median) > allowed:
+                self.spikes += 1
+                if self.spikes < self.window:
+                    return f'spike, {value:.2f} is {value - median:+.1f} from the median'
+                self.history.clear()
+        self.spikes = 0
+        self.history.append((timestamp, value))
+        return None
+
+
+class SensorSampler():
+    # Polls each sensor at its own rate and publishes the latest value into a
+    # shared cache, so control code reads temperatures from memory instead of
+    # blocking on the bus.
+    #
+    # The cache is a plain dict of immutable Sample tuples.  The sampler thread
+    # is the only writer and replaces a whole entry with a single assignment,
+    # which is atomic under the GIL, so readers never need to take a lock.
+    #
+    # If nothing else is polling (no background thread, e.g. under a simulated
+    # clock) get() polls whichever sensors are due before returning, so the
+    # sampler behaves the same, just in the caller's thread.  Code that drives
+    # poll() itself, like the asyncio runtime, clears inline_polling.
+    #
+    # Every reading goes through a SensorFilter.  A read that fails or is
+    # rejected is retried up to retries times, as long as the retry can still
+    # finish within deadline seconds of the first attempt; if none succeeds
+    # the cache keeps the previous reading, so a glitch costs one tick, and
+    # only a sensor that keeps failing goes stale.  health has a 0-1 score per
+    # sensor from the recent reads.
+    #
+    # periods is {name: seconds between reads}.  max_age is {name: seconds},
+    # defaulting to three missed reads plus a conversion time.  filters is
+    # {name: SensorFilter}, defaulting to SensorFilter().
+
+    def __init__(self, reader, periods, max_age=None, clock=time, logger=None, filters=None, retries=1, deadline=2.0):
+        self.reader = reader
+        self.periods = dict(periods)
+        self.max_age = {name: 3 * period + 2 for name, period in self.periods.items()}
+        self.max_age.update(max_age or {})
+        self.clock = clock
+        self.logger = logger or logging.getLogger()
+        self.cache = {}
+        self.next_due = {name: 0 for name in self.periods}
+        self.error_count = {name: 0 for name in self.periods}
+        self.filters = {name: SensorFilter() for name in self.periods}
+        self.filters.update(filters or {})
+        self.retries = retries
+        self.deadline = deadline
+        self.health = {name: 1.0 for name in self.periods}
+        # time spent on the bus, see instrument.py
+        self.read_timer = Timer()
+        # sensors whose health has been warned about
+        self.unhealthy = set()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.inline_polling = True
+        # set once the cache has been filled, see start()
+        self.primed = threading.Event()
+        self.primed.set()
+
+    def poll(self):
+        # read every sensor that is due, concurrently, and publish the good readings
+        now = self.clock.monotonic()
+        due = [name for name, due_time in self.next_due.items() if due_time <= now]
+        if not due:
+            return
+        for name in due:
+            self.next_due[name] += self.periods[name]
+            if self.next_due[name] <= now:
+                # no catch-up bursts: a late read restarts the schedule from now
+                self.next_due[name] = now + self.periods[name]
+        for attempt in range(self.retries + 1):
+            snapshot = self.reader.read(due, self.deadline)
+            self.read_timer.add(snapshot.duration)
+            failed = {name: repr(error) for name, error in snapshot.errors.items()}
+            for name, value in snapshot.values.items():
+                reason = self.filters[name].check(value, snapshot.timestamp)
+                if reason is None:
+                    self.cache[name] = Sample(value, snapshot.timestamp)
+                    self.score(name, True)
+                else:
+                    failed[name] = reason
+            # another attempt takes about as long as this one did
+            retry = attempt < self.retries and self.clock.monotonic() + snapshot.duration <= now + self.deadline
+            for name, reason in failed.items():
+                self.error_count[name] += 1
+                self.score(name, False)
+                self.logger.warning('Bad read of %s sensor (%s), %s', name, reason,
+                                    'retrying.' if retry else 'keeping the last reading.')
+            if not failed or not retry:
+                return
+            due = list(failed)
+
+    def score(self, name, good):
+        health = self.health[name] = self.health[name] + HEALTH_WEIGHT * (good - self.health[name])
+        if health < HEALTH_WARN and name not in self.unhealthy:
+            self.unhealthy.add(name)
+            self.logger.warning(f'{name} sensor health down to {health:.2f}, {self.error_count[name]} bad reads so far.')
+        elif health > HEALTH_OK and name in self.unhealthy:
+            self.unhealthy.discard(name)
+            self.logger.info(f'{name} sensor health back up to {health:.2f}.')
+
+    def get(self, name):
+        if self.inline_polling:
+            self.poll()
+        elif not self.primed.is_set():
+            self.primed.wait()
+        sample = self.cache.get(name)
+        age = float('inf') if sample is None else self.clock.monotonic() - sample.timestamp
+        if age > self.max_age[name]:
+            raise StaleReadingError(name, age)
+        return sample.value
+
+    def snapshot(self, names=None):
+        names = list(self.periods) if names is None else list(names)
+        start = self.clock.monotonic()
+        values = {name: self.get(name) for name in names}
+        timestamp = min(self.cache[name].timestamp for name in names)
+        return SensorSnapshot(timestamp, values, self.clock.monotonic() - start)
+
+    def start(self, prime=True):
+        # fill the cache before anyone reads from it; without prime the first
+        # reads happen on the thread, so startup doesn't wait for a conversion,
+        # and get() waits for them instead
+        if self.thread is not None:
+            return
+        self.primed.clear()
+        if prime:
+            self.poll()
+            self.primed.set()
+        self.stop_event.clear()
+        self.inline_polling = False
+        self.thread = threading.Thread(target=self._run, name='sensor-sampler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        self.inline_polling = True
+        self.primed.set()
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            self.poll()
+            self.primed.set()
+            wait_time = min(self.next_due.values()) - self.clock.monotonic()
+            self.stop_event.wait(max(0, wait_time))
@@ -0,0 +1,277 @@
+import argparse
+import logging
+import math
+import time
+
+from logsetup import flush_logging
+
+# Simulated hardware backend: a virtual clock, a fake GPIO relay bank and a
+# lumped thermal model of the plate, water reservoir and ice bin driven by the
+# relay states.  Time only moves when the controller sleeps, so a full
+# prechill/ice/harvest/rechill cycle runs in milliseconds on any machine.
+#
+# Temperatures are °F, times are seconds, ice is pounds.
+
+
+class SimClock():
+    # virtual monotonic clock; sleep() advances time and steps anything listening
+    def __init__(self, start=0.0):
+        self.now = start
+        self.listeners = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        if seconds <= 0:
+            return
+        self.now += seconds
+        for listener in self.listeners:
+            listener(seconds)
+
+
+class SimGPIO():
+    # stand-in for RPi.GPIO; relays are active low, same as the real board
+    BCM = 'BCM'
+    BOARD = 'BOARD'
+    OUT = 'OUT'
+    IN = 'IN'
+    HIGH = 1
+    LOW = 0
+
+    def __init__(self):
+        self.mode = None
+        self.pins = {}
+        self.write_count = 0
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, channel, direction, initial=HIGH):
+        self.pins[channel] = initial
+
+    def output(self, channel, value):
+        # RPi.GPIO accepts a list of channels with a single value or a list of values
+        if isinstance(channel, (list, tuple)):
+            values = value if isinstance(value, (list, tuple)) else [value] * len(channel)
+            for pin, pin_value in zip(channel, values):
+                self.output(pin, pin_value)
+            return
+        self.pins[channel] = int(value)
+        self.write_count += 1
+
+    def input(self, channel):
+        return self.pins[channel]
+
+    def cleanup(self):
+        self.pins = {}
+
+
+DEFAULT_PARAMS = {
+    'ambient_temp': 75.0,
+    # refrigeration pulls the plate toward the evaporator temperature
+    'evaporator_temp': -15.0,
+    'k_cool': 0.0055,
+    # without the condenser fan the compressors only manage a fraction of their capacity
+    'no_fan_capacity': 0.3,
+    # hot gas pulls the plate toward the discharge temperature
+    'hot_gas_temp': 120.0,
+    'k_hot': 0.012,
+    'k_plate_ambient': 0.0004,
+    # recirculating water over the plate; ice on the plate insulates it
+    'k_water': 0.006,
+    'ice_insulation': 1.0,
+    'tap_water_temp': 55.0,
+    'k_fill': 0.05,
+    'k_water_plate': 0.01,
+    # lb of ice formed per second per °F the plate is below freezing
+    'k_freeze': 0.00015,
+    # lb of ice melted per second per °F of hot gas drive while the slab is attached
+    'k_melt': 0.00002,
+    # the slab lets go once this fraction of it has melted at the plate
+    'release_fraction': 0.05,
+    # bin
+    'bin_capacity': 10.0,
+    'bin_ice_temp': 30.0,
+    'k_bin_ambient': 0.0001,
+    'k_bin_ice': 0.002,
+    'k_bin_melt': 0.00002,
+    'ice_usage': 2.0 / 3600,
+    # electrical
+    'compressor_watts': 400.0,
+    'fan_watts': 40.0,
+    'pump_watts': 30.0,
+}
+
+
+class ThermalModel():
+    # Relay driven first order model.  Each term pulls a temperature toward a
+    # target with a rate constant, and every step is integrated exactly
+    # (exponential decay toward the combined equilibrium), so it is stable
+    # for any step size.
+
+    def __init__(self, gpio, relays, params=None, plate_temp=None, bin_temp=None):
+        self.gpio = gpio
+        self.relays = relays
+        self.params = dict(DEFAULT_PARAMS)
+        self.params.update(params or {})
+        ambient = self.params['ambient_temp']
+        self.plate_temp = ambient if plate_temp is None else plate_temp
+        self.bin_temp = ambient if bin_temp is None else bin_temp
+        self.water_temp = self.params['tap_water_temp']
+        self.plate_ice = 0.0
+        self.melted = 0.0
+        self.bin_ice = 0.0
+        self.harvested_ice = 0.0
+        self.harvest_count = 0
+        self.energy_wh = 0.0
+        self.compressor_time = 0.0
+
+    def relay_on(self, name):
+        pin = self.relays.get(name)
+        return pin is not None and self.gpio.pins.get(pin) == 0
+
+    def step(self, dt):
+        # long sleeps are split so the relay driven terms stay piecewise constant enough
+        while dt > 0:
+            sub_dt = min(dt, 5.0)
+            self._step(sub_dt)
+            dt -= sub_dt
+
+    def _step(self, dt):
+        p = self.params
+        compressor = self.relay_on('compressor_1') or self.relay_on('compressor_2')
+        hot_gas = self.relay_on('hot_gas_solenoid')
+        fan = self.relay_on('condenser_fan')
+        pump = self.relay_on('recirculating_pump')
+        fill = self.relay_on('water_valve')
+
+        # plate: sum of (rate, target) terms
+        terms = [(p['k_plate_ambient'], p['ambient_temp'])]
+        if compressor and hot_gas:
+            terms.append((p['k_hot'], p['hot_gas_temp']))
+        elif compressor:
+            capacity = 1.0 if fan else p['no_fan_capacity']
+            terms.append((p['k_cool'] * capacity, p['evaporator_temp']))
+        if pump:
+            terms.append((p['k_water'] / (1 + self.plate_ice / p['ice_insulation']), self.water_temp))
+        k_total = sum(k for k, _ in terms)
+        equilibrium = sum(k * target for k, target in terms) / k_total
+        new_plate_temp = equilibrium + (self.plate_temp - equilibrium) * math.exp(-k_total * dt)
+
+        if self.plate_ice > 0 and new_plate_temp > 32:
+            # attached slab melts at the plate and holds it near freezing until it lets go
+            drive = max(0.0, equilibrium - 32)
+            self.melted += p['k_melt'] * drive * dt
+            new_plate_temp = 32 + 0.02 * drive
+            if self.melted >= p['release_fraction'] * self.plate_ice:
+                released = self.plate_ice - self.melted
+                self.bin_ice = min(p['bin_capacity'], self.bin_ice + released)
+                self.harvested_ice += released
+                self.harvest_count += 1
+                self.plate_ice = 0.0
+                self.melted = 0.0
+        elif pump and new_plate_temp < 32:
+            self.plate_ice += p['k_freeze'] * (32 - new_plate_temp) * dt
+        self.plate_temp = new_plate_temp
+
+        # reservoir water: tap water while filling, otherwise follows the plate down to freezing
+        if fill:
+            self.water_temp += (p['tap_water_temp'] - self.water_temp) * (1 - math.exp(-p['k_fill'] * dt))
+        elif pump:
+            target = max(32.0, self.plate_temp)
+            self.water_temp += (target - self.water_temp) * (1 - math.exp(-p['k_water_plate'] * dt))
+
+        # bin: warms toward ambient, held cold by the ice in it
+        ice_fraction = min(1.0, self.bin_ice / p['bin_capacity'])
+        k_bin = p['k_bin_ambient'] + p['k_bin_ice'] * ice_fraction
+        bin_equilibrium = (p['k_bin_ambient'] * p['ambient_temp'] + p['k_bin_ice'] * ice_fraction * p['bin_ice_temp']) / k_bin
+        self.bin_temp = bin_equilibrium + (self.bin_temp - bin_equilibrium) * math.exp(-k_bin * dt)
+        self.bin_ice = max(0.0, self.bin_ice - (p['ice_usage'] + p['k_bin_melt'] * max(0.0, p['ambient_temp'] - 32)) * dt)
+
+        watts = 0.0
+        if compressor:
+            watts += p['compressor_watts']
+            self.compressor_time += dt
+        if fan:
+            watts += p['fan_watts']
+        if pump:
+            watts += p['pump_watts']
+        self.energy_wh += watts * dt / 3600
+
+
+class SimSensor():
+    # conversion_time > 0 makes each read cost virtual time, like a real DS18B20
+    def __init__(self, model, name, sensor_id, clock=None, conversion_time=0.0):
+        self.model = model
+        self.name = name
+        self.id = sensor_id
+        self.clock = clock
+        self.conversion_time = conversion_time
+
+    def get_temperature(self):
+        if self.conversion_time:
+            self.clock.sleep(self.conversion_time)
+        return getattr(self.model, f'{self.name}_temp')
+
+
+class SimBackend():
+    # reads are just attribute lookups, threading them would only add overhead
+    parallel_reads = False
+    virtual_time = True
+
+    # machines sharing a clock (see fleet.py) all move through time together
+    def __init__(self, relays, params=None, plate_temp=None, bin_temp=None, conversion_time=0.0, clock=None):
+        self.conversion_time = conversion_time
+        self.gpio = SimGPIO()
+        self.clock = clock or SimClock()
+        self.model = ThermalModel(self.gpio, relays, params, plate_temp, bin_temp)
+        self.clock.listeners.append(self.model.step)
+        self.sensors = []
+
+    def temp_sensor(self, name, sensor_id):
+        sensor = SimSensor(self.model, name, sensor_id, self.clock, self.conversion_time)
+        self.sensors.append(sensor)
+        return sensor
+
+    def available_sensors(self):
+        return list(self.sensors)
+
+
+def load_params(path):
+    # ThermalModel parameters from a JSON file, either a plain {name: value}
+    # object or a model written by calibrate.py
+    import json
+    with open(path) as f:
+        data = json.load(f)
+    return data['params'] if isinstance(data.get('params'), dict) else data
+
+
+def simulated_ice_maker(params=None, config=None, **kwargs):
+    from mark_icemaker2 import IceMaker
+    return IceMaker(backend=SimBackend(IceMaker.relays, params, **kwargs), config=config)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run ice making cycles against the simulated backend.')
+    parser.add_argument('--cycles', type=int, default=10)
+    parser.add_argument('--model', help='JSON file of ThermalModel parameters, e.g. from calibrate.py')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    ice_maker = simulated_ice_maker(load_params(args.model) if args.model else None)
+    logging.getLogger().setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+    model = ice_maker.backend.model
+    wall_start = time.perf_counter()
+    ice_maker.power_on()
+    for _ in range(args.cycles):
+        ice_maker.run_cycle()
+    wall_time = time.perf_counter() - wall_start
+    sim_hours = ice_maker.clock.monotonic() / 3600
+    # the log thread may still be writing, let it finish before the summary
+    flush_logging()
+    print(f'{args.cycles} cycles in {sim_hours:.2f} simulated hours ({wall_time:.3f} s wall, {args.cycles / wall_time:.0f} cycles/s)')
+    print(f'Ice harvested: {model.harvested_ice:.2f} lb ({model.harvested_ice / sim_hours:.2f} lb/h), energy: {model.energy_wh / 1000:.3f} kWh')
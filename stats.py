@@ -0,0 +1,188 @@
+import json
+import logging
+import os
+import struct
+from collections import deque
+
+# Long term machine statistics that survive restarts.
+#
+# Counters are bumped in memory and written out by flush() as small binary
+# journal entries (counter, amount) appended to <path>.journal, so a flush
+# costs one short append and fsync instead of rewriting the whole file.  Once
+# the journal grows past journal_limit entries its totals are folded into the
+# JSON snapshot at <path>, which is replaced atomically.
+#
+# Snapshot and journal carry a generation number.  Compaction writes the
+# snapshot for generation n+1 first and only then starts a new journal, so a
+# journal whose generation doesn't match the snapshot is already included in
+# it and is skipped on load.  A power cut therefore loses at most the counts
+# since the last flush, and never double counts.  Write errors (a full or
+# read-only card) are logged and the counts kept pending until a write works.
+
+COUNTERS = (
+    # completed ice making cycles
+    'batches',
+    'compressor_starts',
+    # seconds with a compressor on, split into cooling (hot gas closed) & heating
+    'compressor_on_time',
+    'compressor_cooling_time',
+    'compressor_heating_time',
+    # hot gas solenoid openings while a compressor was running
+    'hot_gas_activations',
+    'water_fills',
+)
+
+JOURNAL_MAGIC = b'ICEJ'
+JOURNAL_HEADER = struct.Struct('<4sI')
+ENTRY = struct.Struct('<Bd')
+
+
+def write_atomic(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class StatsStore():
+    def __init__(self, path=None, journal_limit=1000, logger=None):
+        self.logger = logger or logging.getLogger()
+        self.journal_limit = journal_limit
+        self.values = dict.fromkeys(COUNTERS, 0)
+        self.pending = {}
+        self.generation = 0
+        self.journal_entries = 0
+        # set when the journal for this generation couldn't be started
+        self.journal_stale = False
+        self.path = None
+        if path is not None:
+            self.open(path)
+
+    def open(self, path):
+        # load the totals from path (and its journal) and persist to it from now on
+        self.path = path
+        self.journal_path = path + '.journal'
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+            self.generation = snapshot['generation']
+            for name, value in snapshot['counters'].items():
+                if name in self.values:
+                    self.values[name] = value
+        except FileNotFoundError:
+            pass
+        self._replay()
+
+    def _replay(self):
+        try:
+            with open(self.journal_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b''
+        if len(data) < JOURNAL_HEADER.size:
+            self._new_journal()
+            return
+        magic, generation = JOURNAL_HEADER.unpack_from(data)
+        if magic != JOURNAL_MAGIC or generation != self.generation:
+            # left over from before the last compaction, already in the snapshot
+            self._new_journal()
+            return
+        body = data[JOURNAL_HEADER.size:]
+        # a torn last entry from a power cut mid-append is dropped
+        whole = len(body) - len(body) % ENTRY.size
+        for index, amount in ENTRY.iter_unpack(body[:whole]):
+            if index < len(COUNTERS):
+                name = COUNTERS[index]
+                self.values[name] += amount if name.endswith('_time') else int(amount)
+        self.journal_entries = whole // ENTRY.size
+        if whole != len(body):
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(JOURNAL_HEADER.size + whole)
+
+    def _new_journal(self):
+        # returns False if the journal couldn't be written, flush() tries again
+        try:
+            write_atomic(self.journal_path, JOURNAL_HEADER.pack(JOURNAL_MAGIC, self.generation))
+        except OSError as error:
+            self.logger.error(f'Could not write {self.journal_path}: {error}')
+            self.journal_stale = True
+            return False
+        self.journal_stale = False
+        self.journal_entries = 0
+        return True
+
+    def add(self, name, amount=1):
+        self.values[name] += amount
+        self.pending[name] = self.pending.get(name, 0) + amount
+
+    def flush(self):
+        if self.path is None or not self.pending:
+            return
+        if self.journal_stale and not self._new_journal():
+            # entries appended to an older generation's journal would be skipped on load
+            return
+        entries = b''.join(ENTRY.pack(COUNTERS.index(name), amount) for name, amount in self.pending.items())
+        try:
+            with open(self.journal_path, 'ab') as f:
+                f.write(entries)
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as error:
+            # keep the counts pending and try again next time
+            self.logger.error(f'Could not write {self.journal_path}: {error}')
+            return
+        self.journal_entries += len(self.pending)
+        self.pending = {}
+        if self.journal_entries >= self.journal_limit:
+            self.compact()
+
+    def compact(self):
+        # fold the journal into a new snapshot
+        snapshot = {'generation': self.generation + 1, 'counters': self.values}
+        try:
+            write_atomic(self.path, json.dumps(snapshot, indent=4).encode())
+        except OSError as error:
+            # the journal still has every count, the next flush tries again
+            self.logger.error(f'Could not write {self.path}: {error}')
+            return
+        self.generation += 1
+        self._new_journal()
+
+
+class RelayUsage():
+    # Turns relay switching into StatsStore counts: compressor starts, hot gas
+    # & water fill activations, and compressor run time split into cooling and
+    # heating.  Fed the relay bitmask after every switch.
+    def __init__(self, stats, relay_bits, now):
+        self.stats = stats
+        self.compressors = relay_bits['compressor_1'] | relay_bits['compressor_2']
+        self.hot_gas = relay_bits['hot_gas_solenoid']
+        self.water_valve = relay_bits['water_valve']
+        self.mask = 0
+        self.since = now
+        # times of the most recent compressor starts, for starts-per-hour limits
+        self.starts = deque(maxlen=100)
+
+    def accrue(self, now):
+        # add the time spent in the current relay state up to now
+        if self.mask & self.compressors:
+            elapsed = now - self.since
+            self.stats.add('compressor_on_time', elapsed)
+            self.stats.add('compressor_heating_time' if self.mask & self.hot_gas else 'compressor_cooling_time', elapsed)
+        self.since = now
+
+    def update(self, mask, now):
+        if mask == self.mask:
+            return
+        self.accrue(now)
+        turned_on = mask & ~self.mask
+        if turned_on & self.compressors and not self.mask & self.compressors:
+            self.stats.add('compressor_starts')
+            self.starts.append(now)
+        if turned_on & self.hot_gas and mask & self.compressors:
+            self.stats.add('hot_gas_activations')
+        if turned_on & self.water_valve:
+            self.stats.add('water_fills')
+        self.mask = mask
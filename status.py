@@ -0,0 +1,184 @@
+import json
+import math
+import threading
+import time
+
+from telemetry import MODES
+
+# HTTP status endpoint.
+#
+#   GET /metrics   Prometheus text format
+#   GET /status    JSON (also /)
+#
+# One server can also publish several machines at once (fleet.py), with a
+# unit="<name>" label on every sample.
+#
+# The control loop calls publish() once per tick with values it already has,
+# which serializes both documents and swaps them in as one tuple.  Requests
+# are answered on the server's own threads from whatever tuple is current, so
+# a scrape never reads a sensor, takes a lock the control loop needs or
+# formats anything, however often dashboards poll.
+
+# (metric, status key, help) for the per-tick gauges
+GAUGES = (
+    ('icemaker_plate_temp_fahrenheit', 'plate_temp', 'Evaporator plate temperature.'),
+    ('icemaker_bin_temp_fahrenheit', 'bin_temp', 'Ice bin temperature.'),
+    ('icemaker_plate_target_fahrenheit', 'plate_target', 'Plate target of the current phase.'),
+    ('icemaker_time_in_mode_seconds', 'time_in_mode', 'Time spent in the current phase.'),
+    ('icemaker_time_in_cycle_seconds', 'time_in_cycle', 'Time spent in the current cycle.'),
+)
+
+
+def unit_status(ice_maker, now):
+    im = ice_maker
+    return {
+        'updated': now,
+        'uptime': im.clock.monotonic() - im.system_start_time,
+        'mode': im.mode,
+        'plate_target': im.plate_target,
+        'plate_temp': im.plate_temp,
+        'bin_temp': im.bin_temp,
+        'time_in_mode': im.time_in_mode,
+        'time_in_cycle': im.time_in_cycle,
+        'cycle_count': im.cycle_count,
+        'unreachable_count': im.unreachable_count,
+        'relays': im.relay_bank.state(),
+        'sensors': {name: {'health': health, 'bad_reads': im.sampler.error_count[name]}
+                    for name, health in im.sampler.health.items()},
+        'lifetime': dict(im.stats.values),
+        # see instrument.py; phase buckets are [upper bound s, cumulative count]
+        'timers': {name: {'count': timer.count, 'total_s': timer.total} for name, timer in im.instruments.timers.items()},
+        'phases': {name: {'count': phase.count, 'total_s': phase.total, 'buckets': phase.cumulative()}
+                   for name, phase in im.instruments.phases.items()},
+    }
+
+
+def unit_metrics(status):
+    # [(metric, type, help, [(labels, value), ...]), ...] for one unit's status;
+    # a histogram's samples are (labels, value, name suffix)
+    modes = MODES + ((status['mode'],) if status['mode'] not in MODES else ())
+    metrics = [(name, 'gauge', text, [({}, status[key])]) for name, key, text in GAUGES]
+    metrics += [
+        ('icemaker_mode', 'gauge', 'Current mode, 1 for the active one.',
+         [({'mode': mode}, status['mode'] == mode) for mode in modes]),
+        ('icemaker_relay_on', 'gauge', 'Relay state, 1 while on.',
+         [({'relay': relay}, on) for relay, on in status['relays'].items()]),
+        ('icemaker_sensor_health', 'gauge', 'Share of recent sensor reads that were good, 0 to 1.',
+         [({'sensor': sensor}, values['health']) for sensor, values in status['sensors'].items()]),
+        ('icemaker_sensor_bad_reads_total', 'counter', 'Sensor reads that failed or were rejected.',
+         [({'sensor': sensor}, values['bad_reads']) for sensor, values in status['sensors'].items()]),
+        ('icemaker_cycles_total', 'counter', 'Cycles finished since start.', [({}, status['cycle_count'])]),
+        ('icemaker_unreachable_total', 'counter', 'Ice phases predicted to miss their target.',
+         [({}, status['unreachable_count'])]),
+        ('icemaker_lifetime', 'counter', 'Lifetime counters from stats.json, seconds for the times.',
+         [({'counter': name}, value) for name, value in status['lifetime'].items()]),
+        ('icemaker_time_spent_seconds_total', 'counter', 'Wall time spent per part of the control loop.',
+         [({'part': name}, timer['total_s']) for name, timer in status['timers'].items()]),
+        ('icemaker_timed_calls_total', 'counter', 'Timed calls per part of the control loop.',
+         [({'part': name}, timer['count']) for name, timer in status['timers'].items()]),
+        ('icemaker_phase_duration_seconds', 'histogram', 'Phase durations across cycles, idle is between cycles.',
+         [sample for name, phase in status['phases'].items() for sample in phase_samples(name, phase)]),
+        ('icemaker_uptime_seconds', 'gauge', 'Time since the controller started.', [({}, status['uptime'])]),
+        ('icemaker_snapshot_timestamp_seconds', 'gauge', 'When this snapshot was taken.', [({}, status['updated'])]),
+    ]
+    return metrics
+
+
+def phase_samples(name, phase):
+    samples = [({'phase': name, 'le': bound}, count, '_bucket') for bound, count in phase['buckets']]
+    samples.append(({'phase': name, 'le': '+Inf'}, phase['count'], '_bucket'))
+    samples.append(({'phase': name}, phase['total_s'], '_sum'))
+    samples.append(({'phase': name}, phase['count'], '_count'))
+    return samples
+
+
+def render(units, now):
+    # (JSON bytes, Prometheus bytes) for [(name, ice_maker), ...]; a single
+    # unnamed machine gets a flat document, named ones a unit label each
+    statuses = [(name, unit_status(ice_maker, now)) for name, ice_maker in units]
+    if len(statuses) == 1 and statuses[0][0] is None:
+        document = statuses[0][1]
+    else:
+        document = {'updated': now, 'units': dict(statuses)}
+    metrics = {}
+    for name, status in statuses:
+        unit = {'unit': name} if name is not None else {}
+        for metric, kind, text, samples in unit_metrics(status):
+            entry = metrics.setdefault(metric, (kind, text, []))
+            entry[2].extend((dict(unit, **sample[0]),) + tuple(sample[1:]) for sample in samples)
+    lines = []
+    for metric, (kind, text, samples) in metrics.items():
+        lines.append(f'# HELP {metric} {text}')
+        lines.append(f'# TYPE {metric} {kind}')
+        for labels, value, *suffix in samples:
+            name = metric + (suffix[0] if suffix else '')
+            label_text = ','.join(f'{key}="{value}"' for key, value in labels.items())
+            value = float(value) if value is not None else math.nan
+            lines.append(f'{name}{{{label_text}}} {value!r}' if label_text else f'{name} {value!r}')
+    return json.dumps(document).encode(), ('\n'.join(lines) + '\n').encode()
+
+
+class StatusServer():
+    def __init__(self, port=8080, host='127.0.0.1'):
+        self.address = (host, port)
+        self.snapshot = (b'{}', b'')
+        self.server = None
+        self.thread = None
+        self.publishes = 0
+
+    def publish(self, ice_maker):
+        self.publish_units([(None, ice_maker)])
+
+    def publish_units(self, units):
+        # [(name, ice_maker), ...], e.g. all the machines of a fleet
+        self.snapshot = render(units, time.time())
+        self.publishes += 1
+
+    def start(self):
+        # http.server pulls in the email and ssl packages, so it's loaded when
+        # the server starts rather than with the controller
+        import http.server
+        status = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                body, kind = status.document(self.path)
+                if body is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', kind)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+
+            do_HEAD = do_GET
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(self.address, Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='status', daemon=True)
+        self.thread.start()
+        return self.server.server_address[1]
+
+    def document(self, path):
+        # (body, content type) for a request path, (None, None) if there's no such document
+        json_body, metrics = self.snapshot
+        path = path.split('?', 1)[0]
+        if path == '/metrics':
+            return metrics, 'text/plain; version=0.0.4; charset=utf-8'
+        if path in ('/', '/status'):
+            return json_body, 'application/json'
+        return None, None
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
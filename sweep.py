@@ -0,0 +1,141 @@
+import argparse
+import concurrent.futures
+import itertools
+import json
+import logging
+import os
+import sys
+
+from recipe import DEFAULT_CONFIG, load_config
+
+# Parameter sweep over the simulator.
+#
+# Every combination of the given settings runs the full controller (cycles
+# plus the bin-full idle loop) against simulator.SimBackend for a number of
+# simulated hours, spread over all cores with a process pool.  Results are
+# ranked by ice per hour, energy per lb or cycle time, and the winning
+# settings are written out as a complete config.json.
+#
+#   python sweep.py --set ice_target_temp=-4:0:1 --set harvest_threshold_temp=36,38,40
+#
+# A range is start:stop:step (stop included), a list is comma separated.
+# With --continuous the bin never counts as full, which measures what the
+# plate can produce rather than what the simulated demand takes.
+
+METRICS = {
+    # name: (result key, higher is better)
+    'ice': ('ice_per_hour', True),
+    'energy': ('wh_per_lb', False),
+    'cycle': ('cycle_minutes', False),
+}
+
+
+def parse_values(text):
+    if ':' in text:
+        start, stop, step = (float(part) for part in text.split(':'))
+        if step <= 0:
+            raise ValueError(f'Step must be positive: {text}')
+        count = int(round((stop - start) / step)) + 1
+        return [round(start + i * step, 6) for i in range(count)]
+    return [json.loads(part) for part in text.split(',')]
+
+
+def parse_settings(specs):
+    # ['name=values', ...] -> {name: [value, ...]}
+    grid = {}
+    for spec in specs:
+        name, _, values = spec.partition('=')
+        if name not in DEFAULT_CONFIG:
+            raise ValueError(f'Unknown setting: {name}')
+        grid[name] = parse_values(values)
+    return grid
+
+
+def simulate(config, hours, params=None, idle=True):
+    # run the controller on the simulator; returns the metrics for one configuration
+    from simulator import simulated_ice_maker
+    ice_maker = simulated_ice_maker(params, config)
+    logging.getLogger().setLevel(logging.ERROR)
+    model = ice_maker.backend.model
+    cycle_time = 0.0
+    ice_maker.power_on()
+    while ice_maker.clock.monotonic() < hours * 3600:
+        ice_maker.run_cycle()
+        cycle_time += ice_maker.cycle_finish_time - ice_maker.cycle_start_time
+        if idle:
+            ice_maker.wait_while_bin_full()
+    elapsed = ice_maker.clock.monotonic() / 3600
+    return {
+        'ice_per_hour': model.harvested_ice / elapsed,
+        'wh_per_lb': model.energy_wh / model.harvested_ice if model.harvested_ice else float('inf'),
+        'cycle_minutes': cycle_time / ice_maker.cycle_count / 60 if ice_maker.cycle_count else float('inf'),
+        'cycles': ice_maker.cycle_count,
+    }
+
+
+def run_one(job):
+    settings, base, hours, params, idle = job
+    config = dict(base)
+    config.update(settings)
+    try:
+        return settings, simulate(config, hours, params, idle), None
+    except (ValueError, KeyError, TypeError) as error:
+        return settings, None, str(error)
+
+
+def sweep(grid, base, hours, params=None, jobs=None, idle=True):
+    names = list(grid)
+    combinations = [dict(zip(names, values)) for values in itertools.product(*grid.values())]
+    work = [(settings, base, hours, params, idle) for settings in combinations]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(run_one, work, chunksize=max(1, len(work) // ((jobs or os.cpu_count()) * 4))))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sweep config settings over the simulator and rank the results.')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUES',
+                        help='setting to sweep, start:stop:step or a,b,c (repeatable)')
+    parser.add_argument('--config', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json'),
+                        help='base config the swept settings are applied on top of')
+    parser.add_argument('--model', help='JSON file of simulator.ThermalModel parameters, e.g. from calibrate.py')
+    parser.add_argument('--hours', type=float, default=8, help='simulated hours per configuration')
+    parser.add_argument('--continuous', action='store_true', help='run cycles back to back, no bin-full idling')
+    parser.add_argument('--rank', choices=sorted(METRICS), default='ice')
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--jobs', type=int, help='worker processes (default: all cores)')
+    parser.add_argument('--output', help='write the winning config here instead of stdout')
+    args = parser.parse_args()
+
+    grid = parse_settings(args.set)
+    if not grid:
+        parser.error('nothing to sweep, give at least one --set')
+    base = load_config(args.config)
+    params = None
+    if args.model:
+        from simulator import load_params
+        params = load_params(args.model)
+
+    results = sweep(grid, base, args.hours, params, args.jobs, not args.continuous)
+    key, higher = METRICS[args.rank]
+    ranked = sorted((result for result in results if result[1] is not None),
+                    key=lambda result: result[1][key], reverse=higher)
+    for settings, _, error in results:
+        if error:
+            print(f'skipped {settings}: {error}', file=sys.stderr)
+    if not ranked:
+        sys.exit('no valid configuration')
+
+    print(f'{len(results)} configurations, {args.hours:g} simulated hours each, ranked by {args.rank}', file=sys.stderr)
+    for settings, metrics, _ in ranked[:args.top]:
+        print('  ' + ' '.join(f'{name}={value}' for name, value in settings.items())
+              + f'  {metrics["ice_per_hour"]:.2f} lb/h  {metrics["wh_per_lb"]:.1f} Wh/lb'
+              + f'  {metrics["cycle_minutes"]:.1f} min/cycle', file=sys.stderr)
+
+    best = dict(base)
+    best.update(ranked[0][0])
+    text = json.dumps(best, indent=4)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
@@ -0,0 +1,182 @@
+import argparse
+import csv
+import logging
+import math
+import os
+import struct
+
+# Per-tick telemetry.
+#
+# Every control tick is packed into one fixed-width binary record in a
+# preallocated ring buffer, instead of being formatted into a text log line.
+# The records not yet on disk are appended to a binary file in batches, so the
+# SD card sees one write every few hundred ticks.  A write that fails (full or
+# read-only card) is logged and the records stay pending for the next one.  At the 5 second tick a day
+# is about 17k records (~530 kB), so the default buffer holds two weeks in
+# about 7.5 MB of RAM.
+#
+# File layout: an 8 byte header (magic, format version, record size) followed
+# by records, little endian:
+#   timestamp      float64  unix time, seconds
+#   mode           uint8    index into MODES
+#   target         float32  °F, NaN for a phase without one
+#   plate          float32  °F
+#   bin            float32  °F
+#   relays         uint16   bit i set while relay i (IceMaker.relays order) is on
+#   time_in_mode   float32  seconds
+#   time_in_cycle  float32  seconds
+
+RECORD = struct.Struct('<dBfffHff')
+FIELDS = ('timestamp', 'mode', 'target', 'plate', 'bin', 'relays', 'time_in_mode', 'time_in_cycle')
+MAGIC = b'ICET'
+VERSION = 1
+HEADER = struct.Struct('<4sBxH')
+MODES = ('IDLE', 'CHILL', 'ICE', 'HEAT')
+# modes from custom recipe phases that aren't in MODES
+OTHER_MODE = 255
+
+MODE_CODES = {mode: code for code, mode in enumerate(MODES)}
+
+
+def mode_name(code):
+    return MODES[code] if code < len(MODES) else 'OTHER'
+
+
+class Telemetry():
+    # capacity: records kept in memory
+    # batch:    pending records that trigger a write to the file
+    def __init__(self, capacity=14*24*720, path=None, batch=720, logger=None):
+        self.logger = logger or logging.getLogger()
+        self.capacity = capacity
+        self.batch = batch
+        self.buffer = bytearray(capacity * RECORD.size)
+        # next slot to write and number of valid records
+        self.head = 0
+        self.count = 0
+        # records written to the buffer but not to the file yet
+        self.pending = 0
+        # records since the last write attempt, so a failing file is retried once a batch
+        self.since_attempt = 0
+        self.dropped = 0
+        self.path = None
+        if path is not None:
+            self.open(path)
+
+    def open(self, path):
+        # append to path from now on, writing the header if the file is new
+        self.path = path
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            with open(path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+        else:
+            check_header(path)
+
+    def record(self, timestamp, mode, target, plate, bin_temp, relays, time_in_mode, time_in_cycle):
+        RECORD.pack_into(self.buffer, self.head * RECORD.size, timestamp, MODE_CODES.get(mode, OTHER_MODE),
+                         math.nan if target is None else target, plate, bin_temp, relays, time_in_mode, time_in_cycle)
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        if self.path is None:
+            return
+        self.pending += 1
+        self.since_attempt += 1
+        if self.pending > self.capacity:
+            # the file fell a whole buffer behind (e.g. it couldn't be written)
+            self.dropped += self.pending - self.capacity
+            self.pending = self.capacity
+        if self.since_attempt >= self.batch:
+            self.flush()
+
+    def _chunks(self, n):
+        # the last n records as at most two contiguous slices of the buffer, oldest first
+        start = (self.head - n) % self.capacity
+        if start + n <= self.capacity:
+            return [self.buffer[start * RECORD.size:(start + n) * RECORD.size]]
+        return [self.buffer[start * RECORD.size:], self.buffer[:self.head * RECORD.size]]
+
+    def flush(self):
+        if self.path is None or not self.pending:
+            return
+        self.since_attempt = 0
+        try:
+            with open(self.path, 'ab') as f:
+                size = f.tell()
+                try:
+                    for chunk in self._chunks(self.pending):
+                        f.write(chunk)
+                    f.flush()
+                except OSError:
+                    # cut off a partly written batch, a torn record would misalign the rest of the file
+                    f.truncate(size)
+                    raise
+        except OSError as error:
+            # keep the records pending and try again next time
+            self.logger.error(f'Could not write {self.path}: {error}')
+            return
+        self.pending = 0
+
+    def records(self):
+        # buffered records as tuples in FIELDS order, oldest first
+        for chunk in self._chunks(self.count):
+            yield from RECORD.iter_unpack(chunk)
+
+
+def check_header(path):
+    with open(path, 'rb') as f:
+        magic, version, size = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or version != VERSION or size != RECORD.size:
+        raise ValueError(f'{path} is not a version {VERSION} telemetry file')
+
+
+def read_file(path, chunk_records=4096):
+    # records in a telemetry file as tuples in FIELDS order; a torn last record is ignored
+    check_header(path)
+    with open(path, 'rb') as f:
+        f.seek(HEADER.size)
+        while True:
+            data = f.read(chunk_records * RECORD.size)
+            whole = len(data) - len(data) % RECORD.size
+            if not whole:
+                return
+            yield from RECORD.iter_unpack(data[:whole])
+
+
+def write_csv(records, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(FIELDS)
+        for record in records:
+            writer.writerow((f'{record[0]:.3f}', mode_name(record[1])) + tuple(
+                f'{value:.2f}' if isinstance(value, float) else value for value in record[2:]))
+
+
+def numpy_dtype():
+    import numpy
+    return numpy.dtype([('timestamp', '<f8'), ('mode', 'u1'), ('target', '<f4'), ('plate', '<f4'),
+                        ('bin', '<f4'), ('relays', '<u2'), ('time_in_mode', '<f4'), ('time_in_cycle', '<f4')])
+
+
+def load_numpy(path):
+    # the whole file as a structured array, without unpacking record by record
+    import numpy
+    check_header(path)
+    dtype = numpy_dtype()
+    count = (os.path.getsize(path) - HEADER.size) // dtype.itemsize
+    return numpy.fromfile(path, dtype=dtype, count=count, offset=HEADER.size)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a telemetry file.')
+    parser.add_argument('path', help='telemetry file written by the controller')
+    parser.add_argument('--csv', help='write the records to this CSV file')
+    parser.add_argument('--npy', help='write the records to this .npy file (needs numpy)')
+    args = parser.parse_args()
+
+    if args.csv:
+        write_csv(read_file(args.path), args.csv)
+    if args.npy:
+        import numpy
+        numpy.save(args.npy, load_numpy(args.path))
+    if not args.csv and not args.npy:
+        count = (os.path.getsize(args.path) - HEADER.size) // RECORD.size
+        print(f'{count} records of {RECORD.size} bytes')
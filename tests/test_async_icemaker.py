@@ -0,0 +1,40 @@
+import os
+
+from async_icemaker import AsyncIceMaker, run
+from simulator import SimBackend
+from stats import JOURNAL_HEADER
+from telemetry import HEADER
+
+
+def test_background_tasks_run(tmp_path):
+    ice_maker = AsyncIceMaker(backend=SimBackend(AsyncIceMaker.relays))
+    ice_maker.telemetry.open(str(tmp_path / 'telemetry.bin'))
+    ice_maker.stats.open(str(tmp_path / 'stats.json'))
+    run(ice_maker.run(1), ice_maker.backend)
+
+    report = ice_maker.scheduler.report()
+    for name in ('stats_flush', 'telemetry_flush', 'sensor_check', 'scheduler_report'):
+        assert report[name]['runs'] > 0, name
+    # written while running, not just at shutdown
+    assert os.path.getsize(tmp_path / 'stats.json.journal') > JOURNAL_HEADER.size
+    assert os.path.getsize(tmp_path / 'telemetry.bin') > HEADER.size
+
+
+def test_warm_restart_resumes_the_checkpointed_phase(tmp_path):
+    ice_maker = AsyncIceMaker(backend=SimBackend(AsyncIceMaker.relays))
+    ice_maker.checkpoint.open(str(tmp_path / 'checkpoint.json'))
+    now = ice_maker.wall_offset + ice_maker.clock.monotonic()
+    ice_maker.checkpoint.save({'saved_at': now - 30, 'stopped_at': now - 30, 'phase': 'harvest', 'mode': 'HEAT',
+                               'phase_start': now - 90, 'cycle_start': now - 1200, 'relays': [], 'changed_at': {}})
+    entered = []
+    enter = ice_maker.engine.enter
+
+    def record(recipe, state, elapsed=0.0):
+        entered.append((recipe.names[state], elapsed))
+        enter(recipe, state, elapsed)
+
+    ice_maker.engine.enter = record
+    ice_maker.power_on = None  # must not be called
+    run(ice_maker.run(1, restart=True), ice_maker.backend)
+    assert entered == [('harvest', 60.0), ('rechill', 0.0)]
+    assert ice_maker.cycle_count == 1
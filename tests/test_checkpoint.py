@@ -0,0 +1,51 @@
+import pytest
+
+from checkpoint import restart_plan
+from recipe import DEFAULT_CONFIG, compile_recipe
+
+NOW = 1_700_000_000.0
+MAX_AGE = 60 * 60
+RECIPE = compile_recipe(dict(DEFAULT_CONFIG))
+
+
+def checkpoint(phase, down, in_phase=90, in_cycle=600, stopped=True):
+    # a checkpoint saved `down` seconds before NOW, `in_phase` s into phase
+    stopped_at = NOW - down
+    return {'version': 1, 'saved_at': stopped_at - (0 if stopped else 5), 'stopped_at': stopped_at if stopped else None,
+            'phase': phase, 'mode': None, 'phase_start': stopped_at - in_phase, 'cycle_start': stopped_at - in_cycle,
+            'relays': [], 'changed_at': {}}
+
+
+def never_read():
+    raise AssertionError('plate read when the plan does not depend on it')
+
+
+CASES = [
+    # (case, checkpoint, plate temp, power on, resume)
+    ('no checkpoint', None, never_read, True, None),
+    ('too old', checkpoint('ice', MAX_AGE + 1), never_read, True, None),
+    ('saved in the future', checkpoint('ice', -120), never_read, True, None),
+    ('between cycles', checkpoint(None, 300), never_read, False, None),
+    ('between cycles, saved not stopped', checkpoint(None, 300, stopped=False), never_read, False, None),
+    ('mid prechill', checkpoint('prechill', 300), never_read, False, ('prechill', 90.0, 600.0)),
+    ('mid harvest', checkpoint('harvest', 300, in_phase=30), never_read, False, ('harvest', 30.0, 600.0)),
+    ('cold ice phase', checkpoint('ice', 300), lambda: 20.0, False, ('ice', 90.0, 600.0)),
+    ('warmed ice phase', checkpoint('ice', 300), lambda: 40.0, False, ('harvest', 0.0, 600.0)),
+    ('phase gone from recipe', checkpoint('defrost', 300), never_read, False, None),
+    ('clock stepped back past the phase start', checkpoint('rechill', 300, in_phase=-50, in_cycle=-50), never_read,
+     False, ('rechill', 0.0, 0.0)),
+]
+
+
+@pytest.mark.parametrize('case, state, read_plate, power_on, resume', CASES, ids=[case[0] for case in CASES])
+def test_restart_plan(case, state, read_plate, power_on, resume):
+    plan = restart_plan(state, NOW, read_plate, RECIPE, MAX_AGE)
+    assert plan[:2] == (power_on, resume)
+    assert plan[2]
+
+
+def test_warmed_last_phase_starts_over():
+    recipe = compile_recipe(dict(DEFAULT_CONFIG, phases=[
+        {'name': 'ice', 'mode': 'ICE', 'target': -2, 'on': ['compressor_1'], 'off': ['hot_gas_solenoid', 'condenser_fan'],
+         'timeout': 25}]))
+    assert restart_plan(checkpoint('ice', 300), NOW, lambda: 40.0, recipe, MAX_AGE)[:2] == (False, None)
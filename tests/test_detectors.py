@@ -0,0 +1,77 @@
+from detectors import ReleaseDetector, slope
+from recipe import DEFAULT_CONFIG, RELEASED, compile_recipe
+from simulator import simulated_ice_maker
+
+
+def feed(detector, samples):
+    return [detector.update(t, temp) for t, temp in samples]
+
+
+def harvest_curve(plateau_end=90, step=5):
+    # plate warming to the melt plateau, sitting there, then climbing once the slab lets go
+    samples = []
+    for t in range(0, 180, step):
+        if t < 30:
+            temp = 20 + t * 0.4
+        elif t < plateau_end:
+            temp = 32.0 + (t % 10) * 0.01
+        else:
+            temp = 32.0 + (t - plateau_end) * 0.25
+        samples.append((float(t), temp))
+    return samples
+
+
+def test_slope():
+    assert slope([]) == 0.0
+    assert slope([(0, 1.0), (0, 2.0)]) == 0.0
+    assert abs(slope([(0, 10.0), (10, 15.0), (20, 20.0)]) - 0.5) < 1e-12
+
+
+def test_released_after_plateau_then_rise():
+    detector = ReleaseDetector()
+    samples = harvest_curve()
+    results = feed(detector, samples)
+    first = results.index(True)
+    # not before the slab lets go at 90 s, and within a few ticks of it
+    assert 90 < samples[first][0] <= 110
+    assert detector.had_plateau
+    # latched from then on
+    assert all(results[first:])
+
+
+def test_rise_without_plateau_is_not_a_release():
+    detector = ReleaseDetector()
+    results = feed(detector, [(float(t), 20 + t * 0.25) for t in range(0, 180, 5)])
+    assert not any(results)
+    assert detector.slope > detector.release_slope
+
+
+def test_short_plateau_is_not_enough():
+    detector = ReleaseDetector(min_plateau=30)
+    # plateau from 30 s to 50 s only
+    assert not any(feed(detector, harvest_curve(plateau_end=50)))
+
+
+def test_release_exit_is_off_by_default():
+    recipe = compile_recipe(dict(DEFAULT_CONFIG))
+    harvest = recipe.names.index('harvest')
+    assert RELEASED not in [row[0] for row in recipe.transitions[harvest]]
+
+    recipe = compile_recipe(dict(DEFAULT_CONFIG, harvest_release_detect=True))
+    assert recipe.transitions[harvest][0][0] == RELEASED
+
+
+def test_release_ends_harvest_below_a_high_threshold():
+    ice_maker = simulated_ice_maker(config={'harvest_release_detect': True, 'harvest_threshold_temp': 52.5})
+    exits = []
+    exit = ice_maker.engine.exit
+
+    def record(recipe, state, description):
+        exits.append((recipe.names[state], description, ice_maker.plate_temp))
+        exit(recipe, state, description)
+
+    ice_maker.engine.exit = record
+    ice_maker.run_cycle()
+    [(description, plate_temp)] = [exit[1:] for exit in exits if exit[0] == 'harvest']
+    assert description == 'released >= 1'
+    assert plate_temp < 52.5
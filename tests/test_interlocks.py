@@ -0,0 +1,63 @@
+import pytest
+
+from interlocks import Interlocks
+
+RELAYS = ('compressor', 'fan', 'hot_gas', 'valve')
+
+
+def state(*on):
+    return {relay: relay in on for relay in RELAYS}
+
+
+def never():
+    return dict.fromkeys(RELAYS, float('-inf'))
+
+
+def test_offs_before_ons():
+    interlocks = Interlocks()
+    plan = interlocks.plan(state('fan'), never(), [('hot_gas', True), ('fan', False)], 100.0)
+    assert plan == [(100.0, (('fan', False), ('hot_gas', True)))]
+
+
+def test_already_set_relays_are_left_alone():
+    interlocks = Interlocks()
+    assert interlocks.plan(state('fan'), never(), [('fan', True), ('hot_gas', False)], 100.0) == []
+
+
+def test_min_off_waits_only_as_long_as_required():
+    interlocks = Interlocks(min_off={'compressor': 180})
+    changed_at = dict(never(), compressor=50.0)
+    plan = interlocks.plan(state(), changed_at, [('fan', True), ('compressor', True)], 100.0)
+    # the fan goes on now, the compressor once it has been off for 3 minutes
+    assert plan == [(100.0, (('fan', True),)), (230.0, (('compressor', True),))]
+    assert interlocks.plan(state(), never(), [('compressor', True)], 100.0) == [(100.0, (('compressor', True),))]
+
+
+def test_exclusive_partner_switched_off_first():
+    interlocks = Interlocks(exclusive=[('hot_gas', 'fan')])
+    plan = interlocks.plan(state('compressor', 'fan'), never(), [('fan', False), ('hot_gas', True)], 100.0)
+    assert plan == [(100.0, (('fan', False), ('hot_gas', True)))]
+
+
+def test_exclusive_pair_rejected():
+    interlocks = Interlocks(exclusive=[('hot_gas', 'fan')])
+    with pytest.raises(ValueError):
+        interlocks.plan(state('fan'), never(), [('hot_gas', True)], 100.0)
+
+
+def test_quiet_relay_waits_for_guards():
+    # the valve only moves once the compressor has been off 60 s, and the
+    # compressor comes back 60 s after the valve moved
+    interlocks = Interlocks(quiet=[('valve', ('compressor',), 60)])
+    plan = interlocks.plan(state('compressor'), never(), [('valve', True)], 100.0)
+    assert plan == [(100.0, (('compressor', False),)), (160.0, (('valve', True),)), (220.0, (('compressor', True),))]
+
+
+def test_check_settings():
+    interlocks = Interlocks(exclusive=[('hot_gas', 'fan')])
+    interlocks.check_settings({'fan': False}, [('hot_gas', True)])
+    interlocks.check_settings({}, [('fan', False), ('hot_gas', True)])
+    with pytest.raises(ValueError, match='may still be on'):
+        interlocks.check_settings({}, [('hot_gas', True)])
+    with pytest.raises(ValueError, match='never be on together'):
+        interlocks.check_settings({'fan': True}, [('hot_gas', True)])
@@ -0,0 +1,47 @@
+import logging
+import queue
+import threading
+
+import pytest
+
+from instrument import Timer
+from logsetup import LazyQueueHandler
+
+
+def test_timer_merge():
+    a, b = Timer(), Timer()
+    a.add(0.000001)
+    b.add(0.001)
+    b.add(0.002)
+    a.merge(b)
+    assert a.count == 3
+    assert a.total == pytest.approx(0.003001)
+    assert a.max == 0.002
+    assert sum(a.buckets) == 3
+
+
+def test_enqueue_timer_counts_every_thread():
+    threads, records = 8, 2000
+    handler = LazyQueueHandler(queue.Queue())
+    logger = logging.getLogger('test_logsetup.threads')
+    logger.propagate = False
+    logger.addHandler(handler)
+    start = threading.Barrier(threads)
+
+    def log():
+        start.wait()
+        for i in range(records):
+            logger.warning('record %d', i)
+
+    workers = [threading.Thread(target=log) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    logger.removeHandler(handler)
+
+    assert len(handler.timers) == threads
+    timer = handler.timer
+    assert timer.count == threads * records == handler.queue.qsize()
+    assert sum(timer.buckets) == timer.count
+    assert handler.timer.export()['count'] == timer.count
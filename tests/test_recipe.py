@@ -0,0 +1,138 @@
+import logging
+
+import pytest
+
+from interlocks import Interlocks
+from mark_icemaker2 import IceMaker
+from recipe import DEFAULT_CONFIG, DONE, compile_recipe, entry_states
+
+
+def interlocks():
+    return Interlocks(**IceMaker.interlock_rules)
+
+
+def phase(name, on=(), off=(), next=None, exits=()):
+    return {'name': name, 'mode': 'CHILL', 'on': list(on), 'off': list(off), 'exits': list(exits), 'timeout': 1, 'next': next}
+
+
+def compile_phases(*phases):
+    return compile_recipe(dict(DEFAULT_CONFIG, phases=list(phases)), IceMaker.relays, interlocks())
+
+
+def test_default_recipe_compiles():
+    recipe = compile_recipe(dict(DEFAULT_CONFIG), IceMaker.relays, interlocks())
+    assert recipe.names == ('prechill', 'ice', 'harvest', 'rechill')
+    assert recipe.transitions[-1][-1][3] == DONE
+
+
+def test_relays_carry_over_between_phases():
+    recipe = compile_recipe(dict(DEFAULT_CONFIG), IceMaker.relays, interlocks())
+    entry = entry_states(recipe)
+    # nothing is known when a cycle starts
+    assert entry[0] == {}
+    assert entry[recipe.names.index('harvest')]['condenser_fan'] is True
+    assert entry[recipe.names.index('rechill')]['hot_gas_solenoid'] is True
+
+
+def test_hot_gas_with_the_fan_left_on_is_rejected():
+    with pytest.raises(ValueError, match='Phase heat: hot_gas_solenoid and condenser_fan must never be on together'):
+        compile_phases(phase('chill', on=['condenser_fan', 'compressor_1'], off=['hot_gas_solenoid'], next='heat'),
+                       phase('heat', on=['hot_gas_solenoid']))
+
+
+def test_hot_gas_with_the_fan_switched_off_compiles():
+    compile_phases(phase('chill', on=['condenser_fan', 'compressor_1'], off=['hot_gas_solenoid'], next='heat'),
+                   phase('heat', on=['hot_gas_solenoid'], off=['condenser_fan']))
+
+
+def test_fan_left_off_by_the_phase_before_compiles():
+    compile_phases(phase('chill', on=['compressor_1'], off=['hot_gas_solenoid', 'condenser_fan'], next='heat'),
+                   phase('heat', on=['hot_gas_solenoid']))
+
+
+def test_first_phase_may_start_with_anything_on():
+    # the idle loop runs the condenser fan between cycles
+    with pytest.raises(ValueError, match='Phase heat: hot_gas_solenoid is switched on while condenser_fan may still be on'):
+        compile_phases(phase('heat', on=['hot_gas_solenoid']))
+
+
+def test_every_path_into_a_phase_is_checked():
+    # heat follows fan_off directly, but also chill through an exit
+    with pytest.raises(ValueError, match='Phase heat'):
+        compile_phases(phase('fan_off', on=['compressor_1'], off=['condenser_fan', 'hot_gas_solenoid'], next='chill'),
+                       phase('chill', on=['condenser_fan'], off=['hot_gas_solenoid'], next='fan_off',
+                             exits=[{'when': 'plate_temp <= 20', 'next': 'heat'}]),
+                       phase('heat', on=['hot_gas_solenoid']))
+
+
+def test_exclusive_pair_in_one_phase_is_rejected():
+    with pytest.raises(ValueError, match='must never be on together'):
+        compile_phases(phase('both', on=['hot_gas_solenoid', 'condenser_fan']))
+
+
+def test_unknown_relay_is_rejected():
+    with pytest.raises(ValueError, match='Unknown relay'):
+        compile_phases(phase('chill', on=['defroster']))
+
+
+class StubWatcher():
+    def __init__(self, config):
+        self.config = config
+
+    def poll(self):
+        config, self.config = self.config, None
+        return config
+
+
+def test_reloaded_phase_that_cannot_follow_the_relays_is_not_switched_to():
+    from simulator import simulated_ice_maker
+    ice_maker = simulated_ice_maker()
+    recipe = ice_maker.recipe
+    ice_maker.apply_relays(recipe.relays[recipe.names.index('ice')])
+    # fine from its own first phase, but not with the fan the old ice phase left on
+    ice_maker.config_watcher = StubWatcher(dict(DEFAULT_CONFIG, phases=[
+        phase('prechill', on=['compressor_1'], off=['condenser_fan', 'hot_gas_solenoid'], next='harvest'),
+        phase('harvest', on=['hot_gas_solenoid'])]))
+    new_recipe, state = ice_maker.engine.boundary(recipe, recipe.names.index('harvest'))
+    assert ice_maker.recipe is not recipe
+    assert new_recipe is recipe and state == recipe.names.index('harvest')
+
+
+def test_interlock_wait_does_not_count_against_the_phase_timeout():
+    from simulator import simulated_ice_maker
+    ice_maker = simulated_ice_maker()
+    min_off = ice_maker.interlock_rules['min_off']['compressor_1']
+    # compressors switched off a minute ago: prechill waits out the rest of min_off first
+    switched_off = ice_maker.clock.monotonic() - 60
+    for relay in ('compressor_1', 'compressor_2'):
+        ice_maker.relay_bank.changed_at[relay] = switched_off
+    exits = []
+    exit = ice_maker.engine.exit
+
+    def record(recipe, state, description):
+        exits.append((recipe.names[state], description, ice_maker.clock.monotonic()))
+        exit(recipe, state, description)
+
+    ice_maker.engine.exit = record
+    ice_maker.run_cycle()
+    name, description, ended = exits[0]
+    assert name == 'prechill' and description == 'timeout'
+    compressors_on = switched_off + min_off
+    # the whole 2 minute timeout is spent chilling, none of it waiting for the interlock
+    assert ended - compressors_on == pytest.approx(ice_maker.recipe.timeouts[0] * ice_maker.MIN)
+
+
+def test_reload_applies_debug_and_log_levels():
+    from simulator import simulated_ice_maker
+    ice_maker = simulated_ice_maker()
+    minute = ice_maker.MIN
+    ice_maker.config_watcher = StubWatcher(dict(ice_maker.config, debug=True, log_levels={'relays': 'ERROR'}))
+    assert ice_maker.reload_config()
+    assert ice_maker.debug
+    assert ice_maker.logger.getChild('relays').level == logging.ERROR
+    # debug only shortens minutes at startup
+    assert ice_maker.MIN == minute
+    ice_maker.config_watcher = StubWatcher(dict(ice_maker.config, debug=False, log_levels={}))
+    assert ice_maker.reload_config()
+    assert not ice_maker.debug
+    assert ice_maker.logger.getChild('relays').level == logging.NOTSET
@@ -0,0 +1,28 @@
+from simulator import simulated_ice_maker
+
+
+def test_watchdog_rewrites_pins_that_disagree_with_the_shadow():
+    ice_maker = simulated_ice_maker()
+    bank = ice_maker.relay_bank
+    ice_maker.apply_relays((('condenser_fan', True), ('compressor_1', True)))
+    changed_at = dict(bank.changed_at)
+    assert ice_maker.relay_watchdog() == []
+
+    # a glitch drops the compressor and turns the pump on behind the bank's back
+    gpio = ice_maker.gpio
+    gpio.output(bank.pins['compressor_1'], 1)
+    gpio.output(bank.pins['recirculating_pump'], 0)
+    assert sorted(ice_maker.relay_watchdog()) == ['compressor_1', 'recirculating_pump']
+    assert gpio.input(bank.pins['compressor_1']) == 0
+    assert gpio.input(bank.pins['recirculating_pump']) == 1
+    assert bank.mismatched() == []
+    assert bank.repairs == 2
+    # as far as the interlocks know, nothing switched
+    assert bank.changed_at == changed_at
+    assert bank.state()['compressor_1'] and not bank.state()['recirculating_pump']
+
+
+def test_watchdog_runs_as_a_scheduler_task():
+    ice_maker = simulated_ice_maker()
+    ice_maker.scheduler.sleep(5 * ice_maker.MIN)
+    assert ice_maker.scheduler.report()['relay_watchdog']['runs'] == 5
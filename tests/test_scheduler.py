@@ -0,0 +1,85 @@
+import logging
+
+from scheduler import Scheduler
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def scheduler(clock):
+    return Scheduler(clock, logging.getLogger('test.scheduler'))
+
+
+def test_tasks_run_on_absolute_deadlines():
+    clock = FakeClock()
+    s = scheduler(clock)
+    times = []
+    # each run takes 2 s, which must not push the schedule back
+    task = s.add_task('slow', 10, lambda: (times.append(clock.now), setattr(clock, 'now', clock.now + 2)))
+    s.sleep_until(45)
+    assert times == [10, 20, 30, 40]
+    assert task.overruns == 0 and task.deadline == 50
+
+
+def test_missed_ticks_are_skipped_and_counted():
+    clock = FakeClock()
+    s = scheduler(clock)
+    task = s.add_task('ticker', 10)
+    clock.now = 35
+    s.wait(task)
+    # one late tick for 10, the ones due at 20 and 30 are skipped
+    assert task.runs == 1 and task.overruns == 1
+    assert task.max_lateness == 25
+    assert task.deadline == 40
+    s.wait(task)
+    assert clock.now == 40 and task.runs == 2 and task.overruns == 1
+
+
+def test_catch_up_after_a_stall_does_not_burst():
+    clock = FakeClock()
+    s = scheduler(clock)
+    times = []
+    task = s.add_task('flush', 10, lambda: times.append(clock.now))
+    # the loop was blocked for 55 s (e.g. a stuck bus read)
+    clock.now = 55
+    s.sleep_until(80)
+    # one late run, then back on the original 10 s grid
+    assert times == [55, 60, 70, 80]
+    assert task.overruns == 1
+
+
+def test_failing_task_is_isolated_and_counted():
+    clock = FakeClock()
+    s = scheduler(clock)
+    runs = []
+
+    def broken():
+        raise OSError('disk full')
+
+    bad = s.add_task('bad', 10, broken)
+    good = s.add_task('good', 10, lambda: runs.append(clock.now))
+    s.sleep_until(30)
+    assert runs == [10, 20, 30]
+    assert bad.failures == 3 and bad.runs == 3
+    assert good.failures == 0
+    assert s.report()['bad']['failures'] == 3
+
+
+def test_wait_is_capped_by_until():
+    clock = FakeClock()
+    s = scheduler(clock)
+    task = s.add_task('phase', 5)
+    s.wait(task, until=3)
+    assert clock.now == 3 and task.runs == 0
+    s.wait(task, until=100)
+    assert clock.now == 5 and task.runs == 1
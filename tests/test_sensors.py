@@ -0,0 +1,168 @@
+import logging
+import threading
+import time
+
+import pytest
+
+from sensors import (HEALTH_OK, HEALTH_WARN, SensorFilter, SensorReader, SensorSampler, SensorSnapshot,
+                     StaleReadingError)
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeReader():
+    # scripted reads: {name: [value or exception, ...]}, each read taking `duration` seconds
+    def __init__(self, clock, script, duration=0.75):
+        self.clock = clock
+        self.script = {name: list(values) for name, values in script.items()}
+        self.duration = duration
+        self.calls = []
+
+    def read(self, names, timeout=None):
+        self.calls.append((list(names), timeout))
+        start = self.clock.monotonic()
+        values, errors = {}, {}
+        for name in names:
+            result = self.script[name].pop(0)
+            if isinstance(result, Exception):
+                errors[name] = result
+            else:
+                values[name] = result
+        self.clock.now += self.duration
+        return SensorSnapshot(start, values, self.duration, errors)
+
+
+def sampler(script, retries=1, deadline=2.0, duration=0.75, period=1):
+    clock = FakeClock()
+    reader = FakeReader(clock, script, duration)
+    return SensorSampler(reader, {'plate': period}, clock=clock, logger=logging.getLogger('test.sensors'),
+                         retries=retries, deadline=deadline), reader, clock
+
+
+def test_failed_read_is_retried():
+    s, reader, clock = sampler({'plate': [OSError('CRC check failed'), 40.0]})
+    assert s.get('plate') == 40.0
+    assert len(reader.calls) == 2
+    assert s.error_count['plate'] == 1
+
+
+def test_no_retry_past_the_deadline():
+    # a second 1.5 s read would end past the 2 s deadline
+    s, reader, clock = sampler({'plate': [40.0, OSError('CRC check failed'), 41.0]}, duration=1.5)
+    assert s.get('plate') == 40.0
+    clock.now = 2.0
+    assert s.get('plate') == 40.0
+    assert len(reader.calls) == 2
+    assert s.error_count['plate'] == 1
+
+
+def test_reads_are_given_the_deadline():
+    s, reader, clock = sampler({'plate': [40.0]}, deadline=1.25)
+    s.get('plate')
+    assert reader.calls == [(['plate'], 1.25)]
+
+
+def test_hung_read_is_abandoned_at_the_deadline():
+    release = threading.Event()
+
+    def hung():
+        release.wait(5)
+        return 40.0
+
+    reader = SensorReader({'plate': hung, 'bin': lambda: 30.0}, parallel=True)
+    try:
+        start = time.monotonic()
+        snapshot = reader.read(timeout=0.05)
+        assert time.monotonic() - start < 1
+        assert snapshot.values == {'bin': 30.0}
+        assert isinstance(snapshot.errors['plate'], TimeoutError)
+        # not queued behind the read that's still hanging
+        snapshot = reader.read(timeout=0.05)
+        assert 'still busy' in str(snapshot.errors['plate'])
+    finally:
+        release.set()
+        reader.close()
+
+
+def test_single_glitch_keeps_the_last_reading():
+    s, reader, clock = sampler({'plate': [40.0, OSError('bus error'), 39.5]}, retries=0)
+    assert s.get('plate') == 40.0
+    clock.now = 1.0
+    assert s.get('plate') == 40.0
+    assert s.cache['plate'].timestamp == 0.0
+    assert s.error_count['plate'] == 1
+    clock.now = 2.0
+    assert s.get('plate') == 39.5
+
+
+def test_power_on_reset_value_is_rejected():
+    f = SensorFilter()
+    assert f.check(185.0, 0.0) == 'power-on reset value'
+    assert f.check(184.995, 0.0) == 'power-on reset value'
+    assert f.check(184.0, 0.0) is None
+
+    s, reader, clock = sampler({'plate': [40.0, 185.0, 40.5]})
+    assert s.get('plate') == 40.0
+    clock.now = 1.0
+    # rejected, retried within the deadline
+    assert s.get('plate') == 40.5
+    assert s.error_count['plate'] == 1
+
+
+def test_out_of_range_and_nan_are_rejected():
+    f = SensorFilter()
+    assert f.check(float('nan'), 0.0).endswith('out of range')
+    assert f.check(300.0, 0.0).endswith('out of range')
+    assert f.check(None, 0.0).endswith('out of range')
+
+
+def test_spike_is_rejected_until_the_history_resets():
+    f = SensorFilter(window=5, max_jump=10.0, max_rate=2.0)
+    for t in range(5):
+        assert f.check(30.0, float(t)) is None
+    # 30 °F away and only 3 s since the middle reading: at most 16 °F allowed
+    for t in range(5, 9):
+        assert f.check(60.0, float(t)).startswith('spike')
+    # five in a row: the temperature really moved, start over from here
+    assert f.check(60.0, 9.0) is None
+    assert list(f.history) == [(9.0, 60.0)]
+    assert f.check(60.5, 10.0) is None
+
+
+def test_slow_change_is_not_a_spike():
+    f = SensorFilter(window=5, max_jump=10.0, max_rate=2.0)
+    for t in range(0, 50, 10):
+        assert f.check(30.0, float(t)) is None
+    # 25 °F off the median, but the middle reading is 30 s old
+    assert f.check(55.0, 50.0) is None
+
+
+def test_health_and_error_count():
+    s, reader, clock = sampler({'plate': [40.0] + [OSError('bus error')] * 8 + [40.0] * 30}, retries=0)
+    assert s.get('plate') == 40.0
+    assert s.health['plate'] == 1.0
+    for second in range(1, 9):
+        clock.now = float(second)
+        s.poll()
+    assert s.error_count['plate'] == 8
+    assert s.health['plate'] < HEALTH_WARN
+    assert 'plate' in s.unhealthy
+    # three missed reads and then some: stale
+    with pytest.raises(StaleReadingError):
+        s.get('plate')
+    for second in range(9, 39):
+        clock.now = float(second)
+        s.poll()
+    assert s.get('plate') == 40.0
+    assert s.health['plate'] > HEALTH_OK
+    assert 'plate' not in s.unhealthy
+    assert s.error_count['plate'] == 8
@@ -0,0 +1,97 @@
+import os
+
+import stats
+from stats import ENTRY, JOURNAL_HEADER, StatsStore
+
+
+def reopened(path):
+    return StatsStore(str(path)).values
+
+
+def test_counts_survive_a_restart(tmp_path):
+    path = tmp_path / 'stats.json'
+    store = StatsStore(str(path))
+    store.add('batches')
+    store.add('compressor_on_time', 12.5)
+    store.flush()
+    store.add('batches')
+    store.flush()
+    values = reopened(path)
+    assert values['batches'] == 2 and values['compressor_on_time'] == 12.5
+
+
+def test_old_generation_journal_is_skipped_after_compaction(tmp_path):
+    path = tmp_path / 'stats.json'
+    store = StatsStore(str(path), journal_limit=2)
+    store.add('batches', 3)
+    store.flush()
+    old_journal = (tmp_path / 'stats.json.journal').read_bytes()
+    store.add('water_fills')
+    store.flush()
+    # compacted into generation 1
+    assert store.generation == 1
+    # power cut after the snapshot was replaced but before the new journal was started
+    (tmp_path / 'stats.json.journal').write_bytes(old_journal + ENTRY.pack(stats.COUNTERS.index('water_fills'), 1))
+    values = reopened(path)
+    assert values['batches'] == 3 and values['water_fills'] == 1
+
+
+def test_torn_final_entry_is_dropped_and_truncated(tmp_path):
+    path = tmp_path / 'stats.json'
+    store = StatsStore(str(path))
+    store.add('batches', 2)
+    store.flush()
+    journal = tmp_path / 'stats.json.journal'
+    whole = os.path.getsize(journal)
+    with open(journal, 'ab') as f:
+        f.write(ENTRY.pack(0, 5)[:4])
+    values = reopened(path)
+    assert values['batches'] == 2
+    assert os.path.getsize(journal) == whole
+    # and the next flush appends after the good entries
+    store = StatsStore(str(path))
+    store.add('batches')
+    store.flush()
+    assert reopened(path)['batches'] == 3
+
+
+def test_garbage_final_entry_is_ignored(tmp_path):
+    path = tmp_path / 'stats.json'
+    store = StatsStore(str(path))
+    store.add('compressor_starts', 4)
+    store.flush()
+    with open(tmp_path / 'stats.json.journal', 'ab') as f:
+        f.write(ENTRY.pack(200, 1e9) + b'\xff' * 3)
+    values = reopened(path)
+    assert values['compressor_starts'] == 4
+    assert sum(values.values()) == 4
+
+
+def test_stale_journal_is_retried(tmp_path, monkeypatch):
+    path = tmp_path / 'stats.json'
+    store = StatsStore(str(path), journal_limit=1)
+    write_atomic = stats.write_atomic
+    failing = True
+
+    def flaky(target, data):
+        if failing and target.endswith('.journal'):
+            raise OSError(28, 'No space left on device')
+        write_atomic(target, data)
+
+    monkeypatch.setattr(stats, 'write_atomic', flaky)
+    store.add('batches')
+    # compacts: the snapshot is written, the new generation's journal isn't
+    store.flush()
+    assert store.generation == 1 and store.journal_stale
+    store.add('batches')
+    store.flush()
+    # nothing appended to the old generation's journal, where it would be lost
+    assert store.pending == {'batches': 1}
+    header = (tmp_path / 'stats.json.journal').read_bytes()[:JOURNAL_HEADER.size]
+    assert JOURNAL_HEADER.unpack(header)[1] == 0
+
+    failing = False
+    store.add('batches')
+    store.flush()
+    assert not store.journal_stale and store.pending == {}
+    assert reopened(path)['batches'] == 3
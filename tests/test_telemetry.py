@@ -0,0 +1,38 @@
+import math
+
+from recipe import DEFAULT_CONFIG
+from simulator import simulated_ice_maker
+from telemetry import Telemetry, mode_name, read_file
+
+
+def test_record_round_trip(tmp_path):
+    telemetry = Telemetry(capacity=4, batch=2)
+    telemetry.open(str(tmp_path / 'telemetry.bin'))
+    for i in range(3):
+        telemetry.record(1000.0 + i, 'ICE', -2.0, 10.0 - i, 40.0, 0b101, 5.0 * i, 60.0 + i)
+    telemetry.flush()
+    records = list(read_file(str(tmp_path / 'telemetry.bin')))
+    assert list(telemetry.records()) == records
+    assert [r[0] for r in records] == [1000.0, 1001.0, 1002.0]
+    assert mode_name(records[0][1]) == 'ICE' and records[0][2] == -2.0 and records[0][5] == 0b101
+
+
+def test_phase_without_target_records_nan():
+    telemetry = Telemetry(capacity=4)
+    telemetry.record(1000.0, 'FILL', None, 50.0, 40.0, 0, 0.0, 0.0)
+    [record] = telemetry.records()
+    assert mode_name(record[1]) == 'OTHER'
+    assert math.isnan(record[2])
+
+
+def test_cycle_with_targetless_phases():
+    phases = [
+        {'name': 'fill', 'mode': 'FILL', 'on': ['water_valve'], 'timeout': 0.25, 'next': 'ice'},
+        {'name': 'ice', 'mode': 'ICE', 'on': ['condenser_fan', 'compressor_1', 'compressor_2', 'recirculating_pump'],
+         'off': ['water_valve', 'hot_gas_solenoid'], 'exits': ['plate_temp <= 20'], 'timeout': 5},
+    ]
+    ice_maker = simulated_ice_maker(config=dict(DEFAULT_CONFIG, phases=phases))
+    ice_maker.run_cycle()
+    assert ice_maker.cycle_count == 1
+    records = list(ice_maker.telemetry.records())
+    assert records and all(math.isnan(record[2]) for record in records)
@@ -1,7 +1,10 @@
+import time
 import RPi.GPIO as GPIO
 import Adafruit_DHT
-import time
 import logging
+from interlocks import Interlocks
+from relays import RelayBank
+from scheduler import Scheduler
 
 class IceMaker():
     relays = {
@@ -13,6 +16,13 @@ class IceMaker():
         'compressor_fan': 23
     }
 
+    # relay safety rules, see interlocks.py
+    interlock_rules = {
+        # the reversing valve only moves with the compressors stopped & settled,
+        # and the compressors only restart once it has moved
+        'quiet': [('reverse_cycle', ('compressor_1', 'compressor_2'), 5)],
+    }
+
     sensors = {
         'temp_humid': 17
     }
@@ -21,11 +31,27 @@ class IceMaker():
 
     def __init__(self):
         self.logger = logging.getLogger()
+        # all delays run on one timeline, so time spent switching relays and
+        # printing doesn't add up over a cycle
+        self.scheduler = Scheduler(logger=self.logger)
+        self.timeline = self.scheduler.timeline()
         GPIO.setmode(GPIO.BCM)
         GPIO.setwarnings(False)
         for relay in self.relays.values():
             GPIO.setup(relay, GPIO.OUT, initial=GPIO.HIGH)
-            GPIO.output(relay, 1)
+        self.relay_bank = RelayBank(GPIO, self.relays, time)
+        self.relay_bank.all_off()
+        self.interlocks = Interlocks(**self.interlock_rules)
+
+    def switch(self, *settings):
+        # (relay, on) pairs, in as few steps and as little time as the interlocks allow
+        plan = self.interlocks.plan(self.relay_bank.state(), self.relay_bank.changed_at, settings, time.monotonic())
+        for at, batch in plan:
+            if at > time.monotonic():
+                # on the timeline, so the next delay counts from when the relays really switched
+                start = time.monotonic() if self.timeline.target is None else self.timeline.target
+                self.timeline.sleep(at - start)
+            self.relay_bank.apply(batch)
 
     def fill(self):
         # determine how long to fill
@@ -41,9 +67,9 @@ class IceMaker():
             sleep_time = 30
         # do the fill
         print(f'Filling for {sleep_time} seconds. Fill #{self.fill_count}')
-        GPIO.output(self.relays['water_fill'], 0)
-        time.sleep(sleep_time)
-        GPIO.output(self.relays['water_fill'], 1)
+        self.switch(('water_fill', True))
+        self.timeline.sleep(sleep_time)
+        self.switch(('water_fill', False))
 
     def freeze(self):
         # Ensure reverse relay is not active
@@ -53,15 +79,13 @@ class IceMaker():
     def circulate(self):
         # Start circulation pump
         print('Starting circulation')
-        GPIO.output(self.relays['water_circulation'], 0)
+        self.switch(('water_circulation', True))
 
     def stop_ice(self):
         print('Stopping circulation and compressors.')
         # Stop circulation pump and compressors
-        GPIO.output(self.relays['water_circulation'], 1)
-        GPIO.output(self.relays['compressor_1'], 1)
-        GPIO.output(self.relays['compressor_2'], 1)
-        GPIO.output(self.relays['compressor_fan'], 1)
+        self.switch(('water_circulation', False), ('compressor_1', False), ('compressor_2', False),
+                    ('compressor_fan', False))
 
     def remove_ice(self):
         print('Removing ice.')
@@ -71,65 +95,44 @@ class IceMaker():
 
         # Plate should be warm after 30 seconds of compressor running
         # Turn off compressors
-        time.sleep(30)
+        self.timeline.sleep(30)
         print('Turning off compressors.')
-        GPIO.output(self.relays['compressor_1'], 1)
-        GPIO.output(self.relays['compressor_2'], 1)
+        self.switch(('compressor_1', False), ('compressor_2', False))
 
 
     def cooldown(self):
         # Ensure compressors are stopped. Leave fan spinning.
         # Cool down for 3 minutes.
         print('Starting cooldown mode.')
-        GPIO.output(self.relays['compressor_1'], 1)
-        GPIO.output(self.relays['compressor_2'], 1)
-        time.sleep(5)
-        GPIO.output(self.relays['reverse_cycle'], 1)
-        GPIO.output(self.relays['compressor_fan'], 0)
-        time.sleep(3 * 60)
-        GPIO.output(self.relays['compressor_fan'], 1)
+        self.switch(('compressor_1', False), ('compressor_2', False), ('reverse_cycle', False),
+                    ('compressor_fan', True))
+        self.timeline.sleep(3 * 60)
+        self.switch(('compressor_fan', False))
         print('Leaving cooldown mode.')
 
     def _start_heat_cycle(self):
         print('Starting a heat cycle.')
-        # Ensure compressors are off
-        GPIO.output(self.relays['compressor_1'], 1)
-        GPIO.output(self.relays['compressor_2'], 1)
-        time.sleep(5)
-        # Ensure reverse cycle is engaged
-        GPIO.output(self.relays['reverse_cycle'], 0)
-        time.sleep(5)
-
-        # Start compressors
-        GPIO.output(self.relays['compressor_fan'], 0)
-        GPIO.output(self.relays['compressor_1'], 0)
-        GPIO.output(self.relays['compressor_2'], 0)
+        # reverse cycle engaged, then fan & compressors; the interlocks stop the
+        # compressors first and wait only if they haven't been off long enough
+        self.switch(('reverse_cycle', True), ('compressor_fan', True), ('compressor_1', True), ('compressor_2', True))
 
     def _start_cool_cycle(self):
         print('Starting a cool cycle.')
-        GPIO.output(self.relays['compressor_1'], 1)
-        GPIO.output(self.relays['compressor_2'], 1)
-        time.sleep(5)
-        # Ensure reverse cycle is not engaged
-        GPIO.output(self.relays['reverse_cycle'], 1)
-        
-        # Start compressors
-        time.sleep(5)
-        GPIO.output(self.relays['compressor_fan'], 0)
-        GPIO.output(self.relays['compressor_1'], 0)
-        GPIO.output(self.relays['compressor_2'], 0)
+        # reverse cycle disengaged, then fan & compressors
+        self.switch(('reverse_cycle', False), ('compressor_fan', True), ('compressor_1', True), ('compressor_2', True))
 
 
 if __name__ == '__main__':
     ice_maker = IceMaker()
     print('Starting IceMaker Program.')
+    ice_maker.timeline.reset()
     while True:
         ice_maker.fill()
         ice_maker.freeze()
-        time.sleep(20)
+        ice_maker.timeline.sleep(20)
         ice_maker.circulate()
-        time.sleep(15 * 60)
+        ice_maker.timeline.sleep(15 * 60)
         ice_maker.stop_ice()
-        time.sleep(15)
+        ice_maker.timeline.sleep(15)
         ice_maker.remove_ice()
         ice_maker.cooldown()